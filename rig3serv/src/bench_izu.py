@@ -0,0 +1,187 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Izu parser benchmark
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import sys
+import getopt
+from rig.log import Log
+from rig.parser import izu_bench
+
+#------------------------
+class BenchIzu(object):
+    _USAGE = """
+bench_izu [-h] [-l lines] [-r repeat] [-s seed] [-b baseline.json] [--save] [--scaling] [--img-gen]
+
+Renders a synthetic Izu document and reports the lines/sec and MB/sec of
+the IzuParser renders and of each formatter stage.
+
+Options:
+    -h, --help:     This help
+    -l, --lines:    Number of lines of the document (default: %(_lines)s)
+    -r, --repeat:   Number of renders, the best one is kept (default: %(_repeat)s)
+    -s, --seed:     Seed of the document generator (default: %(_seed)s)
+    --tags, --accents, --tables, --rigimg, --escapes:
+                    Probability for a line to have inline tags, accents, or to
+                    start a table, a rig image or an escape block.
+    -b, --baseline: JSON results of a previous run to compare with
+                    (default: %(_baseline)s)
+    --save:         Saves the results as the new baseline
+    -t, --tolerance: Slowdown ratio reported as a regression (default: %(_tolerance)s)
+    --scaling:      Also checks that the render time of izu_bench.SCALING
+                    patterns grows linearly with their size
+    --img-gen:      Also renders an album with a mocked slow img_gen_script
+                    using 1 then 4 img_gen_workers
+
+Exits with 1 when a render or stage is slower than the baseline, when
+the render time of a scaling pattern is not linear, or when 4 img_gen_workers
+are not at least twice as fast as one.
+"""
+
+    def __init__(self):
+        self._log = None
+        self._lines = 2000
+        self._repeat = 3
+        self._seed = 0
+        self._densities = {}
+        self._baseline = "izu_bench.json"
+        self._save = False
+        self._tolerance = 0.1
+        self._scaling = False
+        self._img_gen = False
+
+    def _UsageAndExit(self, msg=None):
+        """
+        Prints usage string and exit program.
+        """
+        if msg:
+            print msg
+        print self._USAGE % self.__dict__
+        sys.exit(2)
+
+    def ParseArgs(self, argv):
+        """
+        Parses command line arguments.
+        """
+        densities = { "--tags":    "tag_density",
+                      "--accents": "accent_density",
+                      "--tables":  "table_density",
+                      "--rigimg":  "rigimg_density",
+                      "--escapes": "escape_density" }
+        try:
+            options, args = getopt.getopt(argv[1:],
+                                          "hHl:r:s:b:t:",
+                                          ["help", "lines=", "repeat=", "seed=",
+                                           "baseline=", "save", "tolerance=", "scaling", "img-gen"] +
+                                          [ k[2:] + "=" for k in densities ])
+            for opt, value in options:
+                if opt in ["-h",  "-H", "--help"]:
+                    self._UsageAndExit()
+                elif opt in ["-l", "--lines"]:
+                    self._lines = int(value)
+                elif opt in ["-r", "--repeat"]:
+                    self._repeat = int(value)
+                elif opt in ["-s", "--seed"]:
+                    self._seed = int(value)
+                elif opt in ["-b", "--baseline"]:
+                    self._baseline = value
+                elif opt == "--save":
+                    self._save = True
+                elif opt in ["-t", "--tolerance"]:
+                    self._tolerance = float(value)
+                elif opt == "--scaling":
+                    self._scaling = True
+                elif opt == "--img-gen":
+                    self._img_gen = True
+                elif opt in densities:
+                    self._densities[densities[opt]] = float(value)
+        except (getopt.error, ValueError), msg:
+            self._UsageAndExit(msg)
+
+    def Run(self):
+        """
+        Runs the benchmark. Returns the list of regressions.
+        """
+        self._log = Log(file=sys.stdout, use_stderr=False)
+        settings = dict(self._densities, num_lines=self._lines, seed=self._seed)
+        corpus, images = izu_bench.GenerateCorpus(**settings)
+        bench = izu_bench.IzuBench(self._log, corpus, images,
+                                   settings=settings, repeat=self._repeat)
+        results = bench.Run()
+        if self._scaling:
+            results["scaling"] = bench.Scaling()
+        if self._img_gen:
+            results["img_gen"] = bench.ImgGen()
+
+        baseline = None
+        if os.path.exists(self._baseline):
+            baseline = izu_bench.Load(self._baseline)
+            if not izu_bench.SameCorpus(baseline, results):
+                self._log.Warning("Baseline %s was measured on another corpus, ignored",
+                                  self._baseline)
+                baseline = None
+
+        izu_bench.Report(self._log, results, baseline)
+
+        slower = []
+        if baseline:
+            slower = izu_bench.Compare(baseline, results, self._tolerance)
+            for name, before, after in slower:
+                self._log.Error("%s is slower: %.0f lines/s instead of %.0f lines/s",
+                                name, after, before)
+        for name, ratio in izu_bench.CheckScaling(results):
+            self._log.Error("%s is not linear: x%.1f for 4 times the content", name, ratio)
+            slower.append((name, ratio))
+        for name, speedup in izu_bench.CheckImgGen(results):
+            self._log.Error("%s workers are only x%.1f faster", name, speedup)
+            slower.append((name, speedup))
+        if self._save:
+            izu_bench.Save(results, self._baseline)
+            self._log.Info("Baseline saved to %s", self._baseline)
+        return slower
+
+    def Close(self):
+        """
+        Close whatever is needed before leaving.
+        """
+        self._log.Close()
+
+#------------------------
+def main():
+    b = BenchIzu()
+    b.ParseArgs(sys.argv)
+    slower = b.Run()
+    b.Close()
+    sys.exit(slower and 1 or 0)
+
+if __name__ == "__main__":
+    main()
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
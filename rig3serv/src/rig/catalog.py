@@ -0,0 +1,270 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Sqlite catalog of the entries of a source tree.
+
+A catalog lists the directory and file entries of a blog source tree so
+that a SourceCatalogReader can generate the source items without walking
+the tree. It can be built by "rig3 --build-catalog" or by any external
+tool that follows the schema documented in Catalog.
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import json
+import os
+import sha
+import sqlite3
+import time
+from datetime import datetime
+
+from rig.parser.izu_parser import IzuParser
+from rig.source_item import SourceDir, SourceFile
+
+CATALOG_VERSION = "1"
+
+
+#------------------------
+class Catalog(object):
+    """
+    An sqlite3 catalog of the entries of a source tree.
+
+    Schema:
+
+      CREATE TABLE info (
+          key   TEXT PRIMARY KEY,
+          value TEXT);
+
+        - "version": the catalog version, currently "1".
+        - "base": absolute path of the source tree. Item paths are
+          relative to it.
+
+      CREATE TABLE items (
+          path   TEXT PRIMARY KEY,
+          kind   TEXT NOT NULL,
+          date   REAL NOT NULL,
+          files  TEXT NOT NULL,
+          tags   TEXT NOT NULL,
+          digest TEXT NOT NULL,
+          stamp  REAL NOT NULL);
+
+        - path: path of the item relative to the base.
+        - kind: "dir" for a directory entry, "file" for a file entry.
+        - date: date of the item, in seconds since the epoch.
+        - files: the file names of a "dir" item, one per line. Empty for a
+          "file" item.
+        - tags: JSON dict of the izu header tags of the item. Categories are
+          a list and dates a "YYYY-MM-DD HH:MM:SS" string.
+        - digest: a hex digest that changes when the content of the item
+          changes. Rig3 uses SHA1.
+        - stamp: most recent modification time of the item when it was
+          cataloged, only used by Update(). Can be 0.
+    """
+
+    INDEX_FILES = [ "index.izu", "index.html" ]
+
+    def __init__(self, log, path):
+        self._log = log
+        self._path = path
+        self._db = None
+
+    def Open(self, create=False):
+        """
+        Opens the catalog. If create is true, creates the catalog tables
+        if they don't exist yet.
+
+        Text is read and written as byte strings, as found in the file system.
+
+        Raises an IOError if the catalog does not exist or has an
+        unsupported version.
+
+        Returns self for chaining.
+        """
+        if not create and not os.path.exists(self._path):
+            raise IOError("Catalog %s does not exist" % self._path)
+        self._db = sqlite3.connect(self._path)
+        self._db.text_factory = str
+        if create:
+            self._db.execute("CREATE TABLE IF NOT EXISTS info ("
+                             "key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS items ("
+                             "path TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                             "date REAL NOT NULL, files TEXT NOT NULL, "
+                             "tags TEXT NOT NULL, digest TEXT NOT NULL, "
+                             "stamp REAL NOT NULL)")
+            if self._GetInfo("version") is None:
+                self._SetInfo("version", CATALOG_VERSION)
+            self._db.commit()
+        version = self._GetInfo("version")
+        if version != CATALOG_VERSION:
+            self.Close()
+            raise IOError("Unsupported version %s for catalog %s" % (version, self._path))
+        return self
+
+    def Close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def GetBase(self):
+        """
+        Returns the absolute path of the source tree, or None if not set.
+        """
+        return self._GetInfo("base")
+
+    def Items(self):
+        """
+        Returns the list of items of the catalog, sorted by path, as tuples
+        (path, kind, date, files, tags, digest) where date is a datetime,
+        files a list and tags a dict.
+        """
+        result = []
+        for path, kind, date, files, tags, digest in self._db.execute(
+                "SELECT path, kind, date, files, tags, digest FROM items ORDER BY path"):
+            result.append((path,
+                           kind,
+                           datetime.fromtimestamp(date),
+                           files and files.split("\n") or [],
+                           json.loads(tags),
+                           digest))
+        return result
+
+    def Update(self, base, source_items, encoding):
+        """
+        Updates the catalog with the given list of SourceDir and SourceFile,
+        typically parsed by a SourceBlogReader on the base directory.
+
+        Items which date and stamp did not change are kept as-is. Others are added
+        or updated and their index file is read to compute their tags and
+        digest. Items not in the list are removed.
+
+        Returns a tuple (number of items added or updated, number removed).
+        """
+        if base != self.GetBase():
+            self._SetInfo("base", base)
+
+        stamps = {}
+        for path, kind, date, stamp in self._db.execute("SELECT path, kind, date, stamp FROM items"):
+            stamps[path] = (kind, date, stamp)
+
+        updated = 0
+        seen = {}
+        for item in source_items:
+            if isinstance(item, SourceDir):
+                kind = "dir"
+                path = item.rel_dir.rel_curr
+                abs_dir = item.rel_dir.abs_path
+                files = list(item.all_files)
+                abs_files = [ os.path.join(abs_dir, f) for f in files ]
+                stamp = max([ os.path.getmtime(f) for f in [ abs_dir ] + abs_files ])
+            elif isinstance(item, SourceFile):
+                kind = "file"
+                path = item.rel_file.rel_curr
+                files = []
+                abs_files = [ item.rel_file.abs_path ]
+                stamp = os.path.getmtime(item.rel_file.abs_path)
+            else:
+                self._log.Info("Catalog: ignore unsupported item %s", item.PrettyRepr())
+                continue
+
+            seen[path] = True
+            date = time.mktime(item.date.timetuple())
+            if stamps.get(path) == (kind, date, stamp):
+                continue
+
+            if kind == "dir":
+                index = [ f for f in self.INDEX_FILES if f in files ]
+                index = index and os.path.join(abs_dir, index[0]) or None
+            else:
+                index = abs_files[0]
+            tags, digest = self._ScanItem(index, abs_files, encoding)
+
+            self._db.execute("INSERT OR REPLACE INTO items "
+                             "(path, kind, date, files, tags, digest, stamp) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (path,
+                              kind,
+                              date,
+                              "\n".join(files),
+                              json.dumps(tags, encoding="iso-8859-1", sort_keys=True),
+                              digest,
+                              stamp))
+            updated += 1
+            self._log.Debug("Catalog: update %s", path)
+
+        removed = 0
+        for path in stamps.iterkeys():
+            if not path in seen:
+                self._db.execute("DELETE FROM items WHERE path = ?", (path, ))
+                removed += 1
+                self._log.Debug("Catalog: remove %s", path)
+
+        self._db.commit()
+        return updated, removed
+
+    def _ScanItem(self, index, abs_files, encoding):
+        """
+        Returns the (tags, digest) of an item given its index file (or None)
+        and the list of its files.
+
+        The digest covers the content of the index file as well as the
+        names, sizes and modification times of all the files.
+        """
+        tags = {}
+        md = sha.new()
+        if index:
+            tags = IzuParser(self._log, None, None).ParseFileFirstLine(index, encoding)
+            if "encoding" in tags:
+                tags = IzuParser(self._log, None, None).ParseFileFirstLine(index, tags["encoding"])
+            f = file(index, "rb")
+            try:
+                md.update(f.read())
+            finally:
+                f.close()
+        for f in abs_files:
+            st = os.stat(f)
+            md.update(repr((os.path.basename(f), st.st_size, st.st_mtime)))
+
+        json_tags = {}
+        for k, v in tags.iteritems():
+            if isinstance(v, dict):
+                v = sorted(v.keys())
+            elif isinstance(v, datetime):
+                v = v.strftime("%Y-%m-%d %H:%M:%S")
+            json_tags[k] = v
+        return json_tags, md.hexdigest()
+
+    def _GetInfo(self, key):
+        row = self._db.execute("SELECT value FROM info WHERE key = ?", (key, )).fetchone()
+        return row and row[0] or None
+
+    def _SetInfo(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+                         (key, value))
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Content digest storage
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import sha
+
+from rig import stats
+
+_READ_SIZE = 64 * 1024
+
+
+#------------------------
+class DigestStore(object):
+    """
+    Content digest storage for rig3.
+
+    The "digest store" remembers the SHA1 digest of the content of source
+    files between runs of rig3. Digests are indexed by the (device, inode,
+    size, modification time) of the file, so a file is only read when its
+    stat changes. A file which is touched but not modified is read once
+    and keeps the same digest.
+
+    Only the digests used during a run are saved, so entries for files
+    that were deleted or modified do not accumulate in the cache.
+    """
+    def __init__(self, log, cache):
+        self._log = log
+        self._cache = cache
+        self._digests = {}
+        self._used = {}
+
+    def Load(self):
+        self._digests = self._cache.Compute(
+             key=str(self.__class__) + "_digest_store",
+             lambda_expr=lambda : self._digests,
+             stat_prefix=None,
+             use_cache=True)
+
+    def Save(self):
+        key=str(self.__class__) + "_digest_store"
+        self._cache.Store(self._used, key)
+
+    def FileDigest(self, path):
+        """
+        Returns the hex SHA1 digest of the content of the given file.
+        Will raise an OSError if the file cannot be accessed.
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = self._digests[key] = ComputeDigest(path)
+        else:
+            stats.Start("1.0 Digest Hit").Stop()
+        self._used[key] = digest
+        return digest
+
+    def Clear(self):
+        self._digests = {}
+        self._used = {}
+
+
+#------------------------
+def ComputeDigest(path):
+    """
+    Reads the given file and returns the hex SHA1 digest of its content.
+    """
+    s = stats.Start("1.0 Digest Read")
+    md = sha.new()
+    f = file(path, "rb")
+    try:
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                break
+            md.update(data)
+    finally:
+        f.close()
+    s.Stop()
+    return md.hexdigest()
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -23,7 +23,11 @@ __author__ = "ralfoide at gmail com"
 
 import os
 import re
+import sha
+import stat
+import threading
 
+from rig import stats
 from rig.hashable import Hashable
 
 _EXCLUDE = ".rig3-exclude"
@@ -54,6 +58,61 @@ def PathTimestamp(path):
     except OSError:
         return None
 
+_STAMP_IGNORE = [ ".git", ".svn", "_svn", ".cvs" ]
+
+def TreeStamp(path, item_files):
+    """
+    Returns a hex digest of the state of a source tree, which changes when
+    a directory or an item file of the tree changes.
+
+    The digest covers the modification time of every directory and the
+    size and modification time of the files which name matches the
+    item_files regexp. Any change of these values changes the stamp, not
+    only newer times. When path is a file, only that file is used.
+
+    This is meant to be cheap, so the other files are not looked at:
+    - a file which does not match item_files (e.g. an image) and which is
+      rewritten in place without changing its directory does not change
+      the stamp.
+    - on file systems where the link count of a directory is 2 plus its
+      number of sub-directories, files are only stat'ed until all the
+      sub-directories are found. Symbolic links to directories may then
+      be skipped.
+
+    Returns None if the path does not exist.
+    """
+    md = sha.new()
+    try:
+        _TreeStamp(md, path, os.stat(path), item_files)
+    except OSError:
+        return None
+    return md.hexdigest()
+
+def _TreeStamp(md, path, st, item_files):
+    if not stat.S_ISDIR(st.st_mode):
+        md.update(repr((path, st.st_size, st.st_mtime)))
+        return
+    md.update(repr((path, st.st_mtime)))
+    # Number of sub-directories left to find, or -1 if unknown
+    subdirs = st.st_nlink >= 2 and st.st_nlink - 2 or -1
+    names = os.listdir(path)
+    names.sort()
+    for name in names:
+        if name in _STAMP_IGNORE:
+            continue
+        is_item = item_files.search(name)
+        if is_item or subdirs != 0:
+            full = os.path.join(path, name)
+            try:
+                st2 = os.stat(full)
+            except OSError:
+                continue  # e.g. a broken link
+            if stat.S_ISDIR(st2.st_mode):
+                subdirs -= 1
+                _TreeStamp(md, full, st2, item_files)
+            elif is_item:
+                _TreeStamp(md, full, st2, item_files)
+
 
 #------------------------
 class RelPath(Hashable):
@@ -179,6 +238,7 @@ class DirParser(object):
         self._log = log
         self._files = []
         self._sub_dirs = []
+        self._empty_dirs = []
         self._abs_source_dir = abs_source_dir
         self._abs_dest_dir = abs_dest_dir
         self._rel_curr_dir = None
@@ -226,6 +286,7 @@ class DirParser(object):
         """
         self._files = []
         self._sub_dirs = []
+        self._empty_dirs = []
         self._rel_curr_dir = rel_curr_dir
 
         if isinstance(dir_pattern, (str, unicode)):
@@ -257,6 +318,7 @@ class DirParser(object):
                         self._sub_dirs.append(p)
                         self._log.Debug("Append dir: %s", full_path)
                     else:
+                        self._empty_dirs.append(full_path)
                         self._log.Debug("Ignore empty dir: %s", full_path)
                 else:
                     self._log.Debug("Ignore dir: %s", full_path)
@@ -270,6 +332,37 @@ class DirParser(object):
         self._sub_dirs.sort(cmp=lambda x, y: cmp(x._rel_curr_dir, y._rel_curr_dir))
         return self
 
+    def WithDestDir(self, abs_dest_dir):
+        """
+        Returns a copy of this parsed tree associated with another
+        destination directory. The file lists are shared, not copied.
+        """
+        p = self._new()
+        p._abs_source_dir = self._abs_source_dir
+        p._abs_dest_dir = abs_dest_dir
+        p._rel_curr_dir = self._rel_curr_dir
+        p._files = self._files
+        p._empty_dirs = self._empty_dirs
+        p._sub_dirs = [ d.WithDestDir(abs_dest_dir) for d in self._sub_dirs ]
+        return p
+
+    def DirStamps(self):
+        """
+        Returns a list of (absolute directory, modification times) for all
+        the directories of the tree. Adding, removing or renaming an entry
+        changes the modification time of its directory. The modification
+        time of the exclude file of the directory is also included.
+
+        Empty sub-directories are not in the tree but are included since
+        files could be added to them.
+        """
+        abs_dir = self.AbsSourceDir().abs_path
+        stamps = [ (abs_dir, _DirMTime(abs_dir)) ]
+        stamps.extend([ (d, _DirMTime(d)) for d in self._empty_dirs ])
+        for d in self._sub_dirs:
+            stamps.extend(d.DirStamps())
+        return stamps
+
     def TraverseDirs(self):
         """
         Generator that traverses the directories in the directory structure.
@@ -385,6 +478,140 @@ class DirParser(object):
             self._log.Exception("isdir error on '%s'", dir)
             return False
 
+#------------------------
+_TREES = {}     # (abs_source_dir, file_pattern, dir_pattern) => (dir stamps, DirParser)
+_TREES_LOCK = threading.Lock()
+_WALKS_SAVED = [ 0 ]
+
+def _DirMTime(abs_dir):
+    """
+    Returns the modification times of a directory and of its exclude file.
+    """
+    result = []
+    for path in [ abs_dir, os.path.join(abs_dir, _EXCLUDE) ]:
+        try:
+            result.append(os.path.getmtime(path))
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+def _PatternKey(pattern):
+    return (getattr(pattern, "pattern", pattern), getattr(pattern, "flags", 0))
+
+def SharedParse(log, abs_source_dir, abs_dest_dir, file_pattern=".", dir_pattern="."):
+    """
+    Same as DirParser(log).Parse(abs_source_dir, abs_dest_dir, file_pattern, dir_pattern)
+    except the parsed tree is kept for the rest of the run and shared by all
+    the callers that parse the same source directory with the same patterns,
+    e.g. several sites using the same sources. The destination directory
+    does not need to match.
+
+    A shared tree is parsed again if any of its directories changed.
+
+    The "1.0 Dir Walk" and "1.0 Dir Walk Saved" stats count the walks
+    done and avoided.
+    """
+    key = (abs_source_dir, _PatternKey(file_pattern), _PatternKey(dir_pattern))
+    _TREES_LOCK.acquire()
+    try:
+        entry = _TREES.get(key)
+    finally:
+        _TREES_LOCK.release()
+
+    if entry is not None:
+        stamps, tree = entry
+        if [ (d, _DirMTime(d)) for d, _ in stamps ] == stamps:
+            stats.Start("1.0 Dir Walk Saved").Stop()
+            _TREES_LOCK.acquire()
+            _WALKS_SAVED[0] += 1
+            _TREES_LOCK.release()
+            return tree.WithDestDir(abs_dest_dir)
+
+    s = stats.Start("1.0 Dir Walk")
+    tree = DirParser(log).Parse(abs_source_dir, abs_dest_dir, file_pattern, dir_pattern)
+    s.Stop()
+    _TREES_LOCK.acquire()
+    try:
+        _TREES[key] = (tree.DirStamps(), tree)
+    finally:
+        _TREES_LOCK.release()
+    return tree
+
+def WalksSaved():
+    """
+    Returns the number of directory walks avoided by SharedParse so far.
+    """
+    return _WALKS_SAVED[0]
+
+def ClearSharedTrees():
+    """
+    Discards all the trees kept by SharedParse and resets WalksSaved().
+    """
+    _TREES_LOCK.acquire()
+    try:
+        _TREES.clear()
+        _WALKS_SAVED[0] = 0
+    finally:
+        _TREES_LOCK.release()
+
+
+#------------------------
+_LISTINGS = {}  # abs_dir => (dir mtime, list of names)
+_LISTINGS_LOCK = threading.Lock()
+_LISTINGS_SAVED = [ 0 ]
+
+def CachedListDir(abs_dir):
+    """
+    Same as os.listdir(abs_dir) except the listing is kept for the rest of
+    the run, so that a directory is only listed once however many times it
+    is looked up. A directory is listed again if its modification time
+    changed. The returned list is shared and must not be modified.
+
+    The "1.0 Listdir" and "1.0 Listdir Saved" stats count the listings
+    done and avoided.
+
+    Will raise an OSError if the directory cannot be listed.
+    """
+    abs_dir = os.path.normpath(abs_dir)
+    mtime = os.path.getmtime(abs_dir)
+    _LISTINGS_LOCK.acquire()
+    try:
+        entry = _LISTINGS.get(abs_dir)
+        if entry is not None and entry[0] == mtime:
+            _LISTINGS_SAVED[0] += 1
+            stats.Start("1.0 Listdir Saved").Stop()
+            return entry[1]
+    finally:
+        _LISTINGS_LOCK.release()
+
+    s = stats.Start("1.0 Listdir")
+    names = os.listdir(abs_dir)
+    s.Stop()
+    _LISTINGS_LOCK.acquire()
+    try:
+        _LISTINGS[abs_dir] = (mtime, names)
+    finally:
+        _LISTINGS_LOCK.release()
+    return names
+
+def ListingsSaved():
+    """
+    Returns the number of directory listings avoided by CachedListDir so far.
+    """
+    return _LISTINGS_SAVED[0]
+
+def ClearListings():
+    """
+    Discards all the listings kept by CachedListDir and resets ListingsSaved().
+    """
+    _LISTINGS_LOCK.acquire()
+    try:
+        _LISTINGS.clear()
+        _LISTINGS_SAVED[0] = 0
+    finally:
+        _LISTINGS_LOCK.release()
+
+
 #------------------------
 # Local Variables:
 # mode: python
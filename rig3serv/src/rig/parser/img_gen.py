@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Long-running image generation script
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import json
+import subprocess
+import threading
+
+from rig import stats
+
+SERVER_ARG = "--json-lines"
+
+
+#------------------------
+class ImgGenServer(object):
+    """
+    An img_gen_script started once with the --json-lines argument, which
+    processes all the image requests of the run.
+
+    Each request is written on the script's stdin as a JSON object on a
+    single line, with the same fields as the environment of the one-shot
+    mode: ABS_DIR, REL_FILE, IMG_NAME, IS_LINK, OPT_SIZE, OPT_TITLE,
+    OPT_CAPTION and RIG_BASE.
+
+    The script must reply with a JSON object on a single line of its stdout:
+    { "ret": 0, "output": "..." } where output is what the one-shot mode
+    would print and ret its exit code. "ret" can be omitted when it is 0.
+
+    The script receives an end-of-file on stdin when rig3 is done and must
+    then exit.
+    """
+    def __init__(self, log, script):
+        self._log = log
+        self._script = script
+        self._process = None
+        self._lock = threading.Lock()
+
+    def Request(self, env):
+        """
+        Sends a request to the script, starting it if needed.
+        Returns a tuple (ret, output). Ret is -1 if the script died or sent
+        an invalid reply, in which case it is started again on the next
+        request.
+        """
+        self._lock.acquire()
+        try:
+            s = stats.Start("1.2 Img Gen Request")
+            try:
+                if self._process is None:
+                    self._Start()
+                self._process.stdin.write(json.dumps(env, encoding="iso-8859-1") + "\n")
+                self._process.stdin.flush()
+                reply = json.loads(self._process.stdout.readline())
+                ret = int(reply.get("ret", 0))
+                output = reply.get("output", "")
+                if isinstance(output, unicode):
+                    output = output.encode("iso-8859-1", "xmlcharrefreplace")
+                return ret, output
+            except (IOError, OSError, ValueError, AttributeError), e:
+                self._log.Error("Image Gen Script %s failed: %s", self._script, e)
+                self._Stop()
+                return -1, ""
+        finally:
+            s.Stop()
+            self._lock.release()
+
+    def Stop(self):
+        """
+        Closes the script's input and waits for it to exit.
+        """
+        self._lock.acquire()
+        try:
+            self._Stop()
+        finally:
+            self._lock.release()
+
+    def _Start(self):
+        stats.Start("1.2 Img Gen Start").Stop()
+        self._process = self._SubprocessPopen([ self._script, SERVER_ARG ],
+                                              stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE,
+                                              stderr=None,
+                                              shell=False)
+
+    def _Stop(self):
+        p = self._process
+        self._process = None
+        if p is not None:
+            try:
+                p.stdin.close()
+                p.wait()
+            except (IOError, OSError):
+                pass
+
+    def _SubprocessPopen(self, *popenargs, **kwargs):
+        """
+        Returns the result from subprocess.Popen().
+        This is useful for mocking in unit tests.
+        """
+        return subprocess.Popen(*popenargs, **kwargs)
+
+
+#------------------------
+_SERVERS = {}   # script => ImgGenServer
+_SERVERS_LOCK = threading.Lock()
+
+def Get(log, script):
+    """
+    Returns the ImgGenServer for the given script, shared by all the callers
+    for the rest of the run.
+    """
+    _SERVERS_LOCK.acquire()
+    try:
+        server = _SERVERS.get(script)
+        if server is None:
+            server = _SERVERS[script] = ImgGenServer(log, script)
+        return server
+    finally:
+        _SERVERS_LOCK.release()
+
+def StopAll():
+    """
+    Stops all the servers started by Get().
+    """
+    _SERVERS_LOCK.acquire()
+    try:
+        servers = _SERVERS.values()
+        _SERVERS.clear()
+    finally:
+        _SERVERS_LOCK.release()
+    for server in servers:
+        server.Stop()
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
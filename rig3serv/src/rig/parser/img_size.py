@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Image dimensions read from the JPEG and PNG headers
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import struct
+import threading
+
+from rig import stats
+
+_PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+# JPEG start-of-frame markers, which give the image dimensions. C4, C8 and CC
+# are in the same range but are not frames.
+_JPEG_SOF = [ chr(m) for m in range(0xC0, 0xD0) if m not in (0xC4, 0xC8, 0xCC) ]
+# JPEG markers without any length or content
+_JPEG_STANDALONE = [ "\x01" ] + [ chr(m) for m in range(0xD0, 0xD9) ]
+
+# Don't look for the frame past this offset, which is way more than the
+# EXIF data of any camera.
+_JPEG_MAX_OFFSET = 1024 * 1024
+
+
+#------------------------
+def ReadImageSize(path):
+    """
+    Returns the (width, height) of a JPEG or PNG image, reading only the
+    headers of the file. Returns None if the file can't be read or is not
+    a JPEG or PNG image.
+    """
+    try:
+        f = file(path, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            header = f.read(24)
+            if header.startswith(_PNG_SIGNATURE):
+                if header[12:16] == "IHDR":
+                    return struct.unpack(">II", header[16:24])
+            elif header.startswith("\xFF\xD8"):
+                f.seek(2)
+                return _ReadJpegSize(f)
+        except (IOError, struct.error):
+            pass
+        return None
+    finally:
+        f.close()
+
+def _ReadJpegSize(f):
+    """
+    Reads the JPEG segments from the current position of the file up to
+    the first start-of-frame segment, skipping the content of the others.
+    """
+    while f.tell() < _JPEG_MAX_OFFSET:
+        if f.read(1) != "\xFF":
+            return None
+        marker = f.read(1)
+        while marker == "\xFF":
+            # fill bytes
+            marker = f.read(1)
+        if marker in _JPEG_STANDALONE:
+            continue
+        if not marker or marker == "\xD9" or marker == "\xDA":
+            # end of image or start of scan: there was no frame
+            return None
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker in _JPEG_SOF:
+            precision, height, width = struct.unpack(">BHH", f.read(5))
+            return width, height
+        f.seek(length - 2, 1)
+    return None
+
+def FitSize(dimensions, size):
+    """
+    Returns the (width, height) of an image of the given dimensions scaled
+    down so that its largest dimension is at most size, as rig does for the
+    rig_thumb_url images. Images are never scaled up.
+    """
+    width, height = dimensions
+    largest = max(width, height)
+    if largest <= 0 or size >= largest:
+        return width, height
+    return width * size / largest, height * size / largest
+
+
+#------------------------
+class AlbumSizes(object):
+    """
+    The dimensions of the images of one album directory.
+
+    Dimensions are memoized by the name, modification time and size of the
+    files, so an image is only read again when it changes. When a cache is
+    given, the table is loaded from it and Save() stores it back for the
+    next runs.
+
+    The "1.0 Img Size Read" and "1.0 Img Size Hit" stats count the images
+    read and avoided.
+    """
+    def __init__(self, cache, abs_dir):
+        self._cache = cache
+        self._abs_dir = abs_dir
+        self._key = [ "img_sizes", abs_dir ]
+        self._lock = threading.Lock()
+        self._modified = False
+        self._sizes = None
+        if cache is not None:
+            self._sizes = cache.Find(self._key)
+        if self._sizes is None:
+            self._sizes = {}   # leafname => ((mtime, size), (width, height) or None)
+
+    def Get(self, leafname):
+        """
+        Returns the (width, height) of the given image of the album, or None
+        if it's not a JPEG or PNG image.
+        """
+        path = os.path.join(self._abs_dir, leafname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_mtime, st.st_size)
+        self._lock.acquire()
+        try:
+            entry = self._sizes.get(leafname)
+        finally:
+            self._lock.release()
+        if entry is not None and entry[0] == stamp:
+            stats.Start("1.0 Img Size Hit").Stop()
+            return entry[1]
+
+        s = stats.Start("1.0 Img Size Read")
+        dimensions = ReadImageSize(path)
+        s.Stop()
+        self._lock.acquire()
+        try:
+            self._sizes[leafname] = (stamp, dimensions)
+            self._modified = True
+        finally:
+            self._lock.release()
+        return dimensions
+
+    def Save(self):
+        """
+        Stores the table in the cache if it changed.
+        """
+        self._lock.acquire()
+        try:
+            if self._modified and self._cache is not None:
+                self._cache.Store(self._sizes, self._key)
+            self._modified = False
+        finally:
+            self._lock.release()
+
+
+#------------------------
+_ALBUMS = {}   # abs_dir => AlbumSizes
+_ALBUMS_LOCK = threading.Lock()
+
+def Get(cache, abs_dir):
+    """
+    Returns the AlbumSizes of the given directory, shared by all the callers
+    for the rest of the run. The cache is only used the first time an album
+    is requested.
+    """
+    abs_dir = os.path.normpath(abs_dir)
+    _ALBUMS_LOCK.acquire()
+    try:
+        album = _ALBUMS.get(abs_dir)
+        if album is None:
+            album = _ALBUMS[abs_dir] = AlbumSizes(cache, abs_dir)
+        return album
+    finally:
+        _ALBUMS_LOCK.release()
+
+def SaveAll():
+    """
+    Saves the albums returned by Get() and forgets them.
+    """
+    _ALBUMS_LOCK.acquire()
+    try:
+        albums = _ALBUMS.values()
+        _ALBUMS.clear()
+    finally:
+        _ALBUMS_LOCK.release()
+    for album in albums:
+        album.Save()
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
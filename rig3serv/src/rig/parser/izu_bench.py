@@ -0,0 +1,487 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Izu parser benchmark with a synthetic corpus
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from time import time
+
+from rig import source_buffer
+from rig.parser import dir_parser
+from rig.parser import img_size
+from rig.parser.dir_parser import RelFile
+from rig.parser.izu_parser import IzuParser
+
+# Version of the results' format. Results of another version are not compared.
+RESULTS_VERSION = 1
+
+# IzuParser methods timed for the per stage results, in the order they are
+# applied. Compile and Render include the time of the stages they call.
+STAGES = [ "Compile",
+           "_ParseEscapeBlock",
+           "_ParseIzuTags",
+           "_FormatBoldItalicHtmlEmpty",
+           "_FormatSimpleTags",
+           "_FormatHtmlTags",
+           "_FormatTableTags",
+           "_FormatIzuImage",
+           "_FormatYoutube",
+           "_FormatCenter",
+           "_FormatLinks",
+           "_FormatLists",
+           "_RemoveEscapes",
+           "_ConvertAccents",
+           "_AppendDefaultLine",
+           "Render" ]
+
+# Patterns rendered by IzuBench.Scaling(), as (name, pattern, count): the
+# pattern is repeated count times then 4 times as much, which should take
+# about 4 times as long to render. Patterns without a newline make a single
+# long line of about 25 KB then 100 KB: unclosed tags, runs of special
+# characters, many tags or pasted HTML must not rescan the line for each tag.
+SCALING = [ ("lines", "Line of text with a <br> and a __bold__ word\n\n", 2500) ] + [
+            (repr(p), p, 25000 / len(p)) for p in [
+                "some text ",
+                '<a href="http://www.example.com/x.html">link</a> <div class="y">',
+                "[x ", "[[", "__x", "''x", "==x", "__",
+                "[izu:", "[izu:a:b]", "[izu:image:http://a.png]", "[s:", "[s:a]x",
+                "[!--", "[!--x--]", "[html:b]", "[table:begin][col][row][table:end]",
+                "[izu_image:http://", "[youtube:a:10x20]", "[c]",
+                "[a|http://x", "[http://x", "[a|http://x.png", "[a|riglink:",
+                "[a|rigimg:", "[rigimg:a|b", "[a|#s:", "http://", "http://a_b" ] ]
+
+# Largest ratio of the render times accepted by CheckScaling().
+MAX_SCALING = 8
+
+# Smallest speedup of the img_gen_workers accepted by CheckImgGen(), for
+# 4 workers.
+MIN_IMG_GEN_SPEEDUP = 2
+
+# A slow img_gen_script used by IzuBench.ImgGen(): it waits for the given
+# delay then returns the URL of the image.
+_IMG_GEN_SCRIPT = """#!%s
+import sys, time
+time.sleep(%f)
+sys.stdout.write("http://img/%%s?t=%%s" %% (sys.argv[3], sys.argv[6]))
+"""
+
+_WORDS = [ "the", "photos", "of", "a", "trip", "to", "mountain", "lake", "with",
+           "some", "friends", "and", "long", "walk", "under", "rain", "then",
+           "sun", "came", "back", "in", "afternoon", "we", "took", "pictures" ]
+
+_ACCENTS = [ "\xe9t\xe9", "caf\xe9", "na\xefve", "fa\xe7ade", "M\xe5nsson",
+             "\xe0 la", "cr\xe8me br\xfbl\xe9e", "\xc9cole", "gar\xe7on" ]
+
+_INLINE_TAGS = [ "__%(w)s__", "''%(w)s''", "==%(w)s==", "[%(w)s|http://www.example.com/%(n)d.html]",
+                 "[http://www.example.com/%(n)d.jpg]", "http://www.example.com/p/%(n)d",
+                 "[br] %(w)s", "[[%(w)s]", "[p] %(w)s", "____%(w)s" ]
+
+
+#------------------------
+def GenerateCorpus(num_lines=2000,
+                   tag_density=0.3,
+                   accent_density=0.1,
+                   table_density=0.02,
+                   rigimg_density=0.05,
+                   escape_density=0.02,
+                   seed=0):
+    """
+    Generates a synthetic Izu document of about num_lines lines.
+
+    The densities are the probability for a line to have inline formatting
+    tags and links, accents, or to start a table, a rig image or link, or
+    an escape block (comment or raw HTML). The same arguments always
+    generate the same document.
+
+    Returns a tuple (text, image names): the ISO-8859-1 text and the leaf
+    names of the images used by the rigimg and riglink tags.
+    """
+    rnd = random.Random(seed)
+    images = []
+    lines = [ "[izu:title:Benchmark]",
+              "[izu:cat:bench perf]",
+              "[izu:date:2009-01-01]" ]
+    while len(lines) < num_lines:
+        r = rnd.random()
+        if r < table_density:
+            lines.append("[table:begin:100%%:%dpx]" % rnd.randint(50, 300))
+            for i in xrange(rnd.randint(1, 4)):
+                lines.append(_Words(rnd, 6))
+                lines.append(rnd.choice([ "[col:50%]", "[row]", "[col]" ]))
+            lines.append(_Words(rnd, 6))
+            lines.append("[table:end]")
+            continue
+        r -= table_density
+        if r < escape_density:
+            if rnd.random() < 0.5:
+                lines.append("%s [!-- %s --] %s" % (_Words(rnd, 4), _Words(rnd, 6), _Words(rnd, 4)))
+            else:
+                lines.append("[!html:<pre>")
+                for i in xrange(rnd.randint(1, 5)):
+                    lines.append("  <b>%s</b> [not:a:tag]" % _Words(rnd, 5))
+                lines.append("</pre>--]")
+            continue
+
+        line = _Words(rnd, 12)
+        if rnd.random() < 0.1:
+            line = "* " + line
+        if rnd.random() < tag_density:
+            for i in xrange(rnd.randint(1, 3)):
+                tag = rnd.choice(_INLINE_TAGS) % { "w": _Words(rnd, 2), "n": rnd.randint(0, 999) }
+                line = _Insert(rnd, line, tag)
+        if rnd.random() < accent_density:
+            line = _Insert(rnd, line, rnd.choice(_ACCENTS))
+        if rnd.random() < rigimg_density:
+            name = "IMG_%04d.jpg" % len(images)
+            images.append(name)
+            if rnd.random() < 0.2:
+                tag = "[%s|riglink:IMG_%04d.*]" % (_Words(rnd, 2), len(images) - 1)
+            else:
+                tag = "[%s|rigimg:%d:%s|%s]" % (_Words(rnd, 2), rnd.choice([ 128, 256, 512 ]),
+                                                name, _Words(rnd, 3))
+            line = _Insert(rnd, line, tag)
+        lines.append(line)
+        if rnd.random() < 0.15:
+            lines.append("")
+    return "\n".join(lines) + "\n", images
+
+def _Words(rnd, n):
+    return " ".join([ rnd.choice(_WORDS) for i in xrange(rnd.randint(1, n)) ])
+
+def _Insert(rnd, line, text):
+    """
+    Inserts text between two words of the line.
+    """
+    words = line.split(" ")
+    i = rnd.randint(1, len(words))
+    return " ".join(words[:i] + [ text ] + words[i:])
+
+
+#------------------------
+class IzuBench(object):
+    """
+    Measures the throughput of IzuParser on a corpus.
+
+    The corpus is written with its images in a temporary directory so that
+    the rigimg and riglink tags find them. Run() renders it with
+    RenderStringToHtml and RenderFileToHtml the given number of times and
+    keeps the best time of each, then renders it once more with the STAGES
+    methods of the parser timed. Stage times include the cost of timing
+    them, so they are only comparable with other stage times.
+
+    The results are a dictionary which can be saved as JSON and compared
+    with the ones of a later run, see Compare().
+    """
+    def __init__(self, log, corpus, images, settings=None, repeat=3,
+                 rig_base="http://example.com/photos/"):
+        self._log = log
+        self._corpus = corpus
+        self._images = images
+        self._settings = settings or {}
+        self._repeat = max(1, repeat)
+        self._rig_base = rig_base
+
+    def Run(self):
+        """
+        Runs the benchmark and returns the results.
+        """
+        tempdir = tempfile.mkdtemp(prefix="rig3_izu_bench_")
+        try:
+            for name in self._images:
+                f = file(os.path.join(tempdir, name), "wb")
+                f.close()
+            rel_file = RelFile(tempdir, "index.izu")
+            f = file(rel_file.abs_path, "wb")
+            f.write(self._corpus)
+            f.close()
+
+            results = { "version": RESULTS_VERSION,
+                        "corpus": dict(self._settings,
+                                       lines=self._corpus.count("\n"),
+                                       bytes=len(self._corpus),
+                                       images=len(self._images)),
+                        "renders": {},
+                        "stages": {} }
+
+            parser = self._Parser()
+            results["renders"]["RenderStringToHtml"] = self._Best(
+                lambda: parser.RenderStringToHtml(self._corpus, rel_file=rel_file))
+
+            def _render_file():
+                source_buffer.Clear()
+                parser.RenderFileToHtml(rel_file)
+            results["renders"]["RenderFileToHtml"] = self._Best(_render_file)
+
+            results["stages"] = self._TimeStages(rel_file)
+            return results
+        finally:
+            source_buffer.Clear()
+            dir_parser.ClearListings()
+            img_size.SaveAll()
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    def Scaling(self, cases=SCALING):
+        """
+        Renders the SCALING patterns at 2 sizes and returns a dict
+        { name: { "count", "small", "large", "ratio" } } with the best render
+        time of each size and their ratio. See CheckScaling().
+
+        Times under 5 ms are rounded up to 5 ms for the ratio.
+        """
+        parser = self._Parser()
+        scaling = {}
+        for name, pattern, count in cases:
+            times = []
+            for n in (count, 4 * count):
+                text = pattern * n
+                best = None
+                for i in xrange(self._repeat):
+                    start = time()
+                    parser.RenderStringToHtml(text)
+                    t = time() - start
+                    if best is None or t < best:
+                        best = t
+                times.append(best)
+            scaling[name] = { "count": count,
+                              "small": times[0],
+                              "large": times[1],
+                              "ratio": times[1] / max(times[0], 0.005) }
+        return scaling
+
+    def ImgGen(self, num_images=16, delay=0.1, workers=(1, 4)):
+        """
+        Renders an album of num_images rig images with a mocked img_gen_script
+        which takes delay seconds per image, once for each number of workers.
+
+        Returns a dict { "images", "delay", "seconds": { workers: seconds },
+        "speedup" } where speedup is the ratio of the time of the first and
+        last number of workers. See CheckImgGen().
+        """
+        tempdir = tempfile.mkdtemp(prefix="rig3_izu_bench_")
+        try:
+            script = os.path.join(tempdir, "img_gen.py")
+            f = file(script, "w")
+            f.write(_IMG_GEN_SCRIPT % (sys.executable, delay))
+            f.close()
+            os.chmod(script, 0755)
+            text = ""
+            for i in xrange(num_images):
+                name = "IMG_%04d.jpg" % i
+                f = file(os.path.join(tempdir, name), "wb")
+                f.close()
+                text += "[Image %d|rigimg:%s]\n" % (i, name)
+            rel_file = RelFile(tempdir, "index.izu")
+
+            seconds = {}
+            for n in workers:
+                parser = IzuParser(self._log, self._rig_base, script, img_gen_workers=n)
+                start = time()
+                parser.RenderStringToHtml(text, rel_file=rel_file)
+                seconds[str(n)] = time() - start
+            return { "images": num_images,
+                     "delay": delay,
+                     "seconds": seconds,
+                     "speedup": seconds[str(workers[0])] / max(seconds[str(workers[-1])], 1e-6) }
+        finally:
+            dir_parser.ClearListings()
+            img_size.SaveAll()
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    def _Parser(self):
+        return IzuParser(self._log, self._rig_base, img_gen_script="")
+
+    def _Best(self, run_lambda):
+        """
+        Returns the throughput of the fastest of the runs of run_lambda.
+        """
+        best = None
+        for i in xrange(self._repeat):
+            start = time()
+            run_lambda()
+            t = time() - start
+            if best is None or t < best:
+                best = t
+        return _Throughput(self._corpus.count("\n"), len(self._corpus), best)
+
+    def _TimeStages(self, rel_file):
+        """
+        Renders the corpus once with the STAGES methods of a parser wrapped to
+        accumulate their time and the number and size of the lines they get.
+        """
+        parser = self._Parser()
+        counters = {}
+        for name in STAGES:
+            counters[name] = [ 0, 0, 0.0 ]  # calls, bytes, seconds
+            setattr(parser, name, self._Timed(getattr(parser, name), counters[name],
+                                              whole=name in ("Compile", "Render")))
+
+        parser.RenderStringToHtml(self._corpus, rel_file=rel_file)
+
+        stages = {}
+        for name, (calls, size, t) in counters.iteritems():
+            if calls:
+                stages[name] = _Throughput(calls, size, t)
+        return stages
+
+    def _Timed(self, method, counter, whole):
+        """
+        Wraps a parser method to time it. The line is the last argument of
+        the formatters, whereas Compile and Render process the whole corpus.
+        """
+        def _timed(*args):
+            if whole:
+                lines, size = self._corpus.count("\n"), len(self._corpus)
+            else:
+                lines, size = 1, len(args[-1])
+            start = time()
+            result = method(*args)
+            counter[2] += time() - start
+            counter[0] += lines
+            counter[1] += size
+            return result
+        return _timed
+
+
+#------------------------
+def _Throughput(lines, size, t):
+    t = max(t, 1e-6)
+    return { "lines": lines,
+             "bytes": size,
+             "seconds": t,
+             "lines_per_sec": lines / t,
+             "mb_per_sec": size / t / (1024 * 1024) }
+
+def Save(results, path):
+    f = file(path, "w")
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def Load(path):
+    f = file(path, "r")
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def SameCorpus(baseline, results):
+    """
+    Returns true if the results are comparable with the baseline, i.e. they
+    have the same format and were measured on the same synthetic corpus.
+    """
+    return (baseline.get("version") == results.get("version") and
+            baseline.get("corpus") == results.get("corpus"))
+
+def Compare(baseline, results, tolerance=0.1):
+    """
+    Compares the lines per second of the renders and stages of the results
+    with the ones of the baseline.
+
+    Returns the list of (name, baseline lines/sec, lines/sec) which are slower
+    than the baseline by more than the tolerance ratio, e.g. 0.1 for 10%.
+    Entries missing from one of the results are ignored.
+    """
+    slower = []
+    for group in [ "renders", "stages" ]:
+        names = results.get(group, {}).keys()
+        names.sort()
+        for name in names:
+            base = baseline.get(group, {}).get(name)
+            if base:
+                before = base["lines_per_sec"]
+                after = results[group][name]["lines_per_sec"]
+                if after < before * (1 - tolerance):
+                    slower.append((name, before, after))
+    return slower
+
+def CheckScaling(results, max_ratio=MAX_SCALING):
+    """
+    Returns the list of (name, ratio) of the scaling results which render
+    time grows more than max_ratio times for 4 times the content, i.e. not
+    linearly. Results without scaling return an empty list.
+    """
+    slower = []
+    scaling = results.get("scaling", {})
+    names = scaling.keys()
+    names.sort()
+    for name in names:
+        if scaling[name]["ratio"] > max_ratio:
+            slower.append((name, scaling[name]["ratio"]))
+    return slower
+
+def CheckImgGen(results, min_speedup=MIN_IMG_GEN_SPEEDUP):
+    """
+    Returns [ ("img_gen", speedup) ] when the img_gen results are less than
+    min_speedup times faster with the most workers, or an empty list.
+    Results without img_gen return an empty list.
+    """
+    img_gen = results.get("img_gen")
+    if img_gen and img_gen["speedup"] < min_speedup:
+        return [ ("img_gen", img_gen["speedup"]) ]
+    return []
+
+def Report(log, results, baseline=None):
+    """
+    Logs the throughput of the results, along with the change from the
+    baseline when there's one.
+    """
+    c = results["corpus"]
+    log.Info("Corpus: %d lines, %d bytes, %d images", c["lines"], c["bytes"], c["images"])
+    for group in [ "renders", "stages" ]:
+        entries = results[group]
+        names = group == "stages" and [ n for n in STAGES if n in entries ] or sorted(entries.keys())
+        for name in names:
+            r = entries[name]
+            change = ""
+            base = baseline and baseline.get(group, {}).get(name)
+            if base:
+                change = " (%+.1f%%)" % (100.0 * (r["lines_per_sec"] / base["lines_per_sec"] - 1))
+            log.Info("%-28s: %10.0f lines/s %8.2f MB/s in %7.3f s%s",
+                     name, r["lines_per_sec"], r["mb_per_sec"], r["seconds"], change)
+    scaling = results.get("scaling", {})
+    for name in sorted(scaling.keys()):
+        r = scaling[name]
+        log.Info("Scaling %-20s: %7.3f s for %d, %7.3f s for %d: x%.1f",
+                 name, r["small"], r["count"], r["large"], 4 * r["count"], r["ratio"])
+    img_gen = results.get("img_gen")
+    if img_gen:
+        for n in sorted(img_gen["seconds"].keys(), key=int):
+            log.Info("Img gen %d images of %.2f s, %2s workers: %7.3f s",
+                     img_gen["images"], img_gen["delay"], n, img_gen["seconds"][n])
+        log.Info("Img gen speedup: x%.1f", img_gen["speedup"])
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
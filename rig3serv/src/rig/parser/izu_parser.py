@@ -25,18 +25,29 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 __author__ = "ralfoide at gmail com"
 
-import codecs
+import copy
 import fnmatch
 import os
 import re
+import sha
 import subprocess
 import sys
 import urllib
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 
-from rig.parser.utf8_accents import UTF8_ACCENTS_TO_HTML
+from rig.parser import dir_parser
+from rig.parser import img_gen
+from rig.parser import img_size
 from rig.parser.dir_parser import RelPath, RelFile
+from rig import source_buffer
+from rig import stats
+from rig.spill_file import SpillWriter
+from rig.template.buffer import _WS, _EOL
+from rig.template.node import NodeList, NodeLiteral, NodeTag
+from rig.template.tag import ALL_TAGS
+from rig.template.template import Template
 
 _DATE_YMD = re.compile(r"^(?P<year>\d{4})[:/-]?(?P<month>\d{2})[:/-]?(?P<day>\d{2})"
                        r"(?:[ ,:/-]?(?P<hour>\d{2})[:/.-]?(?P<min>\d{2})(?:[:/.-]?(?P<sec>\d{2}))?)?")
@@ -45,6 +56,9 @@ _WS_LINE = re.compile(r"^[ \t\r\n\f]*$")
 
 _IZU_CAT_SEP = re.compile("[, \t\f]")
 
+# What str.strip() removes, which is less than unicode.strip()
+_WHITESPACE = " \t\n\r\f\v"
+
 _ACCENTS_TO_HTML = {
     "": "&aacute;",
     "": "&agrave;",
@@ -80,12 +94,313 @@ _ACCENTS_TO_HTML = {
     "": "&deg;",
 }
 
+# _ACCENTS_TO_HTML as lists of pairs for byte and unicode strings and as
+# regexps matching any of the accents.
+_ACCENTS_TO_HTML_ITEMS = _ACCENTS_TO_HTML.items()
+_UNICODE_ACCENTS_TO_HTML_ITEMS = [ (unicode(k, "iso-8859-1"), unicode(v))
+                                   for k, v in _ACCENTS_TO_HTML_ITEMS ]
+_RE_ACCENTS = re.compile("[%s]" % "".join(_ACCENTS_TO_HTML.iterkeys()))
+_RE_UNICODE_ACCENTS = re.compile(unicode(_RE_ACCENTS.pattern, "iso-8859-1"))
+
+_GLOB_SEGMENTS = {}  # glob segment => match method of its compiled regexp
+
+def _GlobSegmentMatch(segment):
+    """
+    Returns a function that matches a file name with a glob segment like
+    fnmatch.fnmatch, for file names already normalized by os.path.normcase.
+    """
+    match = _GLOB_SEGMENTS.get(segment)
+    if match is None:
+        regexp = re.compile(fnmatch.translate(os.path.normcase(segment)))
+        match = _GLOB_SEGMENTS[segment] = regexp.match
+    return match
+
+_CODE_DIGEST = []
+
+def CodeDigest():
+    """
+    Returns a hex digest of the source code of the modules which results
+    are kept in the cache of the parser: the compiled IzuDocuments, the
+    img_gen_script replies and the image sizes. Any change to the code of
+    these modules changes the digest, see SiteDefault._IzuCacheDir.
+    """
+    if not _CODE_DIGEST:
+        md = sha.new()
+        for module in [ sys.modules[__name__], img_gen, img_size, source_buffer ]:
+            path = module.__file__
+            if path[-4:] in (".pyc", ".pyo") and os.path.exists(path[:-1]):
+                path = path[:-1]
+            f = file(path, "rb")
+            try:
+                md.update(f.read())
+            finally:
+                f.close()
+        _CODE_DIGEST.append(md.hexdigest())
+    return _CODE_DIGEST[0]
+
+def _Latin1(text):
+    """
+    Returns a unicode string of the unicode text pipeline as the ISO-8859-1
+    string the default pipeline would use. Other values are returned as-is.
+    """
+    if isinstance(text, unicode):
+        # Lines were read with source_buffer.XmlCharRefs so this can't fail
+        text = text.encode("iso-8859-1")
+    return text
+
+# Izumi post links are rendered as links to a placeholder URL, which the site
+# replaces once all its posts are known. The category and title are quoted so
+# that the rest of the formatting leaves them alone.
+RE_POST_LINK = re.compile(r'<a href="izu-post:([^:"]*):([0-9]{8}):([^:"]*)">(.*?)</a>')
+
+def _QuotePostLink(text):
+    return urllib.quote(_Latin1(text or ""), safe="").replace("_", "%5F")
+
+def PostLinkTarget(category, date, title):
+    """
+    Returns the (category, date, title) targeted by a post link, given the
+    first 3 groups matched by RE_POST_LINK. The date is a YYYYMMDD string.
+    The category and the title are None when the link does not give them.
+    """
+    category = urllib.unquote(str(category)) or None
+    title = urllib.unquote(str(title)) or None
+    return category, str(date), title
+
+# The template tags generated by the parser, e.g. for rig images, are written
+# as _Tag("raw rig_img_url ...") rather than as "[[[raw rig_img_url ...]]" so
+# that they are known once rendered: the sections then get them either as
+# template text, see _TagsToText(), or as template nodes without parsing them
+# again, see _TagsToNodes().
+_TAG_OPEN = "\x02"
+_TAG_CLOSE = "\x03"
+_RE_TAG = re.compile("\x02([^\x03]*)\x03")
+_TEMPLATE_TAGS = dict([ (tag.Tag(), tag) for tag in [ t() for t in ALL_TAGS ] ])
+
+def _Tag(text):
+    """
+    Returns the given template tag, e.g. "if rig_base", as generated by the
+    parser.
+    """
+    return _TAG_OPEN + text + _TAG_CLOSE
+
+def _TagsToText(text):
+    """
+    Returns the text with its generated tags written as template tags.
+    """
+    if _TAG_OPEN in text:
+        text = _RE_TAG.sub(r"[[\1]]", text)
+    return text
+
+def _TagsToNodes(log, text):
+    """
+    Returns the NodeList of the template made of the text and its generated
+    tags, which is the NodeList Template(source=_TagsToText(text)) parses.
+
+    The text between the generated tags becomes literal nodes, as long as it
+    has no template tag written by the user, e.g. "[[[raw foo]]", and no line
+    separator the template parser would convert. Otherwise the text is parsed
+    as a template.
+    """
+    pieces = _RE_TAG.split(text)
+    literals = pieces[0::2]
+    for literal in literals:
+        if ("[[" in literal or "\r" in literal or
+                (os.linesep != "\n" and "\n" in literal)):
+            return Template(log, source=_TagsToText(text)).Nodes()
+    nodes = NodeList()
+    stack = [ nodes ]
+    for i in xrange(len(pieces)):
+        piece = pieces[i]
+        if i % 2 == 0:
+            if piece:
+                stack[-1].Append(NodeLiteral(piece))
+            continue
+        words = piece.strip(_WS + _EOL).split(None, 1)
+        keyword = words and words[0].lower() or ""
+        if keyword == "end" and len(stack) > 1:
+            stack.pop()
+        elif keyword in _TEMPLATE_TAGS and keyword != "end":
+            tag = _TEMPLATE_TAGS[keyword]
+            parameters = len(words) > 1 and words[1].strip(_WS + _EOL) or ""
+            content = tag.HasContent() and NodeList() or None
+            stack[-1].Append(NodeTag(tag, parameters, content))
+            if content is not None:
+                stack.append(content)
+        else:
+            # Let the template parser report the error
+            return Template(log, source=_TagsToText(text)).Nodes()
+    if len(stack) > 1:
+        return Template(log, source=_TagsToText(text)).Nodes()
+    return nodes
+
+
+#------------------------
+class IzuDocument(object):
+    """
+    A compiled Izu document, as returned by IzuParser.Compile().
+
+    - tags: dict of izumi header tags.
+    - ops: list of (section name, kind, payload) to render the document,
+      in order. Kind is one of:
+      - "line": payload is a line already formatted by the default section
+        formatter, which only needs to be appended to the section.
+      - "raw": payload is a line that must be formatted when rendering,
+        using the section's formatter. This is used for the lines that
+        depend on the file system or the parser settings, such as rig
+        images and links, and for non-default sections.
+      - "append": payload is raw html to append as-is to the section.
+
+    Documents only depend on the text content and can be pickled.
+    """
+    def __init__(self, tags, ops):
+        self.tags = tags
+        self.ops = ops
+
+
+#------------------------
+class _SectionBuffer(object):
+    """
+    The HTML of a section being rendered, kept as a list of fragments which
+    are only joined once by Text(). The last characters are tracked as
+    fragments are appended so that EndsWith() does not need the whole text.
+
+    When a spill directory is given, fragments are written to a spill file
+    as soon as they reach spill_size bytes and Close() returns a SpillFile
+    instead of a string.
+    """
+    _TAIL_SIZE = 8
+
+    def __init__(self, text="", spill_dir=None, spill_size=0):
+        self._fragments = []
+        self._tail = ""
+        self._size = 0
+        self._spill_dir = spill_dir
+        self._spill_size = spill_size
+        self._writer = None
+        self.Append(text)
+
+    def __nonzero__(self):
+        return self._writer is not None or len(self._fragments) > 0
+
+    def Append(self, content):
+        if content:
+            if self._writer:
+                self._writer.Write(_TagsToText(content))
+            else:
+                self._fragments.append(content)
+                self._size += len(content)
+                if self._spill_dir and self._size >= self._spill_size:
+                    self._Spill()
+            if len(content) >= self._TAIL_SIZE:
+                self._tail = content[-self._TAIL_SIZE:]
+            else:
+                self._tail = (self._tail + content)[-self._TAIL_SIZE:]
+
+    def EndsWith(self, word):
+        """
+        Returns true if the text ends with word, which must not be longer
+        than _TAIL_SIZE.
+        """
+        return self._tail.endswith(word)
+
+    def Text(self):
+        """
+        Returns the text of a buffer which has not been spilled.
+        """
+        if len(self._fragments) > 1:
+            self._fragments = [ "".join(self._fragments) ]
+        return self._fragments and self._fragments[0] or ""
+
+    def Close(self):
+        """
+        Returns the text wrapped in the appropriate span or an empty string
+        if there's no text. Returns a SpillFile if the text was spilled.
+        """
+        if self._writer:
+            self._writer.Write("</span>")
+            return self._writer.Close(store=False)
+        text = self.Text()
+        if text:
+            text = '<span class="izu">%s</span>' % text
+        return text
+
+    def _Spill(self):
+        self._writer = SpillWriter(self._spill_dir)
+        self._writer.Write('<span class="izu">')
+        for f in self._fragments:
+            self._writer.Write(_TagsToText(f))
+        self._fragments = []
+
+
+#------------------------
+class _ImgGenBatch(object):
+    """
+    The img_gen_script requests of a document.
+
+    The batch first collects the requests, then runs them all using a pool
+    of worker threads and keeps their results, indexed by request, for the
+    actual rendering of the document.
+    """
+    def __init__(self):
+        self._requests = []
+        self._results = None
+
+    def IsCollecting(self):
+        return self._results is None
+
+    def Add(self, env):
+        self._requests.append(env)
+
+    def Run(self, run_lambda, num_workers):
+        """
+        Calls run_lambda(env) once for each distinct request, using up to
+        num_workers concurrent threads.
+        """
+        keys = []
+        envs = {}
+        for env in self._requests:
+            key = self._Key(env)
+            if not key in envs:
+                keys.append(key)
+                envs[key] = env
+        self._requests = []
+        self._results = {}
+        num_workers = min(num_workers, len(keys))
+        if num_workers < 1:
+            return
+        s = stats.Start("1.2 Img Gen Batch")
+        pool = ThreadPool(num_workers)
+        try:
+            # map() returns the results in the order of keys
+            results = pool.map(lambda key: run_lambda(envs[key]), keys)
+        finally:
+            pool.close()
+            pool.join()
+            s.Stop()
+        self._results = dict(zip(keys, results))
+
+    def Result(self, env):
+        """
+        Returns the (ret, output) of the request or None if it was not run.
+        """
+        return self._results.get(self._Key(env))
+
+    def _Key(self, env):
+        return tuple(sorted(env.items()))
+
+
 #------------------------
 class _State(object):
-    def __init__(self, _file, filename, rel_file):
+    def __init__(self, _file, filename, rel_file, ops=None, spill_dir=None, spill_size=0,
+                 img_gen_batch=None, unicode_text=False):
         self._file = _file
+        self._unicode_text = unicode_text
         self._filename = filename
         self._rel_file= rel_file
+        self._ops = ops
+        self._spill_dir = spill_dir
+        self._spill_size = spill_size
+        self._img_gen_batch = img_gen_batch
         self._tags = {}
         self._sections = {}
         self._section_needs_paragraph = {}
@@ -101,6 +416,9 @@ class _State(object):
     def Tags(self):
         return self._tags
 
+    def ImgGenBatch(self):
+        return self._img_gen_batch
+
     def CurrSection(self):
         return self._curr_section
 
@@ -117,22 +435,36 @@ class _State(object):
     def CurrFormatter(self):
         return self._curr_formatter
 
-    def Section(self, section):
-        return self._sections.get(section, None)
-
     def InitSection(self, section, default):
-        self._sections[section] = self._sections.get(section, default)
+        """
+        Initializes a section with a default value if it does not exist yet.
+        String sections are accumulated in a _SectionBuffer, other defaults
+        (e.g. a list) are used as-is.
+        """
+        if not section in self._sections:
+            if isinstance(default, (str, unicode)):
+                default = _SectionBuffer(default, self._spill_dir, self._spill_size)
+            self._sections[section] = default
+
+    def HasContent(self, section):
+        return bool(self._sections[section])
 
     def Append(self, section, content):
-        try:
+        s = self._sections[section]
+        if isinstance(s, _SectionBuffer):
+            s.Append(content)
+        else:
             # lists support append()
-            self._sections[section].append(content)
-        except AttributeError:
-            # strings support +=
-            self._sections[section] += content
+            s.append(content)
 
     def EndsWith(self, section, word):
-        return self._sections[section].endswith(word)
+        return self._sections[section].EndsWith(word)
+
+    def Record(self, kind, payload):
+        """
+        Records an IzuDocument operation for the current section.
+        """
+        self._ops.append((self._curr_section, kind, payload))
 
     def EndOfFile(self):
         return self._file is None
@@ -143,12 +475,20 @@ class _State(object):
         if present.
 
         If the end of the file has been reached, returns None.
+
+        Lines are unicode for the unicode text pipeline, in which case
+        string lines are considered to be ISO-8859-1 already.
         """
         line = None
         if self._file:
             try:
                 line = self._file.readline()
-                if isinstance(line, unicode):
+                if self._unicode_text:
+                    if isinstance(line, unicode):
+                        line = source_buffer.XmlCharRefs(line)
+                    else:
+                        line = line.decode("iso-8859-1")
+                elif isinstance(line, unicode):
                     # Internally we only process ISO-8859-1 and replace
                     # unknown entities by their XML hexa encoding
                     line = line.encode("iso-8859-1", "xmlcharrefreplace")
@@ -171,8 +511,8 @@ class _State(object):
         """
         # Wrap existing non-empty HTML sessions in the appropriate div
         for k, v in self._sections.iteritems():
-            if v and isinstance(v, (str, unicode)):
-                self._sections[k] = '<span class="izu">%s</span>' % v
+            if isinstance(v, _SectionBuffer):
+                self._sections[k] = v.Close()
         return self._tags, self._sections
 
 
@@ -181,11 +521,60 @@ class IzuParser(object):
     """
     Izumi parser.
     This class is stateless.
+
+    Documents are first compiled to an IzuDocument, which only depends on
+    their content, then rendered to HTML. When a cache (rig.cache.Cache) is
+    given, compiled documents are kept in it indexed by the digest of their
+    content, so that changes to rig_base or img_gen_script only need to
+    render them again.
+
+    When a spill_dir is given, sections which HTML reaches spill_size bytes
+    are written to a temporary file of that directory while they are
+    rendered and returned as a rig.spill_file.SpillFile, which the caller
+    must remove once used.
+
+    When img_gen_server is true, the img_gen_script is started once and
+    shared by all the parsers, see img_gen.ImgGenServer. Its results are
+    then kept in the cache, if any.
+
+    Otherwise, when img_gen_workers is greater than 1, the img_gen_script
+    requests of a document are collected before rendering it and up to
+    img_gen_workers scripts are executed concurrently.
+
+    When img_dims is true, the dimensions of the rig images rendered without
+    img_gen_script are read from their headers for the rig_img_dims variable.
+    Otherwise the images are not read.
+
+    The sections are template text, which the caller generates with the
+    rig_base and rig_img_dims variables. When template_nodes is true, the
+    text sections are instead rig.template.node.NodeList, which the caller
+    generates with Template(nodes=...) without parsing them, and the images
+    section is a list of them.
+
+    When unicode_text is true, the content is processed as unicode instead
+    of ISO-8859-1 strings and the sections are unicode. The HTML is the same
+    once encoded: characters not in ISO-8859-1 are still replaced by their
+    XML character reference when read, and the tags are still ISO-8859-1
+    strings.
     """
-    def __init__(self, log, rig_base, img_gen_script):
+
+    # Bump this when the format or content of a compiled IzuDocument changes.
+    _IR_VERSION = 3
+
+    def __init__(self, log, rig_base, img_gen_script, cache=None, spill_dir=None, spill_size=0,
+                 img_gen_server=False, img_gen_workers=1, unicode_text=False, img_dims=False,
+                 template_nodes=False):
         self._log = log
+        self._template_nodes = template_nodes
+        self._unicode_text = unicode_text
+        self._img_dims = img_dims
         self._img_gen_script = img_gen_script
+        self._img_gen_server = img_gen_server
+        self._img_gen_workers = img_gen_workers
         self._rig_base = rig_base
+        self._cache = cache
+        self._spill_dir = spill_dir
+        self._spill_size = spill_size
 
         # custom section handlers. Unlisted sections use the "default" formatter
         self._escape_block = { "--"    : self._EscapeComment,
@@ -213,7 +602,7 @@ class IzuParser(object):
         - dict of izumi header tags (can be an empty list, but not None)
             - most are just srtings. The "cat" (categories) tag is a list of strings.
         - dict of sections.
-            - most are HTML content.
+            - most are HTML content, or a SpillFile when spilled.
             - the "images" section must be a list of RIG urls.
         """
         return self.__RenderContent(filestream, encoding)
@@ -231,39 +620,121 @@ class IzuParser(object):
         or "iso-8859-1", as supported by the codecs.open() method.
         """
         f = StringIO(source)
-        return self.__RenderContent(f, encoding, rel_file)
+        digest = None
+        if self._cache:
+            digest = sha.new(isinstance(source, unicode) and source.encode("utf-8") or source).hexdigest()
+        return self.__RenderContent(f, encoding, rel_file, digest)
 
-    def __RenderContent(self, filestream, encoding=None, rel_file=None):
-        f = None
+    def __RenderContent(self, filestream, encoding=None, rel_file=None, digest=None):
         result = None
         try:
             if isinstance(filestream, (str, unicode)):
-                # open with 1=line buffered, U=universal end-of-lines
-                f = codecs.open(filestream, mode="rU", buffering=1,
-                                encoding=encoding,
-                                errors="xmlcharrefreplace")
                 filename = filestream
                 rel_file = RelFile(os.path.dirname(filestream), os.path.basename(filestream))
             elif isinstance(filestream, RelPath):
                 filename = filestream.abs_path
                 rel_file = filestream
-                # open with 1=line buffered, U=universal end-of-lines
-                f = codecs.open(filename, mode="rU", buffering=1,
-                                encoding=encoding,
-                                errors="xmlcharrefreplace")
             else:
-                f = filestream
                 filename = "<internal stream>"
 
-            state = _State(f, filename, rel_file)
-            self._ParseStream(state)
-            result = state.Close()
+            if filename == "<internal stream>":
+                open_lambda = lambda: filestream
+            else:
+                buffer = source_buffer.Get(filename)
+                open_lambda = lambda: buffer.Open(encoding)
+                if self._cache:
+                    digest = buffer.Digest()
+
+            doc = self._CompileCached(open_lambda, filename, encoding, digest)
+            result = self.Render(doc, filename, rel_file)
         except IOError:
-            if f and f != filestream:
-                f.close()
             self._log.Exception("Read-error for %s" % filestream)
         return result
 
+    def _CompileCached(self, open_lambda, filename, encoding, digest):
+        """
+        Compiles the stream returned by open_lambda, or reuses the compiled
+        document from the cache when there's a cache and a content digest.
+        """
+        if not self._cache or not digest:
+            return self.Compile(open_lambda(), filename)
+        key = [ "izu_document",
+                self.__class__.__name__,
+                self._IR_VERSION,
+                encoding,
+                digest ]
+        if self._unicode_text:
+            key.append("unicode")
+        return self._cache.Compute(key,
+                                   lambda: self.Compile(open_lambda(), filename),
+                                   stat_prefix="1.1 Izu Compile")
+
+    def Compile(self, f, filename="<internal stream>"):
+        """
+        Parses the file-like object f and returns an IzuDocument.
+        The filename is only used for error messages.
+        """
+        ops = []
+        state = _State(f, filename, None, ops, unicode_text=self._unicode_text)
+        self._ParseStream(state)
+        return IzuDocument(state.Tags(), ops)
+
+    def Render(self, doc, filename, rel_file):
+        """
+        Renders an IzuDocument to HTML.
+
+        The filename and rel_file are the ones of the originating file, if
+        any. They are used to locate the rig images and links.
+
+        Returns a tuple (dict: tags, dict: sections), like RenderFileToHtml.
+        """
+        batch = None
+        if self._img_gen_script and not self._img_gen_server and self._img_gen_workers > 1:
+            batch = self._PrefetchImgGen(doc, filename, rel_file)
+        state = _State(None, filename, rel_file,
+                       spill_dir=self._spill_dir, spill_size=self._spill_size,
+                       img_gen_batch=batch)
+        state.Tags().update(copy.deepcopy(doc.tags))
+        for section, kind, payload in doc.ops:
+            formatter = self._formatters.get(section, self._DefaultSection)
+            state.SetCurrSection(section, formatter)
+            if kind == "line":
+                self._AppendDefaultLine(state, payload)
+            elif kind == "raw":
+                formatter(state, payload)
+            else:
+                state.InitSection(section, "")
+                state.Append(section, payload)
+        tags, sections = state.Close()
+        convert = self._template_nodes and (lambda t: _TagsToNodes(self._log, t)) or _TagsToText
+        for k, v in sections.iteritems():
+            if isinstance(v, (str, unicode)):
+                sections[k] = convert(v)
+            elif isinstance(v, list):
+                sections[k] = [ convert(i) for i in v ]
+        return tags, sections
+
+    def _PrefetchImgGen(self, doc, filename, rel_file):
+        """
+        Formats the lines of the document which have rig images on a scratch
+        state to collect their img_gen_script requests, then executes the
+        requests concurrently.
+
+        The requests do not depend on the state of the sections, so the
+        scratch state only gets the lines which may have rig images.
+
+        Returns an _ImgGenBatch with the results.
+        """
+        batch = _ImgGenBatch()
+        scratch = _State(None, filename, rel_file, img_gen_batch=batch)
+        for section, kind, payload in doc.ops:
+            if kind == "raw":
+                formatter = self._formatters.get(section, self._DefaultSection)
+                scratch.SetCurrSection(section, formatter)
+                formatter(scratch, payload)
+        batch.Run(self._RunGenScript, self._img_gen_workers)
+        return batch
+
     def ParseFirstLine(self, source):
         """
         Parses the *first* line of a *string* -- the string is actual content,
@@ -281,7 +752,7 @@ class IzuParser(object):
         tags, sections = self.RenderStringToHtml(source) #@UnusedVariable
         return tags
 
-    def ParseFileFirstLine(self, filename, encoding):
+    def ParseFileFirstLine(self, filename, encoding, keep=True):
         """
         Parses the *first* 2 lines of a *file*, using the given optional encoding.
 
@@ -291,24 +762,17 @@ class IzuParser(object):
 
         This is a wrapper to open the file, extract the first line and
         return the result of ParseFirstLine on it.
+
+        The file is read in its source buffer, which is kept for the next
+        reads. When keep is False and the file is not loaded yet, only its
+        first lines are read, e.g. when the rest of the file may not be
+        needed.
         """
-        f = None
-        try:
-            if isinstance(filename, RelPath):
-                filename = filename.abs_path
-            f = codecs.open(filename, mode="rU", buffering=1,
-                            encoding=encoding, errors="xmlcharrefreplace")
-            line = f.readline() + f.readline()
-            if isinstance(line, unicode):
-                # Internally we only process ISO-8859-1 and replace
-                # unknown entities by their XML hexa encoding
-                line = line.encode("iso-8859-1", "xmlcharrefreplace")
-            # strip \r\n from it
-            line = re.sub("[\r\n]", "", line)
-            return self.ParseFirstLine(line)
-        finally:
-            if f:
-                f.close()
+        if keep:
+            line = source_buffer.Get(filename).HeaderLine(encoding)
+        else:
+            line = source_buffer.HeaderLine(filename, encoding)
+        return self.ParseFirstLine(line)
 
     def _ParseStream(self, state):
         is_block = None
@@ -348,13 +812,10 @@ class IzuParser(object):
         """
         # First take care of the case of a block that opens and closes on the same line
         while line:
-            m = self._RE_PEB_BLOCK_SAME_LINE.match(line)
+            m = self._FindSameLineBlock(line)
             if not m:
                 break
-            start = m.group("start")
-            line  = m.group("end")
-            name  = m.group("name")
-            body  = m.group("body")
+            start, name, body, line = m
             if start:
                 self._ParseLine(state, start)
             if body:
@@ -393,10 +854,34 @@ class IzuParser(object):
 
         return is_block, line
 
-    _RE_PEB_BLOCK_SAME_LINE = re.compile(r"(?P<start>(?:^|.*?[^\[]))\[!(?P<name>--|html:)(?P<body>.*?)--\](?P<end>.*)$")
     _RE_PEB_BLOCK_CLOSE     = re.compile(r"(?P<body>.*?)--\](?P<line>.*)$")
     _RE_PEB_BLOCK_OPEN      = re.compile(r"(?P<start>.*?(?:^|[^\[]))\[!(?P<name>--|html:)(?P<body>.*)$")
 
+    def _FindSameLineBlock(self, line):
+        """
+        Finds the first [!-- ... --] or [!html: ... --] block which opens and
+        closes on the line. The block must not be escaped by a double-[.
+
+        Returns a tuple (start, name, body, end) or None.
+
+        This scans the line once: when the first block opened has no closing
+        "--]" after it, none of the following ones can have one either.
+        """
+        i = line.find("[!")
+        while i >= 0:
+            if i == 0 or line[i-1] != "[":
+                for name in self._ESCAPE_BLOCK_NAMES:
+                    if line.startswith(name, i + 2):
+                        j = i + 2 + len(name)
+                        k = line.find("--]", j)
+                        if k < 0:
+                            return None
+                        return line[:i], name, line[j:k], line[k+3:]
+            i = line.find("[!", i + 1)
+        return None
+
+    _ESCAPE_BLOCK_NAMES = ( "--", "html:" )
+
     def _EscapeComment(self, state, line):
         """
         Process an escaped line in an [!-- ... --] comment block.
@@ -415,9 +900,7 @@ class IzuParser(object):
         we need to re-inject one. This is necessary for some HTML tags such
         as <pre> which are line-sensitive.
         """
-        curr_section = state.CurrSection()
-        state.InitSection(curr_section, "")
-        state.Append(curr_section, line + "\n")
+        state.Record("append", line + "\n")
 
 
     # --- structural parsers
@@ -429,24 +912,44 @@ class IzuParser(object):
         - then splits into sections, formatting whatever is before the current section
         - finally formats whatever is left
         """
-        while line is not None:
-            line = self._ParseIzuTags(state, line)
+        # Tags are stripped from the whole line at once: what follows a section
+        # is a tail of the stripped line so it cannot contain any other tag.
+        line = self._ParseIzuTags(state, line)
+        loop = True
+        while loop:
             loop, line = self._ParseIzuSection(state, line)
-            if loop:
-                continue
-            # Process according to current formatter
-            state.CurrFormatter()(state, line)
-            return
+        # Process according to current formatter
+        self._CompileLine(state, line)
+
+    def _CompileLine(self, state, line):
+        """
+        Records how to render a line with the current section formatter.
+
+        Lines of default sections are formatted right away unless they
+        contain rig images or links, which depend on the file system and
+        the parser settings and are thus formatted at render time.
+        """
+        if (state.CurrFormatter() == self._DefaultSection and
+                not self._RE_DEFERRED.search(line)):
+            state.Record("line", self._FormatDefaultLine(state, line))
+        else:
+            state.Record("raw", line)
+
+    _RE_DEFERRED = re.compile(r"riglink:|rigimg")
 
     def _ParseIzuTags(self, state, line):
         """
         Handles [izu:tag:value]
+
+        A tag at the very beginning of the line is handled first, then the
+        others from the last one to the first one.
         """
+        pos = len(line)
         while line:
-            m = self._RE_PARSE_IZU_TAG.match(line)
+            m = self._FindLastTag(line, "[izu:", self._RE_PARSE_IZU_TAG, pos)
             if m:
-                start = m.group("start") or ""
-                end   = m.group("end") or ""
+                start = line[:m.start()]
+                end   = line[m.end():]
                 line = start + end
 
                 tag  = m.group("tag")
@@ -460,29 +963,35 @@ class IzuParser(object):
                     line = start + "[izu_%s:%s]" % (tag, value) + end
 
                 elif tag:
+                    tag = _Latin1(tag)
+                    value = _Latin1(value)
                     self._tag_handlers.get(tag, self._DefaultTagHandler)(state, tag, value)
                 else:
                     # log an error and ignore
                     self._log.Error("Invalid tag %s:%s in %s", tag, value, state.Filename())
+
+                # Any other tag starts before this one, possibly straddling
+                # it, except if this tag was at the beginning of the line.
+                pos = start and len(start) + 4 or len(line)
             else:
                 break
         return line
 
-    _RE_PARSE_IZU_TAG = re.compile(r"(?P<start>(?:^|.*[^\[]))\[izu:(?P<tag>[^:\]]+):(?P<value>[^\]]*)\](?P<end>.*)$")
+    _RE_PARSE_IZU_TAG = re.compile(r"\[izu:(?P<tag>[^:\]]+):(?P<value>[^\]]*)\]")
 
     def _ParseIzuSection(self, state, line):
         """
         Handles [s:section_name], allowing multiple per line.
         """
         # section. Supports multile [s:section_name] per line.
-        m = self._RE_PARSE_IZU_SECTION.match(line)
+        m = self._FindLastTag(line, "[s:", self._RE_PARSE_IZU_SECTION, len(line))
         if m:
-            start = m.group("start")
-            line  = m.group("end")
-            name  = m.group("name")
+            start = line[:m.start()]
+            line  = line[m.end():]
+            name  = _Latin1(m.group("name"))
 
             if start:
-                state.CurrFormatter()(state, start)
+                self._CompileLine(state, start)
 
             if name:
                 state.SetCurrSection(name,
@@ -493,7 +1002,31 @@ class IzuParser(object):
                 self._log.Error("Invalid section name in %s", state.Filename())
         return False, line  # don't loop
 
-    _RE_PARSE_IZU_SECTION = re.compile(r"(?P<start>(?:^|.*[^\[]))\[s:(?P<name>[^\]:]+)\](?P<end>.*)$")
+    _RE_PARSE_IZU_SECTION = re.compile(r"\[s:(?P<name>[^\]:]+)\]")
+
+    def _FindLastTag(self, line, prefix, regexp, pos):
+        """
+        Finds a tag starting with the given prefix and matching the regexp:
+        either the tag at the very beginning of the line or, if there's none,
+        the last one starting before pos which is not escaped by a double-[.
+
+        Returns a match object or None.
+
+        Candidates are located with rfind and only those followed by a closing
+        bracket are matched, so a long line is never backtracked over.
+        """
+        if line.startswith(prefix):
+            m = regexp.match(line)
+            if m:
+                return m
+        pos = min(pos, line.rfind("]"))
+        while pos > 0:
+            pos = line.rfind(prefix, 1, pos)
+            if pos > 0 and line[pos-1] != "[":
+                m = regexp.match(line, pos)
+                if m:
+                    return m
+        return None
 
 
     # --- section formatters
@@ -503,9 +1036,13 @@ class IzuParser(object):
         """
         Default formatter for Izu section.
         """
-        curr_section = state.CurrSection()
-        state.InitSection(curr_section, "")
+        self._AppendDefaultLine(state, self._FormatDefaultLine(state, line))
 
+    def _FormatDefaultLine(self, state, line):
+        """
+        Formats a line of a default Izu section.
+        Returns the formatted line.
+        """
         # --- formatting tags
         line = self._FormatBoldItalicHtmlEmpty(line)
         line = self._FormatSimpleTags(state, line)
@@ -520,13 +1057,21 @@ class IzuParser(object):
         # --- cleanup
         line = self._RemoveEscapes(line)
         line = self._ConvertAccents(line)
+        return line
+
+    def _AppendDefaultLine(self, state, line):
+        """
+        Appends a line formatted by _FormatDefaultLine to the current section.
+        """
+        curr_section = state.CurrSection()
+        state.InitSection(curr_section, "")
 
         # --- append to buffer
         # empty lines or line solely made of whitespace are to be treated as
         # paragraphs (<p>) and merged togethers *iif* we'll have content later
         # that is inline and we *already* had content.
         if _WS_LINE.match(line):
-            state.SetSectionNeedsParagraph(curr_section, state.Section(curr_section))
+            state.SetSectionNeedsParagraph(curr_section, state.HasContent(curr_section))
             return
 
         # don't append <br> to <br> or <p> to <p>
@@ -556,7 +1101,7 @@ class IzuParser(object):
 
         if (not line.startswith("</") and
                 not line.startswith("\n") and
-                not state.Section(curr_section).endswith("\n")):
+                not state.EndsWith(curr_section, "\n")):
             state.Append(curr_section, "\n")
 
         # finally append the line to the section
@@ -573,44 +1118,37 @@ class IzuParser(object):
         # it is valid. We define an URL context is as being a non-special chars
         # string that contains :// somewhere before the underline, unfortunately
         # we can't use a non-capturing look-behind expression (?<!...) with a
-        # variable width, so instead we'll use a capturing group and filter
-        # using a lambda.
+        # variable width, so instead we'll match the URL context as a whole
+        # and keep it as-is using a lambda. Any :// within the URL context ends
+        # at the same place, so it doesn't need to be scanned again.
         line = self._RE_RMV_ESC_DOUBLE_UNDER.sub(
-                     lambda m: not m.group(1) and m.group(3) or m.group(0), line)
+                     lambda m: m.group(1) or m.group(0), line)
 
         return line
 
     _RE_RMV_ESC_DOUBLE_CHAR = re.compile(r"(['=\[])(\1+)")
-    _RE_RMV_ESC_DOUBLE_UNDER = re.compile(r"(://(?:[^ \"\[\]_]|_[^_])*)?(_)(\2+)")
+    _RE_RMV_ESC_DOUBLE_UNDER = re.compile(r"://(?:[^ \"\[\]_]|_[^_])*(?:__+)?|_(_+)")
 
     def _ConvertAccents(self, line):
         """
         Converts accents to HTML encoding entities.
         Returns the formatted line.
-        """
-        is_unicode = isinstance(line, unicode)
-        for k, v in _ACCENTS_TO_HTML.iteritems():
-            if is_unicode:
-                # If line is of type unicode, k cannot be str, it must
-                # be converted to unicode using the encoding of _ACCENTS_TO_HTML
-                # otherwise the "k in line" will fail with a type error.
-                k = unicode(k, "iso-8859-1")
-            if k in line:
-                line = line.replace(k, v)
-
-        try:
-            if is_unicode:
-                us = line
-            else:
-                us = unicode(line, "utf-8")
-
-            for k, v in UTF8_ACCENTS_TO_HTML.iteritems():
-                if k in us:
-                    us = us.replace(k, v)
-            line = us
-        except Exception:
-            pass
 
+        Lines without any accent, such as ASCII-only lines, are returned
+        as-is after a single regexp search. Other lines are converted with
+        the replace() of each accent, which is faster than a regexp
+        substitution or unicode.translate() in that case.
+        """
+        if isinstance(line, unicode):
+            regexp = _RE_UNICODE_ACCENTS
+            items = _UNICODE_ACCENTS_TO_HTML_ITEMS
+        else:
+            regexp = _RE_ACCENTS
+            items = _ACCENTS_TO_HTML_ITEMS
+        if regexp.search(line):
+            for k, v in items:
+                if k in line:
+                    line = line.replace(k, v)
         return line
 
     def _FormatBoldItalicHtmlEmpty(self, line):
@@ -664,18 +1202,11 @@ class IzuParser(object):
 
         This replaces all the occurrences of any [html:foo] in the line.
         """
-        m = True
-        while m:
-            m = self._RE_TAG_HTML.match(line)
-            if m:
-                before = m.group("before") or ""
-                tag    = m.group("tag") or ""
-                after  = m.group("after")  or ""
-                line = "%s<%s>%s" % (before, tag, after)
-
+        if "[html:" in line:
+            line = self._RE_TAG_HTML.sub(r"<\g<tag>>", line)
         return line
 
-    _RE_TAG_HTML = re.compile(r"(?P<before>.*?)(?<!\[)\[html:(?P<tag>/?[a-z]+)\](?P<after>.*)")
+    _RE_TAG_HTML = re.compile(r"(?<!\[)\[html:(?P<tag>/?[a-z]+)\]")
 
     def _FormatCenter(self, state, line):
         """
@@ -706,26 +1237,24 @@ class IzuParser(object):
         Formats any [youtube:ID:t=time:SXxSY] tag.
         The "t=time" and ":SXxSY" parts are optional.
         """
-        m = True
-        while m:
-            m = self._RE_TAG_YOUTUBE.match(line)
-            if m:
-                before = m.group("before") or ""
-                id     = m.group("id") or ""
-                sx     = m.group("sx") or "youtube_sx"
-                sy     = m.group("sy") or "youtube_sy"
-                t      = m.group("t")  or ""
-                after  = m.group("after")  or ""
+        if "[youtube:" in line:
+            line = self._RE_TAG_YOUTUBE.sub(self._ReplYoutube, line)
+        return line
 
-                url_extra = t and ("&t=%s" % t) or ""
-                cmd = '[[[raw youtube_html %% { "id": "%s", "sx": %s, "sy": %s, "url_extra": "%s" } ]]' \
-                        % (id, sx, sy, url_extra)
+    def _ReplYoutube(self, m):
+        """
+        Returns the replacement string for a [youtube:...] tag match.
+        """
+        id     = m.group("id") or ""
+        sx     = m.group("sx") or "youtube_sx"
+        sy     = m.group("sy") or "youtube_sy"
+        t      = m.group("t")  or ""
 
-                line = "%s%s%s" % (before, cmd, after)
+        url_extra = t and ("&t=%s" % t) or ""
+        return _Tag('raw youtube_html %% { "id": "%s", "sx": %s, "sy": %s, "url_extra": "%s" } '
+                    % (id, sx, sy, url_extra))
 
-        return line
-
-    _RE_TAG_YOUTUBE = re.compile(r"(?P<before>.*?)(?<!\[)\[youtube:(?P<id>[^:\"\'\<\>\]]+)(?::t=(?P<t>[0-9]+))?(?::(?P<sx>[0-9]+)x(?P<sy>[0-9]+))?\](?P<after>.*)")
+    _RE_TAG_YOUTUBE = re.compile(r"(?<!\[)\[youtube:(?P<id>[^:\"\'\<\>\]]+)(?::t=(?P<t>[0-9]+))?(?::(?P<sx>[0-9]+)x(?P<sy>[0-9]+))?\]")
 
     def _FormatTableTags(self, state, line):
         """
@@ -748,41 +1277,30 @@ class IzuParser(object):
                                  ( self._RE_TAG_TABLE_END,
                                    "</td></tr></table>" )
                                  ]:
-            m = True
-            while m:
-                m = regexp.match(line)
-                if m:
-                    before = m.group("before") or ""
-                    after  = m.group("after")  or ""
-
-                    try:
-                        # first width (table with for begin, column width for row/col)
-                        w1 = m.group("w1") or ""
-                        if w1:
-                            w1 = " width=\"" + w1 + "\""
-
-                        # second width (column width for begin, none for the others)
-                        try:
-                            w2 = m.group("w2") or ""
-                            if w2:
-                                w2 = " width=\"" + w2 + "\""
-                            replace = replace % ( w1, w2 )
-                        except IndexError:
-                            # no w2 argument
-                            replace = replace % ( w1 )
-                    except IndexError:
-                        pass # no w1 argument
-
-                    line = "%s%s%s" % (before, replace, after)
-
-
+            line = regexp.sub(lambda m: self._ReplTableTag(m, replace), line)
 
         return line
 
-    _RE_TAG_TABLE_BEGIN = re.compile(r"(?P<before>.*?)(?<!\[)\[table:begin(?::(?P<w1>[0-9]+(?:%|px))(?::(?P<w2>[0-9]+(?:%|px)))?)?\](?P<after>.*)")
-    _RE_TAG_TABLE_COL   = re.compile(r"(?P<before>.*?)(?<!\[)\[col(?::(?P<w1>[0-9]+(?:%|px)))?\](?P<after>.*)")
-    _RE_TAG_TABLE_ROW   = re.compile(r"(?P<before>.*?)(?<!\[)\[row(?::(?P<w1>[0-9]+(?:%|px)))?\](?P<after>.*)")
-    _RE_TAG_TABLE_END   = re.compile(r"(?P<before>.*?)(?<!\[)\[table:end\](?P<after>.*)")
+    def _ReplTableTag(self, m, replace):
+        """
+        Returns the replacement string for a table tag match.
+        The replace pattern gets the optional widths of the tag: the first
+        one (table width for begin, column width for row/col) and the second
+        one (column width for begin, none for the others).
+        """
+        widths = []
+        for name in [ "w1", "w2" ]:
+            if name in m.re.groupindex:
+                w = m.group(name) or ""
+                if w:
+                    w = " width=\"" + w + "\""
+                widths.append(w)
+        return replace % tuple(widths)
+
+    _RE_TAG_TABLE_BEGIN = re.compile(r"(?<!\[)\[table:begin(?::(?P<w1>[0-9]+(?:%|px))(?::(?P<w2>[0-9]+(?:%|px)))?)?\]")
+    _RE_TAG_TABLE_COL   = re.compile(r"(?<!\[)\[col(?::(?P<w1>[0-9]+(?:%|px)))?\]")
+    _RE_TAG_TABLE_ROW   = re.compile(r"(?<!\[)\[row(?::(?P<w1>[0-9]+(?:%|px)))?\]")
+    _RE_TAG_TABLE_END   = re.compile(r"(?<!\[)\[table:end\]")
 
     def _FormatIzuImage(self, state, line):
         """
@@ -791,39 +1309,59 @@ class IzuParser(object):
         If label is defined, it is used for <img title>.
         If url_link is defined, it is used to wrap the img using an <a href>.
         Url_link must start with http. The link cannot contain " : or < >
+
+        Candidates are located by the head of the tag. When a candidate does
+        not match, any other candidate within its image URL would fail the
+        same way so the scan resumes after it.
         """
-        m = True
-        while m:
-            m = self._RE_TAG_IZU_IMG.match(line)
-            if m:
-                before = m.group("before") or ""
-                after  = m.group("after")  or ""
-                img    = m.group("img")    or ""
-                tag    = m.group("tag")    or ""
-                value  = m.group("value")  or ""
-                link   = m.group("link")   or ""
-                label  = m.group("label")  or ""
-
-                if tag and value:
-                    tag = "%s=%s" % (tag, value)
-                else:
-                    tag = ""
-                if label:
-                    tag = "%s title=\"%s\"" % (tag, label)
+        result = []
+        pos = 0
+        close = line.rfind("]")
+        while pos < close:
+            m = self._RE_TAG_IZU_IMG_HEAD.search(line, pos, close)
+            if not m:
+                break
+            t = self._RE_TAG_IZU_IMG.match(line, m.start())
+            if t:
+                result.append(line[pos:t.start()])
+                result.append(self._ReplIzuImage(t))
+                pos = t.end()
+            else:
+                result.append(line[pos:m.end()])
+                pos = m.end()
+        if result:
+            result.append(line[pos:])
+            line = "".join(result)
+        return line
 
-                img = "<img src=\"%s\" %s />" % (img, tag)
+    def _ReplIzuImage(self, m):
+        """
+        Returns the replacement string for an [izu_image:...] tag match.
+        """
+        img    = m.group("img")    or ""
+        tag    = m.group("tag")    or ""
+        value  = m.group("value")  or ""
+        link   = m.group("link")   or ""
+        label  = m.group("label")  or ""
 
-                if link:
-                    link = "<a href=\"%s\">%s</a>" % (link, img)
-                else:
-                    link = img
+        if tag and value:
+            tag = "%s=%s" % (tag, value)
+        else:
+            tag = ""
+        if label:
+            tag = "%s title=\"%s\"" % (tag, label)
 
-                line = "%s%s%s" % (before, link, after)
+        img = "<img src=\"%s\" %s />" % (img, tag)
 
-        return line
+        if link:
+            link = "<a href=\"%s\">%s</a>" % (link, img)
+        else:
+            link = img
+        return link
 
     # Note: the [izu:image:..] tag is rewritten to [izu_image:..] by _ParseIzuTags
-    _RE_TAG_IZU_IMG = re.compile(r"(?i)(?P<before>.*?)(?<!\[)\[izu_image:(?P<img>https?://[^\],\"<>]+\.(?:gif|jpe?g|png|svg))(?:,(?P<tag>[a-z]+)=(?P<value>[a-z]+))?(?:\|(?P<link>(?:https?://|ftp://|#)[^:\"<>\]]+))?(?::(?P<label>[^\]]+))?\](?P<after>.*)")
+    _RE_TAG_IZU_IMG_HEAD = re.compile(r"(?i)(?<!\[)\[izu_image:https?://[^\],\"<>]*")
+    _RE_TAG_IZU_IMG = re.compile(r"(?i)(?<!\[)\[izu_image:(?P<img>https?://[^\],\"<>]+\.(?:gif|jpe?g|png|svg))(?:,(?P<tag>[a-z]+)=(?P<value>[a-z]+))?(?:\|(?P<link>(?:https?://|ftp://|#)[^:\"<>\]]+))?(?::(?P<label>[^\]]+))?\]")
 
     def _FormatLinks(self, state, line):
         """
@@ -832,30 +1370,49 @@ class IzuParser(object):
         """
         # -- format external links --
 
+        # Link tags are matched up to the first character which can't be part
+        # of the URL. Tags without the closing bracket there are left as-is
+        # and the scan resumes after them: any other tag in the URL would end
+        # at the same place and fail too.
+
+        # izumi post link: [name|/category#s:date:title] or [name|#s:date:title],
+        # before the named links which would take the ones without a space.
+        line = self._RE_IZU_POST_LINK.sub(
+            lambda m: self._ReplIzuPostLink(state, m.group(1), m.group(2), m.group(3), m.group(4)),
+            line)
+
         # named image link: [title|http://blah/blah.gif,jpeg,jpg,png,svg], without [[
-        line = self._RE_LINK_NAMED_IMG.sub(r'<img alt="\1" title="\1" src="\2">', line)
+        line = self._SubLinkTags(self._RE_LINK_NAMED_IMG,
+            lambda m: self._RE_IMG_URL.match(m.group(2)) and
+                      '<img alt="%s" title="%s" src="%s">' % (m.group(1), m.group(1), m.group(2)) or
+                      m.group(0),
+            line)
 
         # unnamed image link: [http://blah/blah.gif,jpeg,jpg,png,svg], without [[
-        line = self._RE_LINK_UNNAMED_IMG.sub(r'<img src="\1">', line)
+        line = self._SubLinkTags(self._RE_LINK_UNNAMED_IMG,
+            lambda m: self._RE_IMG_URL.match(m.group(1)) and
+                      '<img src="%s">' % m.group(1) or
+                      m.group(0),
+            line)
 
         # named link: [name|http://blah/blah], accept ftp:// and #name, without [[
-        line = self._RE_LINK_NAMED_URL.sub(r'<a href="\2">\1</a>', line)
+        line = self._SubLinkTags(self._RE_LINK_NAMED_URL,
+            lambda m: '<a href="%s">%s</a>' % (m.group(2), m.group(1)),
+            line)
 
         # unnamed link: [http://blah/blah], accepts ftp:// and #name, without [[
-        line = self._RE_LINK_UNNAMED_URL.sub(r'<a href="\1">\1</a>', line)
+        line = self._SubLinkTags(self._RE_LINK_UNNAMED_URL,
+            lambda m: '<a href="%s">%s</a>' % (m.group(1), m.group(1)),
+            line)
 
         # rig link: [name|riglink:image_glob]
-        line = self._RE_RIGLINK.sub(
-            lambda m: self._ReplRigLink(state, m.group(1), m.group(2)), line)
+        line = self._SubLinkTags(self._RE_RIGLINK,
+            lambda m: self._ReplRigLink(state, m.group(1), m.group(2)),
+            line)
 
         # rig image: [name|rigimg:size:image_glob]
         line = self._ParseRigImage(state, line, accept_rest=True)
 
-        # izumi post link: [name|/category#s:date:title] or [name|#s:date:title]
-        line = self._RE_IZU_POST_LINK.sub(
-            lambda m: self._ReplIzuPostLink(state, m.group(1), m.group(2), m.group(3), m.group(4)),
-            line)
-
         # unformatted link: http://blah or ftp:// (link cannot contain quotes)
         # and must not be surrounded by quotes
         # and must not be surrounded by brackets
@@ -865,13 +1422,27 @@ class IzuParser(object):
         line = self._RE_LINK_UNFORMATTED.sub(r'\1<a href="\2">\2</a>\3', line)
         return line
 
-    _RE_LINK_NAMED_IMG   = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|((?:https?://|/)[^\] "<>]+\.(?:gif|jpe?g|png|svg))\]')
-    _RE_LINK_UNNAMED_IMG = re.compile(r'(?<!\[)\[((?:https?://|/)[^\]" <>]+\.(?:gif|jpe?g|png|svg))\]')
-    _RE_LINK_NAMED_URL   = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|((?:https?://|ftp://|#|/)[^ "<>]+?)\]')
-    _RE_LINK_UNNAMED_URL = re.compile(r'(?<!\[)\[((?:https?://|ftp://|#)[^ "<>]+?)\]')
+    _RE_LINK_NAMED_IMG   = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|((?:https?://|/)[^\] "<>]*)(\]?)')
+    _RE_LINK_UNNAMED_IMG = re.compile(r'(?<!\[)\[((?:https?://|/)[^\]" <>]*)(\]?)')
+    _RE_LINK_NAMED_URL   = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|((?:https?://|ftp://|#|/)[^ "<>][^ "<>\]]*)(\]?)')
+    _RE_LINK_UNNAMED_URL = re.compile(r'(?<!\[)\[((?:https?://|ftp://|#)[^ "<>][^ "<>\]]*)(\]?)')
     _RE_LINK_UNFORMATTED = re.compile(r'(^|[^\[]\]|[^"\[\]\|>])((?:https?://|ftp://)[^ "<>]+)($|[^"\]])')
-    _RE_RIGLINK = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|riglink:([^"<>]+?)\]')
+    _RE_RIGLINK = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|riglink:([^"<>][^"<>\]]*)(\]?)')
+    _RE_IMG_URL = re.compile(r'(?:https?://|/).+\.(?:gif|jpe?g|png|svg)$')
+
+    def _SubLinkTags(self, regexp, repl, line):
+        """
+        Replaces the link tags matched by regexp by repl(match). The last
+        group of regexp is the closing bracket: tags which don't have it
+        are left as-is.
+        """
+        def _Repl(m):
+            if m.group(m.re.groups):
+                return repl(m)
+            return m.group(0)
+        return regexp.sub(_Repl, line)
     _RE_IZU_POST_LINK = re.compile(r'(?<!\[)\[([^\|\[\]]+)\|(/[^ #:\[\]\|]+)?#s:([0-9]{8})(?::([^\|\[\]]+))?\]')
+    _RE_HTML_TAG = re.compile(r"<[^>]*>")
 
     def _ReplIzuPostLink(self, state, label, category, date, title):
         """
@@ -881,12 +1452,20 @@ class IzuParser(object):
         If category is available, we link to:
           <album_base_url>/cat/<category>/post_<date>_<title>.html
         If the category is not available, we need to figure the current one.
+
+        Neither the URL nor the category can be known here: the link is
+        rendered with a placeholder URL matched by RE_POST_LINK, which the
+        site resolves once it knows all its posts.
         """
-        return ("<pre> *** "
-                "curr_category=[[[[raw locals().get('curr_category', 'NOT-SET2')]] "
-                "permalink_url=[[[[raw locals().get('permalink_url', 'NOT-SET')]] "
-                "rel_permalink_url=[[[[raw locals().get('rel_permalink_url', 'NOT-SET')]] "
-                "</pre>")
+        if category:
+            category = category[1:]
+        if title:
+            # the title must be the post's, not formatted like the label
+            title = self._RE_HTML_TAG.sub("", title)
+        return '<a href="izu-post:%s:%s:%s">%s</a>' % (_QuotePostLink(category),
+                                                        date,
+                                                        _QuotePostLink(title),
+                                                        label)
 
     def _ParseRigImage(self, state, line, accept_rest):
         """
@@ -897,9 +1476,20 @@ class IzuParser(object):
         start at the beginning of the line and anything after the tag is ignored.
         """
         if accept_rest:
-            line = self._RE_RIGIMGLINK.sub(
-                       lambda m: self._ReplRigImage(state, m.group(1), m.group(2), m.group(3), m.group(4), m.group(5)),
-                       line)
+            result = []
+            pos = 0
+            memo = {}
+            m = self._RE_RIGIMGLINK_HEAD.search(line)
+            while m:
+                tag = self._MatchRigImage(line, m.start(), memo)
+                if tag:
+                    result.append(line[pos:m.start()])
+                    result.append(self._ReplRigImage(state, *tag[1:]))
+                    pos = tag[0]
+                m = self._RE_RIGIMGLINK_HEAD.search(line, max(pos, m.start() + 1))
+            if result:
+                result.append(line[pos:])
+                line = "".join(result)
         else:
             m = self._RE_RIGIMGLINK.match(line)
             if m:
@@ -908,6 +1498,81 @@ class IzuParser(object):
 
     # groups:                     . first     1 title               2 islink.  3 size       4 img glob .    5 caption
     _RE_RIGIMGLINK = re.compile(r'(?<!\[)\[(?:([^\|\[\]]+)\|)?rigimg(link)?:(?:([^:\]]*?):)?([^"<>|]+?)(?:\|([^"<>\]]+?))?\]')
+    _RE_RIGIMGLINK_HEAD = re.compile(r'(?<!\[)\[(?:[^\|\[\]]+\|)?rigimg')
+
+    def _MatchRigImage(self, line, i, memo):
+        """
+        Matches _RE_RIGIMGLINK at index i of the line, trying the optional
+        title and size in the same order as the regexp does.
+
+        The memo dict must be shared by all the calls for the same line: the
+        lookups of the character ending each part of the tag are cached so
+        that a line full of unterminated tags is not scanned once per tag.
+
+        Returns a tuple (end, title, is_link, size, image_glob, caption)
+        or None.
+        """
+        n = len(line)
+        heads = []
+        k = self._FindFirst(line, self._RE_RIGIMG_END_TITLE, i + 1, memo)
+        if k > i + 1 and k < n and line[k] == "|":
+            heads.append((line[i+1:k], k + 1))
+        heads.append((None, i + 1))
+
+        for title, j in heads:
+            if not line.startswith("rigimg", j):
+                continue
+            j += 6
+            is_link = None
+            if line.startswith("link:", j):
+                is_link = "link"
+                j += 5
+            elif line.startswith(":", j):
+                j += 1
+            else:
+                continue
+
+            bodies = []
+            k = self._FindFirst(line, self._RE_RIGIMG_END_SIZE, j, memo)
+            if k < n and line[k] == ":":
+                bodies.append((line[j:k], k + 1))
+            bodies.append((None, j))
+
+            for size, g in bodies:
+                if g >= n or line[g] in '"<>|':
+                    continue
+                k = self._FindFirst(line, self._RE_RIGIMG_END_GLOB, g + 1, memo)
+                if k < n and line[k] == "]":
+                    return k + 1, title, is_link, size, line[g:k], None
+                if k < n and line[k] == "|":
+                    c = self._FindFirst(line, self._RE_RIGIMG_END_CAPTION, k + 1, memo)
+                    if c > k + 1 and c < n and line[c] == "]":
+                        return c + 1, title, is_link, size, line[g:k], line[k+1:c]
+        return None
+
+    _RE_RIGIMG_END_TITLE   = re.compile(r'[\|\[\]]')
+    _RE_RIGIMG_END_SIZE    = re.compile(r'[:\]]')
+    _RE_RIGIMG_END_GLOB    = re.compile(r'[\|\]"<>]')
+    _RE_RIGIMG_END_CAPTION = re.compile(r'["<>\]]')
+
+    def _FindFirst(self, line, regexp, pos, memo):
+        """
+        Returns the index of the first character matching regexp at or after
+        pos in the line, or the length of the line if there's none.
+
+        The memo dict keeps the last lookup of each regexp: a lookup that falls
+        between the position and the result of the previous one gets the same
+        result without scanning the line again.
+        """
+        start, found = memo.get(regexp, (0, -1))
+        if pos < start or pos > found:
+            m = regexp.search(line, pos)
+            if m:
+                found = m.start()
+            else:
+                found = len(line)
+            memo[regexp] = (pos, found)
+        return found
 
     def _ReplRigLink(self, state, title, image_glob):
         """
@@ -924,7 +1589,7 @@ class IzuParser(object):
                 abs_dir = rel_file.dirname().abs_path
             else:
                 abs_dir = os.path.dirname(filename)
-            choice = self._GlobGlob(abs_dir, image_glob)
+            choice = self._GlobGlob(abs_dir, _Latin1(image_glob))
             if choice:
                 subdir = os.path.dirname(choice)
                 filename = os.path.basename(choice)
@@ -933,7 +1598,11 @@ class IzuParser(object):
                     if os.path.sep != "/":
                         subdir = subdir.replace(os.path.sep, "/")
                     album += ' + (curr_album and "/" or "") + "%s"' % urllib.quote(subdir, "/")
-                result = '[[[if rig_base]]<a title="%(name)s" href="[[[raw rig_img_url %% { "rig_base": rig_base, "album": %(album)s, "img": "%(img)s" } ]]">%(name)s</a>[[[end]]'
+                result = (_Tag("if rig_base") +
+                          '<a title="%(name)s" href="' +
+                          _Tag('raw rig_img_url %% { "rig_base": rig_base, "album": %(album)s, "img": "%(img)s" } ') +
+                          '">%(name)s</a>' +
+                          _Tag("end"))
                 result %= { "name":  title,
                             "album": album,
                             "img":   urllib.quote(filename, "/") }
@@ -957,30 +1626,44 @@ class IzuParser(object):
                 abs_dir = rel_file.dirname().abs_path
             else:
                 abs_dir = os.path.dirname(filename)
-            choice = self._GlobGlob(abs_dir, image_glob)
+            choice = self._GlobGlob(abs_dir, _Latin1(image_glob))
             if choice:
                 if rel_file:
                     rel_file = rel_file.dirname().join(choice)
                 subdir = os.path.dirname(choice)
                 filename = os.path.basename(choice)
-                result = self._ExternalGenRigUrl(rel_file, abs_dir, choice, title, is_link, size, caption)
+                batch = state.ImgGenBatch()
+                result = self._ExternalGenRigUrl(rel_file, abs_dir, choice, title, is_link, size, caption,
+                                                 batch)
                 if not result:
-                    result = self._InternalGenRigUrl(subdir, filename, title, is_link, size, caption)
+                    dimensions = None
+                    if self._img_dims and not (batch and batch.IsCollecting()):
+                        dimensions = img_size.Get(self._cache,
+                                                  os.path.join(abs_dir, subdir)).Get(filename)
+                    result = self._InternalGenRigUrl(subdir, filename, title, is_link, size, caption,
+                                                     dimensions)
         return result
 
-    def _ExternalGenRigUrl(self, rel_file, abs_dir, filename, title, is_link, size, caption):
+    def _ExternalGenRigUrl(self, rel_file, abs_dir, filename, title, is_link, size, caption,
+                           batch=None):
         """
         Calls external script.
         Returns None if there is no external script.
         Returns False if script is dies with ret != 0, in which case we just die painfully
         anyway.
         Otherwise returns the replacement string to use for the image.
+
+        When an _ImgGenBatch is given, the request is only added to it while
+        it is collecting requests and None is returned. Once the batch has
+        run, its result is used instead of calling the script.
         """
         script = self._img_gen_script
         if not script:
             return None
 
         rig_base = self._rig_base
+        title = _Latin1(title)
+        caption = _Latin1(caption)
 
         env = { "ABS_DIR":     abs_dir,
                 "REL_FILE":    rel_file and rel_file.rel_curr or "",
@@ -992,7 +1675,51 @@ class IzuParser(object):
                 "RIG_BASE":    rig_base                 or ""
               }
 
-        p = self._SubprocessPopen( [ script,
+        if batch is not None and batch.IsCollecting():
+            batch.Add(env)
+            return None
+
+        result = batch is not None and batch.Result(env) or None
+        if result is not None:
+            ret, output = result
+        elif self._img_gen_server:
+            ret, output = self._ServerGenRigUrl(env)
+        else:
+            ret, output = self._RunGenScript(env)
+        if ret != 0 or not output:
+            self._log.Error("Image Gen Script failed. Ret=%d, Args=%s", ret, repr(env))
+            if abs_dir != "@test@":
+                # Don't do a sys.exit during unit-tests :-)
+                sys.exit(2)
+            return None
+
+        result = output
+        if output.find("<img ") == -1:
+            # result must be an URL. Wrap in <img> tag.
+            result = '<img '
+            if title:
+                result += 'title="%(title)s" '
+            result += 'src="%(output)s">'
+
+        if caption and output.find("<tt>") == -1:
+            result += "<br/><tt>%(caption)s</tt>"
+
+        result %= { "output": output,
+                    "title": title,
+                    "caption": caption }
+        if self._unicode_text:
+            result = result.decode("iso-8859-1")
+        return result
+
+
+    def _RunGenScript(self, env):
+        """
+        Executes the img_gen_script once for the given request.
+        This can be called from several threads at once.
+
+        Returns a tuple (ret, output).
+        """
+        p = self._SubprocessPopen( [ self._img_gen_script,
                                      env["ABS_DIR"],
                                      env["REL_FILE"],
                                      env["IMG_NAME"],
@@ -1015,36 +1742,52 @@ class IzuParser(object):
         ret = -1
         if output:
             ret = p.wait()
-        if ret != 0:
-            self._log.Error("Image Gen Script failed. Ret=%d, Args=%s", ret, repr(env))
-            if abs_dir != "@test@":
-                # Don't do a sys.exit during unit-tests :-)
-                sys.exit(2)
-            return None
+        return ret, output
 
-        result = output
-        if output.find("<img ") == -1:
-            # result must be an URL. Wrap in <img> tag.
-            result = '<img '
-            if title:
-                result += 'title="%(title)s" '
-            result += 'src="%(output)s">'
-
-        if caption and output.find("<tt>") == -1:
-            result += "<br/><tt>%(caption)s</tt>"
+    def _ServerGenRigUrl(self, env):
+        """
+        Sends the request to the shared img_gen_script server.
+        Successful results are kept in the cache, indexed by the request and
+        the modification time and size of the image and of the script, so
+        that editing the script invalidates its results.
 
-        result %= { "output": output,
-                    "title": title,
-                    "caption": caption }
+        Returns a tuple (ret, output) like the one-shot mode.
+        """
+        compute = lambda: img_gen.Get(self._log, self._img_gen_script).Request(env)
+        if not self._cache:
+            return compute()
+        try:
+            st = os.stat(os.path.join(env["ABS_DIR"], env["IMG_NAME"]))
+            script_st = os.stat(self._img_gen_script)
+        except OSError:
+            return compute()
+        key = [ "img_gen",
+                self._img_gen_script,
+                script_st.st_mtime,
+                script_st.st_size,
+                sorted(env.items()),
+                st.st_mtime,
+                st.st_size ]
+        result = self._cache.Find(key)
+        if result is None:
+            result = compute()
+            if result[0] == 0 and result[1]:
+                self._cache.Store(result, key)
+        else:
+            stats.Start("1.2 Img Gen Cached").Stop()
         return result
 
-
-    def _InternalGenRigUrl(self, subdir, filename, title, is_link, size, caption):
+    def _InternalGenRigUrl(self, subdir, filename, title, is_link, size, caption,
+                           dimensions=None):
         """
         Returns the replacement string for a [name|rigimg:size:image_glob|caption]
         based on the rig_img_url and rig_thumb_url variables.
+
+        When the (width, height) dimensions of the image are given, the
+        rig_img_dims variable, if set, is added to the img tag with the
+        dimensions of the image as displayed.
         """
-        result = '[[[if rig_base]]'
+        result = _Tag("if rig_base")
         album = "curr_album"
         if subdir:
             if os.path.sep != "/":
@@ -1054,23 +1797,47 @@ class IzuParser(object):
             result += '<a '
             if title:
                 result += 'title="%(name)s" '
-            result += 'href="[[[raw rig_img_url %% { "rig_base": rig_base, "album": %(album)s, "img": "%(img)s" } ]]">'
+            result += 'href="' + _Tag('raw rig_img_url %% { "rig_base": rig_base, "album": %(album)s, "img": "%(img)s" } ') + '">'
         result += '<img '
         if title:
             result += 'title="%(name)s" '
-        result += 'src="[[[raw rig_thumb_url %% { "rig_base": rig_base, "album": %(album)s, "img": "%(img)s", "size": %(size)s } ]]">'
+        result += 'src="' + _Tag('raw rig_thumb_url %% { "rig_base": rig_base, "album": %(album)s, "img": "%(img)s", "size": %(size)s } ') + '"%(dims)s>'
         if is_link:
             result += '</a>'
         if caption:
             result += "<br/><tt>%(caption)s</tt>"
-        result += '[[[end]]'
+        result += _Tag("end")
         result %= { "name":    title,
                     "album":   album,
                     "img":     urllib.quote(filename, "/"),
                     "size":    size and ('"%s"' % size) or "rig_img_size",
-                    "caption": caption }
+                    "caption": caption,
+                    "dims":    dimensions and self._RigImgDims(dimensions, size) or "" }
         return result
 
+    def _RigImgDims(self, dimensions, size):
+        """
+        Returns the template inserting the rig_img_dims variable with the
+        width and height of an image of the given dimensions once scaled to
+        the given size, or to rig_img_size if size is empty.
+        Returns an empty string if the size is not a number.
+        """
+        if size:
+            try:
+                width, height = img_size.FitSize(dimensions, int(size))
+            except ValueError:
+                return ""
+        else:
+            width, height = dimensions
+            largest = max(width, height)
+            if largest <= 0:
+                return ""
+            width = "%d * min(rig_img_size, %d) / %d" % (width, largest, largest)
+            height = "%d * min(rig_img_size, %d) / %d" % (height, largest, largest)
+        return (_Tag("if rig_img_dims") + " " +
+                _Tag('raw rig_img_dims %% { "width": %s, "height": %s } ') % (width, height) +
+                _Tag("end"))
+
     def _FormatLists(self, state, line):
         """
         Formats straight URLs and tags for URLs & images
@@ -1094,7 +1861,7 @@ class IzuParser(object):
         if line:
             line = self._FormatBoldItalicHtmlEmpty(line)
             reference = line
-            line = self._ParseRigImage(state, line.strip(), accept_rest=False)
+            line = self._ParseRigImage(state, line.strip(_WHITESPACE), accept_rest=False)
             if line and line != reference:
                 line = self._RemoveEscapes(line)
                 line = self._ConvertAccents(line)
@@ -1159,6 +1926,12 @@ class IzuParser(object):
         the first choice is taken into account.
 
         This is used by _ReplRigLink.
+
+        Directory listings are shared by all the lookups of the run, see
+        dir_parser.CachedListDir, and segments are only compiled once.
+
+        Returns None when nothing matches, including when "dir" is not a
+        directory, e.g. for an entry read from an archive.
         """
         if isinstance(pattern, list):
             segments = pattern
@@ -1174,9 +1947,13 @@ class IzuParser(object):
             if not segment or segment == "." or segment == "..":
                 continue
 
-            for d in os.listdir(dir):
-                leaf = os.path.basename(d)
-                if fnmatch.fnmatch(leaf, segment):
+            match = _GlobSegmentMatch(segment)
+            try:
+                leaves = dir_parser.CachedListDir(dir)
+            except OSError:
+                return None
+            for leaf in leaves:
+                if match(os.path.normcase(leaf)):
 
                     if not segments:
                         return leaf
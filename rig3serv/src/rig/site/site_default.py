@@ -33,15 +33,21 @@ import urllib
 import zlib
 from datetime import date, datetime
 
-from rig.parser.izu_parser import IzuParser
+from rig.parser.izu_parser import IzuParser, RE_POST_LINK, PostLinkTarget, CodeDigest
 from rig.site_base import SiteBase, SiteItem
-from rig.template.template import Template
+from rig.template.template import Template, GenerateChunks
+from rig.template.node import NodeList
 from rig.source_item import SourceDir, SourceFile, SourceContent
 from rig.parser.dir_parser import RelPath, PathTimestamp
+from rig.parser import img_size
 from rig.version import Version
 from rig.sites_settings import DEFAULT_ITEMS_PER_PAGE
 from rig.cache import Cache
 from rig.hash_store import HashStore
+from rig.digest_store import DigestStore
+from rig.spill_file import SpillFile, SpillWriter
+from rig import source_buffer
+from rig import stats
 
 #------------------------
 class ContentEntry(object):
@@ -53,6 +59,9 @@ class ContentEntry(object):
 
     def __repr__(self):
         content = self.content
+        if isinstance(content, unicode):
+            # repr() must be a string, as with the ISO-8859-1 pipeline
+            content = content.encode("iso-8859-1", "xmlcharrefreplace")
         return "<%s: title %s, date %s, link %s, content %s>" % (
              self.__class__.__name__, self.title, self.date, self.permalink, content)
 
@@ -65,6 +74,38 @@ class MonthPageItem(object):
     def __repr__(self):
         return "<%s: url %s, date %s>" % (self.__class__.__name__, self.url, self.date)
 
+#------------------------
+class PermalinkIndex(object):
+    """
+    Indexes SiteItems by date and mangled title, so that izumi post links
+    can be resolved in constant time.
+
+    - items: list of SiteItem, in decreasing date order. When several items
+      match a link, the first one wins.
+    - name_func: the method mangling titles, i.e. SiteDefault._SimpleFileName.
+    - has_categories: whether the site generates per-category pages.
+    """
+    def __init__(self, items, name_func, has_categories=False):
+        self._name_func = name_func
+        self.has_categories = has_categories
+        self._items = {}
+        for i in items:
+            date = "%04d%02d%02d" % (i.date.year, i.date.month, i.date.day)
+            self._items.setdefault((date, name_func(i.title)), []).append(i)
+            # links without a title target the first post of the day
+            self._items.setdefault((date, None), []).append(i)
+
+    def Find(self, date, title=None, category=None):
+        """
+        Returns the SiteItem for the given YYYYMMDD date and title, with the
+        given category if any, or None.
+        """
+        key = (date, title and self._name_func(title) or None)
+        for i in self._items.get(key, []):
+            if not category or category in i.categories:
+                return i
+        return None
+
 #------------------------
 class SiteDefault(SiteBase):
     """
@@ -117,14 +158,35 @@ class SiteDefault(SiteBase):
                 os.path.join(site_settings.cache_dir,
                              self._cache.GetKey(site_settings.public_name)))
 
+        # Compiled izu documents only depend on their content and on the
+        # parser code: they are shared by all sites and are not cleared
+        # with the site's cache. See _IzuCacheDir.
+        self._izu_cache = Cache(log, site_settings.cache_dir)
+        self._izu_cache.SetCacheDir(self._IzuCacheDir(site_settings.cache_dir))
+
+        # Large sections are spilled in the site's cache directory, so that
+        # they are cleared along with the cache entries that refer to them.
+        self._spill_dir = os.path.join(site_settings.cache_dir,
+                                       self._cache.GetKey(site_settings.public_name),
+                                       "spill")
+
         self._hash_store = HashStore(log, self._cache)
+        self._digest_store = DigestStore(log, self._cache)
+        self._permalinks = PermalinkIndex([], self._SimpleFileName)
+        self._broken_links = {}
+        self._img_manifests = {}
+        self._coherency_key = None
+        self._fingerprint = None
 
         self._enable_cache = os.getenv("DISABLE_RIG3_CACHE") is None
         self._debug_cache  = os.getenv("DEBUG_RIG3_CACHE")   is not None
 
         if self._enable_cache:
             self._hash_store.Load()
+            if site_settings.content_digest:
+                self._digest_store.Load()
             self._ClearCache(site_settings)
+            self._ClearIzuCache(site_settings.cache_dir)
         else:
             self._log.Info("[%s] Cache is disabled.",
                            self._site_settings.public_name)
@@ -132,9 +194,49 @@ class SiteDefault(SiteBase):
     def Dispose(self):
         if self._enable_cache:
             self._hash_store.Save()
+            if self._site_settings.content_digest:
+                self._digest_store.Save()
             self._cache.DisplayCounters(self._log)
         super(SiteDefault, self).Dispose()
 
+    def _FileDigest(self, path):
+        """
+        Returns the content digest of the given file. Digests are kept in
+        the site cache, so a file is only read again when its stat changes.
+        """
+        if self._enable_cache:
+            return self._digest_store.FileDigest(path)
+        return super(SiteDefault, self)._FileDigest(path)
+
+    def _IsUpToDate(self):
+        """
+        Computes a fingerprint of the site from the cache coherency key
+        (site settings, theme and rig version) and the stamps of all the
+        sources. The site is up-to-date if this fingerprint is in the hash
+        store, i.e. a previous run fully generated the site from the same
+        state. This does not parse the sources nor load any item cache.
+
+        Always false unless the skip_unchanged setting is set, and when the
+        cache is disabled or generation is forced.
+        """
+        self._fingerprint = None
+        if not self._site_settings.skip_unchanged:
+            return False
+        if not self._enable_cache or not os.path.isdir(self._site_settings.dest_dir or ""):
+            return False
+        s = stats.Start("0-Site Fingerprint")
+        self._fingerprint = self._cache.GetKey(
+            [ self._coherency_key,
+              [ (source, source.Stamp()) for source in self._site_settings.source_list ] ])
+        s.Stop()
+        if self._force:
+            return False
+        return self._hash_store.Contains(self._fingerprint)
+
+    def _SetUpToDate(self):
+        if self._fingerprint is not None and not self._dry_run:
+            self._hash_store.Add(self._fingerprint)
+
     def MakeDestDirs(self):
         """
         Creates the necessary directories in the destination.
@@ -167,6 +269,9 @@ class SiteDefault(SiteBase):
         # Do we have to generate anything at all?
         hash_key = self._cache.GetKey([ categories, items ])
 
+        # Index all the posts in one pass for the izumi post links
+        self._permalinks = PermalinkIndex(items, self._SimpleFileName, bool(categories))
+
         if self._enable_cache and self._hash_store.Contains(hash_key):
             if self._force:
                 self._log.Info("[%s] No new content found, forcing generation",
@@ -677,6 +782,12 @@ class SiteDefault(SiteBase):
         may_have_images, all_files, izu_file, html_file, title, rel_dir = \
                                             self._GenItem_GetFiles(source_item)
 
+        # Reject items which categories are not accepted on this site
+        # before doing any rendering, when the header is enough to tell.
+        if not self._GenItem_HeaderMatches(source_item, izu_file, html_file):
+            stats.Start("1.1 Izu Skipped").Stop()
+            return None
+
         # TODO keep 2 keyword dicts: the main site_settings which does NOT
         # need to be hashed for the cache (cache gets cleared on settings)
         # and a 2nd keyword local for here. Pre-Hash the 2nd then merge
@@ -697,6 +808,12 @@ class SiteDefault(SiteBase):
                  stat_prefix="1.1 Izu",
                  use_cache=self._enable_cache)
 
+        if sections and [ v for v in sections.itervalues()
+                          if isinstance(v, SpillFile) and not v.Exists() ]:
+            # The cache refers to spill files which have been removed
+            sections, tags = self._GenItem_GetSections(*section_args)
+            self._cache.Store((sections, tags), section_args)
+
         if sections is None:
             return None
 
@@ -749,14 +866,54 @@ class SiteDefault(SiteBase):
             title = source_item.title
             may_have_images = True
             all_files = []
-            izu_file = source_item.rel_file
-            rel_dir = izu_file.dirname()
+            rel_dir = source_item.rel_file.dirname()
+            if not source_item.rel_file.rel_curr.endswith(self.EXT_HTML):
+                izu_file = source_item.rel_file
 
         else:
             raise NotImplementedError("TODO support %s" % repr(source_item))
 
         return may_have_images, all_files, izu_file, html_file, title, rel_dir
 
+    def _GenItem_HeaderMatches(self, source_item, izu_file, html_file):
+        """
+        Cheap pre-pass on the item's categories using only its header.
+
+        Returns False only if the item would definitely be rejected by the
+        site's cat_filter, True otherwise (in which case the real filter
+        is applied after rendering.)
+
+        Blog entries already know all their tags so the whole filter is
+        applied, unless they only have their header tags. For izu files
+        only the first line is parsed, and since izu:cat tags further down
+        in the file add more categories, the item is only rejected when a
+        header category is excluded.
+        """
+        cat_filter = self._site_settings.cat_filter
+        if cat_filter.MatchesAll():
+            return True
+
+        if html_file == "@content":
+            tags = source_item.tags
+            if source_item.header_tags and izu_file:
+                if not "cat" in tags:
+                    return True
+                return not cat_filter.Excludes(tags["cat"].keys())
+        elif izu_file:
+            if source_item.source_settings.encoding:
+                encoding = source_item.source_settings.encoding
+            else:
+                encoding = self._site_settings.encoding
+            tags = IzuParser(self._log, None, None).ParseFileFirstLine(izu_file, encoding,
+                                                                       keep=False)
+            if not "cat" in tags:
+                return True
+            return not cat_filter.Excludes(tags["cat"].keys())
+        else:
+            return True
+
+        return cat_filter.Matches(tags.get("cat", {}).keys())
+
     def _GenItem_GetSections(self,
                               source_item,
                               may_have_images,
@@ -777,12 +934,25 @@ class SiteDefault(SiteBase):
                            self._site_settings.public_name,
                            izu_file)
 
+            spill_size = self._site_settings.spill_size
             p = IzuParser(self._log,
-                              keywords["rig_base"],
-                              keywords["img_gen_script"])
+                          keywords["rig_base"],
+                          keywords["img_gen_script"],
+                          self._enable_cache and self._izu_cache or None,
+                          spill_dir=spill_size > 0 and self._spill_dir or None,
+                          spill_size=spill_size,
+                          img_gen_server=keywords["img_gen_server"],
+                          img_gen_workers=keywords["img_gen_workers"],
+                          unicode_text=self._site_settings.unicode_text,
+                          img_dims=bool(keywords.get("rig_img_dims")),
+                          template_nodes=True)
             if html_file == "@content":
                 tags = source_item.tags
-                _, sections = p.RenderStringToHtml(source_item.content, encoding, source_item.rel_file)
+                content_tags, sections = p.RenderStringToHtml(source_item.GetContent(), encoding, source_item.rel_file)
+                if source_item.header_tags:
+                    # Add the izu tags found further down the content
+                    tags = dict(tags)
+                    tags.update(content_tags)
             else:
                 tags = p.ParseFileFirstLine(izu_file, encoding)
                 if "encoding" in tags:
@@ -790,21 +960,28 @@ class SiteDefault(SiteBase):
                 tags, sections = p.RenderFileToHtml(izu_file, encoding)
 
             for k, v in sections.iteritems():
-                if isinstance(v, (str, unicode)):
+                if isinstance(v, SpillFile):
+                    if may_have_images:
+                        keywords["curr_album"] = urllib.quote(rel_dir.rel_curr)
+                    sections[k] = self._GenItem_GenerateSpillFile(v, keywords)
+                elif isinstance(v, NodeList):
                     if may_have_images:
                         keywords["curr_album"] = urllib.quote(rel_dir.rel_curr)
-                    template = Template(self._log, source=v)
+                    template = Template(self._log, nodes=v)
                     sections[k] = template.Generate(keywords)
                 elif k == "images":
                     if may_have_images:
                         keywords["curr_album"] = urllib.quote(rel_dir.rel_curr)
-                        keywords["lines"] = [v]  # one line of many columns
-                        content = self._FillTemplate(SiteDefault._TEMPLATE_IMG_TABLE, **keywords)
-                        template = Template(self._log, source=content)
-                        sections[k] = template.Generate(keywords)
+                        # one line of many columns, already generated
+                        keywords["lines"] = [[ Template(self._log, nodes=n).Generate(keywords)
+                                               for n in v ]]
+                        sections[k] = self._FillTemplate(SiteDefault._TEMPLATE_IMG_TABLE, **keywords)
                     else:
                         sections[k] = ""
 
+        elif html_file == "@content":
+            tags = source_item.tags
+            sections["html"] = source_item.GetContent()
         elif html_file:
             sections["html"] = self._ReadFile(html_file, encoding)
             izu_parser = IzuParser(self._log,
@@ -817,6 +994,26 @@ class SiteDefault(SiteBase):
 
         return sections, tags
 
+    def _GenItem_GenerateSpillFile(self, spill_file, keywords):
+        """
+        Generates the template of a section spilled by the IzuParser, chunk
+        by chunk, and removes the spilled section.
+
+        Returns a SpillFile with the generated section, stored in the site's
+        spill directory.
+        """
+        writer = SpillWriter(self._spill_dir)
+        result = None
+        try:
+            for chunk in GenerateChunks(self._log, spill_file.Lines(), keywords):
+                writer.Write(chunk)
+            result = writer.Close()
+            return result
+        finally:
+            if result is None:
+                writer.Discard()
+            spill_file.Remove()
+
     def __GenItem_CreateSiteItem(self,
                                  source_item,
                                  may_have_images,
@@ -855,15 +1052,19 @@ class SiteDefault(SiteBase):
         keywords["abs_permalink_url"] = permalink_url
         keywords["_cache_key"] = self._cache.GetKey(keywords)
 
+        post_links = self._FindPostLinks(sections)
+
         return SiteItem(source_item,
                         date,
                         title,
                         anchorlink_url,
                         categories=cats,
                         content_gen=lambda template, extra=None: \
-                            self.__GenItem_GenContent(template, keywords, img_params, extra))
+                            self.__GenItem_GenContent(template, keywords, img_params,
+                                                      post_links, extra))
 
-    def __GenItem_GenContent(self, _template, _keywords, _img_params, _extra_keywords=None):
+    def __GenItem_GenContent(self, _template, _keywords, _img_params, _post_links,
+                             _extra_keywords=None):
         # we need to make sure we can't contaminate the caller's dictionaries
         # so we just duplicate them here. Also we make sure not to use any
         # variables which are declared in the outer method.
@@ -909,14 +1110,111 @@ class SiteDefault(SiteBase):
             _key_temp_dict["last_content_iso"] = None
             _cache_key.append(_key_temp_dict)
 
+        # Resolve the izumi post links. The content only needs to be
+        # generated again when one of the posts they target moved.
+        _urls = None
+        if _post_links:
+            _urls = {}
+            for _link in _post_links:
+                _urls[_link] = self._PostLinkUrl(_link, _keywords)
+            _cache_key.append(sorted(_urls.items()))
+
         _content = self._cache.Compute(
                _cache_key,
-               lambda: self._FillTemplate(_template, **_keywords),
+               lambda: self._FillTemplate(_template,
+                            **self._ResolvePostLinks(self._ReadSpillFiles(_keywords), _urls)),
                stat_prefix="2.2 Content",
                use_cache=self._enable_cache)
 
         return _content
 
+    def _FindPostLinks(self, sections):
+        """
+        Returns the list of izumi post links found in the sections, as the
+        (category, date, title) placeholders generated by the IzuParser.
+        """
+        links = {}
+        for v in sections.itervalues():
+            if isinstance(v, SpillFile):
+                lines = v.Lines()
+            elif isinstance(v, (str, unicode)):
+                lines = [ v ]
+            else:
+                continue
+            for line in lines:
+                if "izu-post:" in line:
+                    for m in RE_POST_LINK.finditer(line):
+                        links[m.group(1, 2, 3)] = True
+        return links.keys()
+
+    def _PostLinkUrl(self, link, keywords):
+        """
+        Returns the URL of the post targeted by an izumi post link, relative
+        to the page being generated, or None if the site has no such post.
+
+        Posts without categories link to their single page at the top level.
+        Posts with categories link to their single page in the link's
+        category, else the current one, else their first one. When the site
+        has no category pages, they link to their anchor in the month page.
+        """
+        category, date, title = PostLinkTarget(*link)
+        item = self._permalinks.Find(date, title, category)
+        if item is None:
+            if not link in self._broken_links:
+                self._broken_links[link] = True
+                self._log.Warning("[%s] No post found for link to %s %s %s",
+                                  self._site_settings.public_name,
+                                  category or "", date, title or "")
+            return None
+        rel_base_url = keywords.get("rel_base_url", "")
+        if not item.categories:
+            return rel_base_url + self._SinglePermalink(item.date, item.title)
+        if not self._permalinks.has_categories:
+            return rel_base_url + item.permalink
+        if not category:
+            category = keywords.get("curr_category")
+            if not category in item.categories:
+                category = item.categories[0]
+        return "%scat/%s/%s" % (rel_base_url, category,
+                                self._SinglePermalink(item.date, item.title))
+
+    def _ResolvePostLinks(self, keywords, urls):
+        """
+        Returns the keywords with the izumi post links of the sections
+        replaced by links to the given URLs, or by their label for the ones
+        which URL is None.
+        """
+        if not urls:
+            return keywords
+        def _Repl(m):
+            url = urls.get(m.group(1, 2, 3))
+            if url is None:
+                return m.group(4)
+            return '<a href="%s">%s</a>' % (url, m.group(4))
+        keywords = dict(keywords)
+        keywords["sections"] = sections = dict(keywords["sections"])
+        for k, v in sections.items():
+            if isinstance(v, (str, unicode)) and "izu-post:" in v:
+                sections[k] = RE_POST_LINK.sub(_Repl, v)
+        return keywords
+
+    def _ReadSpillFiles(self, keywords):
+        """
+        Returns the keywords with the content of the spilled sections read
+        back, as expected by the templates.
+
+        The entry template and the page are not generated chunk by chunk, so
+        the spilled sections are held in memory whole again here.
+        """
+        sections = keywords["sections"]
+        spilled = [ k for k, v in sections.iteritems() if isinstance(v, SpillFile) ]
+        if spilled:
+            keywords = dict(keywords)
+            keywords["sections"] = sections = dict(sections)
+            for k in spilled:
+                sections[k] = sections[k].Read()
+        return keywords
+
     def _GenerateImages(self, source_dir, all_files, keywords):
         """
         Generates a table with images.
@@ -954,6 +1252,66 @@ class SiteDefault(SiteBase):
         if not img_pattern:
             img_pattern = self._IMG_PATTERN
 
+        nums, images = self._ImageManifest(source_dir, all_files, img_pattern)
+
+        cache_key = [ source_dir,
+                      all_files,
+                      images,
+                      keywords.get("_cache_key", None) ]
+
+        c = self._cache.Compute(
+                    key=cache_key,
+                    lambda_expr=lambda : self.__GenImage_CreateHtml(source_dir, nums, images, keywords),
+                    stat_prefix="2.1 Images",
+                    use_cache=self._enable_cache)
+        return c
+
+    def _ImageManifest(self, source_dir, all_files, img_pattern):
+        """
+        Returns the (nums, images) manifest of an album, as computed by
+        _ScanImages.
+
+        When img_manifest is set, the manifest of each album is stored in
+        the cache along with the modification time of the album directory.
+        It is reused as long as the directory does not change, in which case
+        the image files are neither matched nor stat'ed. It is also kept for
+        the rest of the run since an album is generated once per page.
+        """
+        if not self._site_settings.img_manifest or not self._enable_cache:
+            return self._ScanImages(source_dir, all_files, img_pattern)
+
+        abs_dir = source_dir.realpath()
+        key = [ "img_manifest",
+                abs_dir,
+                all_files,
+                img_pattern.pattern,
+                self._site_settings.content_digest ]
+        h = self._cache.GetKey(key)
+        manifest = self._img_manifests.get(h)
+        if manifest is None:
+            try:
+                dir_ts = os.path.getmtime(abs_dir)
+            except OSError:
+                dir_ts = None
+            manifest = self._cache.Find(key)
+            if dir_ts is not None and manifest is not None and manifest[0] == dir_ts:
+                stats.Start("2.1 Img Manifest Hit").Stop()
+            else:
+                s = stats.Start("2.1 Img Manifest Scan")
+                manifest = (dir_ts, self._ScanImages(source_dir, all_files, img_pattern))
+                s.Stop()
+                if dir_ts is not None:
+                    self._cache.Store(manifest, key)
+            self._img_manifests[h] = manifest
+        return manifest[1]
+
+    def _ScanImages(self, source_dir, all_files, img_pattern):
+        """
+        Matches the files of an album with the image pattern and returns a
+        tuple (nums, images):
+        - nums: (num_excellent, num_good, num_images, num_normal)
+        - images: index => { "top_rating", "top_name", "files", "ts" }
+        """
         images = {}
         # images: index => { "top_rating": number,
         #                    "files": [ pattern.groupdict + "full": leaf name ] }
@@ -979,22 +1337,14 @@ class SiteDefault(SiteBase):
                     entry["top_rating"] = rating
                     entry["top_name"] = filename
                 entry["files"].append(filename)
-                entry["ts"].append(PathTimestamp(os.path.join(source_dir.realpath(),
-                                                              filename)))
+                img_path = os.path.join(source_dir.realpath(), filename)
+                if self._site_settings.content_digest:
+                    entry["ts"].append(self._FileDigest(img_path))
+                else:
+                    entry["ts"].append(PathTimestamp(img_path))
 
         nums = (num_excellent, num_good, num_images, num_normal)
-
-        cache_key = [ source_dir,
-                      all_files,
-                      images,
-                      keywords.get("_cache_key", None) ]
-
-        c = self._cache.Compute(
-                    key=cache_key,
-                    lambda_expr=lambda : self.__GenImage_CreateHtml(source_dir, nums, images, keywords),
-                    stat_prefix="2.1 Images",
-                    use_cache=self._enable_cache)
-        return c
+        return nums, images
 
     def __GenImage_CreateHtml(self, source_dir, nums, images, keywords):
         # TODO: the heuristics below are lousy. Works for me, and even that
@@ -1092,9 +1442,17 @@ class SiteDefault(SiteBase):
             tooltip = title or os.path.splitext(leafname)[0]
             link = self._RigImgLink(keywords, album, leafname)
             img = self._RigThumbLink(keywords, album, leafname, size)
-            content = '<img title="%(title)s" alt="%(title)s" src="%(img)s"/>' % {
+            dims = ""
+            if size > 0 and keywords.get("rig_img_dims"):
+                dimensions = img_size.Get(self._enable_cache and self._izu_cache or None,
+                                          source_dir.realpath()).Get(leafname)
+                if dimensions:
+                    width, height = img_size.FitSize(dimensions, size)
+                    dims = " " + keywords["rig_img_dims"] % { "width": width, "height": height }
+            content = '<img title="%(title)s" alt="%(title)s" src="%(img)s"%(dims)s/>' % {
                 "title": tooltip,
-                "img": img }
+                "img": img,
+                "dims": dims }
         else:
             content = album_title
         html = '<a title="%(title)s" href="%(link)s">%(content)s</a>' % {
@@ -1147,15 +1505,14 @@ class SiteDefault(SiteBase):
         tags = IzuParser(self._log, None, None).ParseFileFirstLine(full_path, encoding)
         encoding = tags.get("encoding", encoding)
 
-        f = codecs.open(full_path, mode="rU",
-                        encoding=encoding,
-                        errors="xmlcharrefreplace")
-        data = f.read()
-        f.close()
+        data = source_buffer.Get(full_path).Read(encoding)
 
-        # Internally we only process ISO-8859-1 and replace
-        # unknown entities by their XML hexa encoding
-        data = data.encode("iso-8859-1", "xmlcharrefreplace")
+        if not self._site_settings.unicode_text:
+            # Internally we only process ISO-8859-1 and replace
+            # unknown entities by their XML hexa encoding
+            data = data.encode("iso-8859-1", "xmlcharrefreplace")
+        elif isinstance(data, unicode):
+            data = source_buffer.XmlCharRefs(data)
 
         return data
 
@@ -1190,9 +1547,14 @@ class SiteDefault(SiteBase):
             f = codecs.open(dest_file, mode="wb",
                             encoding="utf-8",
                             errors="xmlcharrefreplace")
-            # Internally the data was processed as iso-8859-1, so use that
-            # to decode and re-encode to UTF-8 for output.
-            f.write(data.decode("iso-8859-1"))
+            if isinstance(data, unicode):
+                # Content of the unicode text pipeline, which may still have
+                # characters that the ISO-8859-1 one would have replaced.
+                f.write(source_buffer.XmlCharRefs(data))
+            else:
+                # Internally the data was processed as iso-8859-1, so use that
+                # to decode and re-encode to UTF-8 for output.
+                f.write(data.decode("iso-8859-1"))
             f.close()
         return dest_file
 
@@ -1230,7 +1592,8 @@ class SiteDefault(SiteBase):
         assert "theme" in keywords
         template_file = self._TemplatePath(path=template, **keywords)
         template_dirs = self._TemplateThemeDirs(**keywords)
-        template = Template(self._log, file=template_file)
+        template = Template(self._log, file=template_file,
+                            compiled=self._site_settings.compile_templates)
         result = template.Generate(keywords, template_dirs=template_dirs)
         return result
 
@@ -1291,6 +1654,40 @@ class SiteDefault(SiteBase):
         """
         return date(_date.year, _date.month, 1)
 
+    def _IzuCacheDir(self, cache_dir):
+        """
+        Returns the directory of the cache shared by the IzuParsers of all
+        the sites. It is named after a key of the rig version and of the
+        parser code (see izu_parser.CodeDigest) so that any change of the
+        code invalidates the compiled documents, img_gen_script replies and
+        image sizes it holds.
+        """
+        rig_version = Version()
+        key = self._cache.GetKey({ "rig3 vers str": rig_version.VersionString(),
+                                   "rig3 svn rev": rig_version.SvnRevision(),
+                                   "izu code": CodeDigest() })
+        return os.path.join(cache_dir, "izu_documents", key)
+
+    def _ClearIzuCache(self, cache_dir):
+        """
+        Removes the entries of the shared izu cache which were computed by
+        another version of the code, i.e. everything in the izu_documents
+        directory but the current _IzuCacheDir.
+        """
+        izu_dir = self._IzuCacheDir(cache_dir)
+        parent = os.path.dirname(izu_dir)
+        if not os.path.isdir(parent):
+            return
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            if path != izu_dir:
+                self._log.Info("[%s] Clear izu cache %s",
+                               self._site_settings.public_name, name)
+                if os.path.isdir(path):
+                    Cache(self._log, path).Clear()
+                else:
+                    os.remove(path)
+
     def _ClearCache(self, site_settings):
         """
         Computes a "cache coherency" key that combines the current site
@@ -1309,6 +1706,7 @@ class SiteDefault(SiteBase):
             "rig3 svn rev": rig_version.SvnRevision()
             }
         hash_key = self._cache.GetKey(cache_coherency_key)
+        self._coherency_key = hash_key
 
         f = self._enable_cache and self._hash_store.Contains(hash_key)
 
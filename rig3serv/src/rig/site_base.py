@@ -28,6 +28,7 @@ Workflow:
 - rig3 calls SiteBase.Process()                      (never overriden)
     - Call self.MakeDestDirs()                       (always overriden)
     - Call self._CopyMedia()                         (not overriden)
+    - Calls self._ParseSources                       (never overriden)
     - For each source: Call self._ProcessSourceItems (never overriden)
         - For each item: Calls self.GenerateItem     (always overriden)
     - Calls self._CollectCategories                  (never overriden)
@@ -45,10 +46,15 @@ __author__ = "ralfoide at gmail com"
 import re
 import os
 import errno
+import sha
+from multiprocessing.pool import ThreadPool
 
 from rig.template.template import Template
 from rig.hashable import Hashable
+from rig.digest_store import ComputeDigest
+from rig.source_item import SourceDir, SourceFile
 from rig import stats
+from rig import source_buffer
 
 DEFAULT_THEME = "default"
 
@@ -182,6 +188,26 @@ class SiteBase(object):
         """
         raise NotImplementedError("Must be derived by subclasses")
 
+    def _IsUpToDate(self):
+        """
+        Called by Process() before anything else. Returns True if the site
+        was already generated from the current state of its sources and
+        settings, in which case Process() does nothing.
+
+        This must be cheap: it should not parse the sources.
+
+        Subclassing: Derived classes can override this. Parent returns False.
+        """
+        return False
+
+    def _SetUpToDate(self):
+        """
+        Called by Process() once the site has been fully generated.
+
+        Subclassing: Derived classes can override this. Parent does nothing.
+        """
+        pass
+
     # Generic implementation that is not expected to be derived.
 
     def Process(self):
@@ -193,6 +219,10 @@ class SiteBase(object):
                        self._site_settings.source_list,
                        self._site_settings.dest_dir,
                        self._site_settings.theme)
+        if self._IsUpToDate():
+            self._log.Info("[%s] No source changed, skipping site",
+                           self._site_settings.public_name)
+            return
         self.MakeDestDirs()
         self._CopyMedia()
         site_items = []
@@ -201,8 +231,13 @@ class SiteBase(object):
 
         dups = {}
 
-        for source in self._site_settings.source_list:
-            self._ProcessSourceItems(source, site_items, dups)
+        source_list = self._site_settings.source_list
+        parsed = self._ParseSources(source_list)
+
+        # Items are merged in the source_list order, whatever the order in
+        # which the sources finished parsing, so dup detection stays the same.
+        for source, source_items in zip(source_list, parsed):
+            self._ProcessSourceItems(source, site_items, dups, source_items)
 
         del dups
 
@@ -220,6 +255,8 @@ class SiteBase(object):
 
         s.Stop(len(site_items))
 
+        self._SetUpToDate()
+
     def _CopyMedia(self):
         """
         Copy media directory from selected template to destination
@@ -242,7 +279,37 @@ class SiteBase(object):
             self._CopyDir(media, os.path.join(self._site_settings.dest_dir, self.MEDIA_DIR),
                           filter_ext={ ".css": _apply_template })
 
-    def _ProcessSourceItems(self, source, in_out_items, dups):
+    def _ParseSources(self, source_list):
+        """
+        Parses all the given sources and returns a list with one list of
+        SourceItem per source, in the same order as source_list.
+
+        When the site settings' num_parse_workers is greater than 1, the
+        sources are parsed concurrently using a pool of worker threads.
+        Parsing is mostly I/O bound (directory walks) so this helps when
+        sources live on different disks.
+
+        Subclassing: Derived classes can override this if needed.
+        The base implementation is expected to be good enough.
+        """
+        dest_dir = self._site_settings.dest_dir
+        num_workers = min(self._site_settings.num_parse_workers, len(source_list))
+        if num_workers <= 1:
+            return [ source.Parse(dest_dir) for source in source_list ]
+
+        self._log.Info("[%s] Parsing %d sources with %d workers",
+                       self._site_settings.public_name,
+                       len(source_list),
+                       num_workers)
+        pool = ThreadPool(num_workers)
+        try:
+            # map() returns the results in the order of source_list
+            return pool.map(lambda source: source.Parse(dest_dir), source_list)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _ProcessSourceItems(self, source, in_out_items, dups, source_items=None):
         """
         Process all items from a given source and queue them into the
         in_out_items list.
@@ -255,6 +322,9 @@ class SiteBase(object):
         the site. However this only works for symlinked entries since the
         real path of the entry is computed in the hash.
 
+        'source_items' is the list of SourceItem already parsed from the
+        source, if any. When None, the source is parsed here.
+
         Subclassing: Derived classes can override this if needed.
         The base implementation is expected to be good enough.
 
@@ -262,7 +332,14 @@ class SiteBase(object):
         """
         dup_on_realpath = self._site_settings.dup_on_realpath
 
-        for source_item in source.Parse(self._site_settings.dest_dir):
+        if source_items is None:
+            source_items = source.Parse(self._site_settings.dest_dir)
+
+        content_digest = self._site_settings.content_digest
+
+        for source_item in source_items:
+            if content_digest:
+                self._DigestSourceItem(source_item)
             if dup_on_realpath:
                 item_hash = source_item.ContentHash().hexdigest()
             else:
@@ -272,11 +349,54 @@ class SiteBase(object):
                 self._log.Info("Skipping dup source item %s", source_item.PrettyRepr())
             else:
                 dups[item_hash] = source_item
+                opens, reads = source_buffer.Counters()
                 site_item = self.GenerateItem(source_item)
+                self._CountItemSources(opens, reads)
                 if site_item:
                     in_out_items.append(site_item)
         return in_out_items
 
+    def _CountItemSources(self, opens, reads):
+        """
+        Reports the number of source file opens and reads done to generate
+        one item, given the source_buffer.Counters() before the item, as
+        a histogram in the stats, e.g. "1.1 Item Source Opens=1".
+        """
+        new_opens, new_reads = source_buffer.Counters()
+        stats.Start("1.1 Item Source Opens=%d" % (new_opens - opens)).Stop()
+        stats.Start("1.1 Item Source Reads=%d" % (new_reads - reads)).Stop()
+
+    def _DigestSourceItem(self, source_item):
+        """
+        Sets the content_digest of a SourceDir or SourceFile which does not
+        have one yet, e.g. one not coming from a catalog. The digest of a
+        directory covers the names and content of all its files.
+
+        This is only used when the site settings' content_digest is true.
+
+        Subclassing: Derived classes can override this if needed.
+        The base implementation is expected to be good enough.
+        """
+        if getattr(source_item, "content_digest", True):
+            return
+        if isinstance(source_item, SourceDir):
+            md = sha.new()
+            abs_dir = source_item.rel_dir.abs_path
+            for f in source_item.all_files:
+                md.update(repr((f, self._FileDigest(os.path.join(abs_dir, f)))))
+            source_item.content_digest = md.hexdigest()
+        elif isinstance(source_item, SourceFile):
+            source_item.content_digest = self._FileDigest(source_item.rel_file.abs_path)
+
+    def _FileDigest(self, path):
+        """
+        Returns the hex digest of the content of the given file.
+
+        Subclassing: Derived classes can override this to cache digests.
+        The base implementation reads the file each time.
+        """
+        return ComputeDigest(path)
+
     def _TemplatePath(self, path, **keywords):
         """
         Returns the relative path to "path" under the theme's template directory.
@@ -27,6 +27,7 @@ import ConfigParser
 from rig.settings_base import SettingsBase
 from rig.source_item import SourceSettings
 from rig.source_reader import SourceDirReader, SourceFileReader, SourceBlogReader
+from rig.source_reader import SourceArchiveReader, SourceCatalogReader
 from rig.site_base import DEFAULT_THEME
 from rig.hashable import Hashable
 
@@ -55,15 +56,8 @@ class IncludeExclude(Hashable):
         Returns true if it matches.
         """
         # First apply exclusions... the first match makes the test fail
-        exc = self._exclude
-        if exc == IncludeExclude.ALL:
-            return False  # everything is excluded
-        elif exc:
-            if not cats and IncludeExclude.NOTAG in exc:
-                return False  # exclude posts with no tags
-            for cat in cats:
-                if cat in exc:
-                    return False  # some word is excluded
+        if self.Excludes(cats):
+            return False
 
         # Then process inclusions... one of them must be there.
         inc = self._include
@@ -76,6 +70,31 @@ class IncludeExclude(Hashable):
                 return True  # some word is included
         return False  # no inclusion worked
 
+    def Excludes(self, cats):
+        """
+        Returns true if the given list of categories is rejected by the
+        exclusions alone. Since exclusions are checked first by Matches(),
+        adding more categories to the list can't make it match again.
+        """
+        exc = self._exclude
+        if exc == IncludeExclude.ALL:
+            return True  # everything is excluded
+        elif exc:
+            if not cats and IncludeExclude.NOTAG in exc:
+                return True  # exclude posts with no tags
+            for cat in cats:
+                if cat in exc:
+                    return True  # some word is excluded
+        return False
+
+    def MatchesAll(self):
+        """
+        Returns true if Matches() would accept any list of categories,
+        i.e. there are no exclusions and everything is included.
+        """
+        inc = self._include
+        return not self._exclude and (not inc or inc == IncludeExclude.ALL)
+
     def Filter(self, all_cats):
         """
         For a given list of all possible categories, start with those that
@@ -191,11 +210,21 @@ class SiteSettings(object):
         rig_img_url=%(rig_base)s?album=%(album)s&img=%(img)s
     - rig_thumb_url(string): Declares how to generate an IMG reference to a give RIG image.
         rig_thumb_url=%(rig_base)s?th=&album=%(album)s&img=%(img)s&sz=%(size)s&q=75
+    - rig_img_dims(string): Attributes added to the IMG references of JPEG and PNG
+        images with their dimensions, read from the image headers. Default is
+        empty, which adds nothing.
+        rig_img_dims=width="%(width)s" height="%(height)s"
     - header_img_url (str): Full URL for the header image. If not present, the default one from
       the theme will be used.
     - header_img_height (int): The height of the header_img. Default is 185.
     - cat_filter(IncludeExclude): An inclusion-exclusion list.
     - img_gen_script (string): An optional script to execute to generate images
+    - img_gen_server (bool): When true, img_gen_script is started once and receives
+                     the image requests as JSON lines. Default is false, which
+                     executes the script for each image.
+    - img_gen_workers (int): Number of img_gen_script executed concurrently for the
+                     images of a post, when img_gen_server is false. Default is 1,
+                     which executes the script for one image after another.
     - num_item_page (int): Number of items per HTML page. Default is 20. Must be > 0.
     - num_item_atom (int): Number of items in ATOM feed. Default is 20. -1 for all.
     - html_header (string): Path to HTML header. Default is "html_header.html"
@@ -225,6 +254,29 @@ class SiteSettings(object):
                     the generic "all recents items" page.
     - encoding(str): Encoding of Izu/HTML text files. Default is Latin-1 (ISO-8859-1).
                      Can be overridden per source.
+    - num_parse_workers(int): Number of sources to parse concurrently. Default is 1,
+                     which parses sources one after another.
+    - content_digest(bool): When true, source files are identified by a digest of
+                     their content rather than by their modification time, so
+                     that touching a file does not invalidate its cached output.
+    - spill_size(int): Izu sections which HTML reaches this number of bytes are
+                     written to files of the cache directory, which the cache
+                     refers to instead of storing their HTML. This does not
+                     bound the memory used by a post: the spilled sections are
+                     read back whole to fill the entry template and the page.
+                     Default is 0, which never spills.
+    - unicode_text(bool): When true, the content of the items is processed as
+                     unicode and only encoded when written, instead of being
+                     converted to ISO-8859-1 when read. The output is the same.
+    - img_manifest(bool): When true, the images found in each album are kept in
+                     the cache and only looked for again when the album
+                     directory changes.
+    - compile_templates(bool): When true, the theme templates are compiled to
+                     Python functions once per run instead of being parsed and
+                     interpreted for each page. The output is the same.
+    - skip_unchanged(bool): When true, the site is skipped before parsing its
+                     sources if their directories and izu/html files did not
+                     change since the last complete run. See SourceReaderBase.Stamp.
     """
     def __init__(self,
                  public_name="",
@@ -238,11 +290,14 @@ class SiteSettings(object):
                  rig_img_url="%(rig_base)s?album=%(album)s&img=%(img)s",
                  rig_thumb_url="%(rig_base)s?th=&album=%(album)s&img=%(img)s&sz=%(size)s&q=75",
                  rig_img_size=512,
+                 rig_img_dims="",
                  header_img_url="",
                  header_img_height=185,
                  tracking_code="",
                  cat_filter=IncludeExclude(IncludeExclude.ALL, None),
                  img_gen_script="",
+                 img_gen_server=False,
+                 img_gen_workers=1,
                  num_item_page=DEFAULT_ITEMS_PER_PAGE,
                  num_item_atom=DEFAULT_ITEMS_PER_PAGE,
                  html_header="html_header.html",
@@ -266,7 +321,14 @@ class SiteSettings(object):
                  youtube_sy="385",
                  enable_sharing=False,
                  index_exclude=IncludeExclude(IncludeExclude.ALL, None),
-                 encoding="iso-8859-1"
+                 encoding="iso-8859-1",
+                 num_parse_workers=1,
+                 content_digest=False,
+                 spill_size=0,
+                 unicode_text=False,
+                 img_manifest=False,
+                 compile_templates=False,
+                 skip_unchanged=False
                  ):
         # Note: this is *always* called using the default values defined in the
         # constructor. If you need to change a setting loaded from an RC file,
@@ -282,11 +344,14 @@ class SiteSettings(object):
         self.rig_img_url = rig_img_url
         self.rig_thumb_url = rig_thumb_url
         self.rig_img_size = int(rig_img_size)
+        self.rig_img_dims = rig_img_dims
         self.header_img_url = header_img_url
         self.header_img_height = int(header_img_height)
         self.tracking_code = tracking_code
         self.cat_filter = cat_filter
         self.img_gen_script = img_gen_script
+        self.img_gen_server = self.ParseBool(img_gen_server)
+        self.img_gen_workers = int(img_gen_workers)
         self.num_item_page = int(num_item_page)
         self.num_item_atom = int(num_item_atom)
         self.html_header = html_header
@@ -310,6 +375,13 @@ class SiteSettings(object):
         self.enable_sharing = self.ParseBool(enable_sharing)
         self.index_exclude = index_exclude;
         self.encoding = encoding
+        self.num_parse_workers = int(num_parse_workers)
+        self.content_digest = self.ParseBool(content_digest)
+        self.spill_size = int(spill_size)
+        self.unicode_text = self.ParseBool(unicode_text)
+        self.img_manifest = self.ParseBool(img_manifest)
+        self.compile_templates = self.ParseBool(compile_templates)
+        self.skip_unchanged = self.ParseBool(skip_unchanged)
 
     def AsDict(self):
         """
@@ -452,6 +524,8 @@ class SitesSettings(SettingsBase):
         type_class = { "dir":  SourceDirReader,  "dirs":  SourceDirReader,
                        "file": SourceFileReader, "files": SourceFileReader,
                        "blog": SourceBlogReader,
+                       "archive": SourceArchiveReader,
+                       "catalog": SourceCatalogReader,
                       }
         source_settings_keys = SourceSettings().KnownKeys()
         for k, value in vars.iteritems():
@@ -0,0 +1,339 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Run-scoped buffers of source files.
+
+A source file is typically accessed several times while an item is
+generated: the izu header is parsed to find the encoding and the
+categories, then the whole file is rendered. Each access used to open,
+read and decode the file again.
+
+SourceBuffer reads a file once and keeps its decoded lines for each
+encoding it is requested with. Get() returns the buffer of a file, shared
+by all users for the duration of the run. A buffer is discarded when the
+file changes on disk, and only the most recently used buffers are kept.
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import codecs
+import os
+import re
+import sha
+import threading
+from StringIO import StringIO
+
+from rig import stats
+from rig.parser.dir_parser import RelPath
+
+# Maximum number of buffers kept by Get()
+MAX_BUFFERS = 16
+
+
+#------------------------
+class SourceBuffer(object):
+    """
+    The content of one source file, read once.
+
+    The raw data is read on first use. The decoded lines are computed
+    once per encoding and follow the same rules as a file opened with
+    codecs.open(filename, "rU", encoding, errors="xmlcharrefreplace"):
+    - with an encoding, lines are split on unicode line boundaries and
+      keep their original end-of-line terminators.
+    - without encoding, end-of-lines are converted to \\n (universal
+      end-of-lines.)
+    """
+    def __init__(self, abs_path):
+        self._abs_path = abs_path
+        self._data = None
+        self._digest = None
+        self._lines = {}
+
+    def Data(self):
+        """
+        Returns the raw content of the file as a byte string.
+        Will raise an IOError if the file cannot be read.
+        """
+        if self._data is None:
+            _Count("Open")
+            f = file(self._abs_path, "rb")
+            try:
+                self._data = f.read()
+            finally:
+                f.close()
+        return self._data
+
+    def IsLoaded(self):
+        """
+        Returns true if the raw content of the file has already been read.
+        """
+        return self._data is not None
+
+    def Digest(self):
+        """
+        Returns the hex SHA1 digest of the raw content of the file.
+        """
+        if self._digest is None:
+            self._digest = sha.new(self.Data()).hexdigest()
+        return self._digest
+
+    def Lines(self, encoding):
+        """
+        Returns the list of lines of the file decoded using the given
+        encoding. The lines include their end-of-line terminators.
+        Lines are unicode strings if there's an encoding, str otherwise.
+        """
+        lines = self._lines.get(encoding)
+        if lines is None:
+            data = self.Data()
+            if encoding:
+                lines = data.decode(encoding, "xmlcharrefreplace").splitlines(True)
+            else:
+                data = data.replace("\r\n", "\n").replace("\r", "\n")
+                lines = data.splitlines(True)
+            self._lines[encoding] = lines
+        return lines
+
+    def Read(self, encoding):
+        """
+        Returns the whole content of the file decoded using the given encoding.
+        """
+        _Count("Read")
+        return "".join(self.Lines(encoding))
+
+    def Open(self, encoding):
+        """
+        Returns a read-only file-like object on the lines of the file
+        decoded using the given encoding. It only supports readline().
+        """
+        _Count("Read")
+        return _LineReader(self.Lines(encoding))
+
+    def HeaderLine(self, encoding):
+        """
+        Returns the izu header of the file: its first 2 lines merged as a
+        single ISO-8859-1 string without end-of-line terminators.
+        See IzuParser.ParseFileFirstLine.
+        """
+        _Count("Read")
+        if encoding and not encoding in self._lines:
+            # Only decode the header: the rest of the file may not be valid
+            # in this encoding when the header has an izu:encoding tag.
+            f = codecs.getreader(encoding)(StringIO(self.Data()), "xmlcharrefreplace")
+            line = f.readline() + f.readline()
+        else:
+            line = "".join(self.Lines(encoding)[:2])
+        return _JoinHeader(line)
+
+
+#------------------------
+class _LineReader(object):
+    """
+    A minimal file-like object that returns a list of lines.
+    """
+    def __init__(self, lines):
+        self._lines = lines
+        self._index = 0
+
+    def readline(self):
+        if self._index >= len(self._lines):
+            return ""
+        line = self._lines[self._index]
+        self._index += 1
+        return line
+
+    def close(self):
+        self._lines = []
+
+
+#------------------------
+_BUFFERS = {}    # abs_path => (file stamp, SourceBuffer)
+_RECENT = []     # abs_path, most recently used last
+_LOCK = threading.Lock()
+
+def Get(filename):
+    """
+    Returns the SourceBuffer for the given file name, which can be a
+    string or a RelPath.
+
+    The same buffer is returned as long as the file does not change on disk.
+    Will raise an IOError if the file does not exist.
+    """
+    if isinstance(filename, RelPath):
+        filename = filename.abs_path
+    try:
+        st = os.stat(filename)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, filename)
+    stamp = (st.st_ino, st.st_size, st.st_mtime)
+
+    _LOCK.acquire()
+    try:
+        entry = _BUFFERS.get(filename)
+        if entry is None or entry[0] != stamp:
+            entry = _BUFFERS[filename] = (stamp, SourceBuffer(filename))
+        if filename in _RECENT:
+            _RECENT.remove(filename)
+        _RECENT.append(filename)
+        while len(_RECENT) > MAX_BUFFERS:
+            del _BUFFERS[_RECENT.pop(0)]
+        return entry[1]
+    finally:
+        _LOCK.release()
+
+def ReadRange(filename, offset, length):
+    """
+    Returns length bytes of the file starting at offset, as a byte string.
+
+    This uses the buffer of the file if it is already loaded, otherwise
+    only the range is read and the file is not kept, e.g. to read one
+    entry of a large file without loading all of it.
+    Will raise an IOError if the file cannot be read.
+    """
+    filename, buffer = _Loaded(filename)
+    _Count("Read")
+    if buffer:
+        return buffer.Data()[offset:offset + length]
+
+    _Count("Open")
+    f = file(filename, "rb")
+    try:
+        f.seek(offset)
+        return f.read(length)
+    finally:
+        f.close()
+
+def HeaderLine(filename, encoding):
+    """
+    Returns the izu header of the file, like SourceBuffer.HeaderLine.
+
+    This uses the buffer of the file if it is already loaded, otherwise
+    only the first 2 lines are read and the file is not kept, e.g. to check
+    the categories of a file without loading all of it.
+    Will raise an IOError if the file cannot be read.
+    """
+    filename, buffer = _Loaded(filename)
+    if buffer:
+        return buffer.HeaderLine(encoding)
+
+    _Count("Open")
+    _Count("Read")
+    if encoding:
+        f = codecs.getreader(encoding)(file(filename, "rb"), "xmlcharrefreplace")
+    else:
+        f = file(filename, "rU")
+    try:
+        line = f.readline() + f.readline()
+    finally:
+        f.close()
+    return _JoinHeader(line)
+
+def _Loaded(filename):
+    """
+    Returns a tuple (file name, buffer) where buffer is the SourceBuffer of
+    the file if it is already loaded and the file did not change, or None.
+    Will raise an IOError if the file does not exist.
+    """
+    if isinstance(filename, RelPath):
+        filename = filename.abs_path
+    try:
+        st = os.stat(filename)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, filename)
+    stamp = (st.st_ino, st.st_size, st.st_mtime)
+
+    _LOCK.acquire()
+    try:
+        entry = _BUFFERS.get(filename)
+    finally:
+        _LOCK.release()
+
+    if entry is not None and entry[0] == stamp and entry[1].IsLoaded():
+        return filename, entry[1]
+    return filename, None
+
+def _JoinHeader(line):
+    """
+    Returns the first 2 lines of a file as a single ISO-8859-1 string
+    without end-of-line terminators.
+    """
+    if isinstance(line, unicode):
+        # Internally we only process ISO-8859-1 and replace
+        # unknown entities by their XML hexa encoding
+        line = line.encode("iso-8859-1", "xmlcharrefreplace")
+    return re.sub("[\r\n]", "", line)
+
+def Clear():
+    """
+    Discards all the buffers.
+    """
+    _LOCK.acquire()
+    try:
+        _BUFFERS.clear()
+        del _RECENT[:]
+    finally:
+        _LOCK.release()
+
+
+#------------------------
+_COUNTERS = threading.local()
+
+def _Count(name):
+    """
+    Counts a file open or read in the run's stats and in the counters of
+    the current thread, see Counters().
+    """
+    stats.Start("1.0 Source " + name).Stop()
+    setattr(_COUNTERS, name, getattr(_COUNTERS, name, 0) + 1)
+
+def Counters():
+    """
+    Returns the number of (opens, reads) done by the current thread since
+    the start of the run. The difference between two calls gives the
+    opens and reads of one item, see SiteBase.GenerateItems.
+    """
+    return getattr(_COUNTERS, "Open", 0), getattr(_COUNTERS, "Read", 0)
+
+
+#------------------------
+_RE_NON_LATIN1 = re.compile(u"[^\x00-\xff]")
+
+def XmlCharRefs(text):
+    """
+    Replaces the characters of a unicode string which are not in ISO-8859-1
+    by their XML character reference, as encoding it to ISO-8859-1 with
+    errors="xmlcharrefreplace" does, but keeps the string unicode.
+
+    This is what the unicode text pipeline uses instead of the ISO-8859-1
+    round-trip. Strings without such characters are returned as-is.
+    """
+    if _RE_NON_LATIN1.search(text):
+        text = _RE_NON_LATIN1.sub(lambda m: u"&#%d;" % ord(m.group()), text)
+    return text
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
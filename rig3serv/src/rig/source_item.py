@@ -22,6 +22,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 __author__ = "ralfoide at gmail com"
 
+import sha
+
 from rig.hashable import Hashable
 
 
@@ -132,18 +134,23 @@ class SourceDir(SourceItem):
     - date (datetime): Date of the directory (i.e. most recent item)
     - rel_dir (RelDir): absolute+relative source directory
     - all_files (list [string]): All interesting files in this directory
+    - content_digest (str): Optional digest of the content of the directory,
+        e.g. from a catalog. When set, it identifies the item instead of the
+        real path of the directory, which is then not accessed.
     """
-    def __init__(self, date, rel_dir, all_files, source_settings):
+    def __init__(self, date, rel_dir, all_files, source_settings, content_digest=None):
         super(SourceDir, self).__init__(date, source_settings)
         self.rel_dir = rel_dir
         self.all_files = all_files
+        self.content_digest = content_digest
 
     def __eq__(self, rhs):
         if not super(SourceDir, self).__eq__(rhs):
             return False
         return (isinstance(rhs, SourceDir) and
                 self.rel_dir == rhs.rel_dir and
-                self.all_files == rhs.all_files)
+                self.all_files == rhs.all_files and
+                self.content_digest == rhs.content_digest)
 
     def RigHash(self, md=None):
         """
@@ -158,21 +165,31 @@ class SourceDir(SourceItem):
     def ContentHash(self, md=None):
         """
         Computes a hash that only depends on the real path of the directory
-        and its inner file list.
+        and its inner file list, or on the content digest when there's one.
         """
         md = super(SourceDir, self).ContentHash(md)
-        md = self.UpdateHash(md, self.rel_dir.realpath())
+        if self.content_digest:
+            md = self.UpdateHash(md, self.rel_dir.abs_path)
+            md = self.UpdateHash(md, self.content_digest)
+        else:
+            md = self.UpdateHash(md, self.rel_dir.realpath())
         for f in self.all_files:
             md = self.UpdateHash(md, f)
         return md
 
     def __repr__(self):
-        return "<%s (%s) %s, %s, %s, %s>" % (self.__class__.__name__,
-                                             self.date,
-                                             self.rel_dir,
-                                             self.all_files,
-                                             self.categories,
-                                             self.source_settings)
+        # The repr is used in cache keys. When there's a content digest,
+        # the date (typically the modification time of the directory) is
+        # left out so that touching a file keeps its cached output.
+        r = "<%s (%s) %s, %s, %s, %s" % (self.__class__.__name__,
+                                         self.content_digest and "-" or self.date,
+                                         self.rel_dir,
+                                         self.all_files,
+                                         self.categories,
+                                         self.source_settings)
+        if self.content_digest:
+            r += ", #%s" % self.content_digest
+        return r + ">"
 
     def PrettyRepr(self):
         """
@@ -191,16 +208,21 @@ class SourceFile(SourceItem):
     - date (datetime): Date of the file
     - rel_file (RelFile): absolute+relative source file
     - source_settings (not optional)
+    - content_digest (str): Optional digest of the content of the file,
+        e.g. from a catalog. When set, it identifies the item instead of the
+        real path of the file, which is then not accessed.
     """
-    def __init__(self, date, rel_file, source_settings):
+    def __init__(self, date, rel_file, source_settings, content_digest=None):
         super(SourceFile, self).__init__(date, source_settings)
         self.rel_file = rel_file
+        self.content_digest = content_digest
 
     def __eq__(self, rhs):
         if not super(SourceFile, self).__eq__(rhs):
             return False
         return (isinstance(rhs, SourceFile) and
-                self.rel_file == rhs.rel_file)
+                self.rel_file == rhs.rel_file and
+                self.content_digest == rhs.content_digest)
 
     def RigHash(self, md=None):
         """
@@ -214,18 +236,26 @@ class SourceFile(SourceItem):
 
     def ContentHash(self, md=None):
         """
-        Computes a hash that only depends on the real path of the file.
+        Computes a hash that only depends on the real path of the file,
+        or on the content digest when there's one.
         """
         md = super(SourceFile, self).ContentHash(md)
-        md = self.UpdateHash(md, self.rel_file.realpath())
+        if self.content_digest:
+            md = self.UpdateHash(md, self.rel_file.abs_path)
+            md = self.UpdateHash(md, self.content_digest)
+        else:
+            md = self.UpdateHash(md, self.rel_file.realpath())
         return md
 
     def __repr__(self):
-        return "<%s (%s) %s, %s, %s>" % (self.__class__.__name__,
-                                         self.date,
-                                         self.rel_file,
-                                         self.categories,
-                                         self.source_settings)
+        r = "<%s (%s) %s, %s, %s" % (self.__class__.__name__,
+                                     self.content_digest and "-" or self.date,
+                                     self.rel_file,
+                                     self.categories,
+                                     self.source_settings)
+        if self.content_digest:
+            r += ", #%s" % self.content_digest
+        return r + ">"
 
     def PrettyRepr(self):
         """
@@ -243,14 +273,51 @@ class SourceContent(SourceItem):
     Parameters:
     - date (datetime): Date of the file
     - rel_file (RelFile): absolute+relative source file
+    - title (str): Title of the entry
+    - content (str): The Izu content of the entry, or None if content_ref is used.
+    - tags (dict): Izu tags of the entry
     - source_settings (not optional)
+    - content_ref: Optional reference on the content in the source file. It must
+        have a Read() method that returns the content, and be Hashable.
+        When set, the content is not kept in memory and is only read when
+        GetContent() is called.
+    - header_tags (bool): True if the tags only come from the header of the
+        content, in which case the izu tags of the whole content are added
+        to them when it is rendered. By default the tags are final.
     """
-    def __init__(self, date, rel_file, title, content, tags, source_settings):
+    def __init__(self, date, rel_file, title, content, tags, source_settings, content_ref=None,
+                 header_tags=False):
         super(SourceContent, self).__init__(date, source_settings)
         self.rel_file = rel_file
         self.tags = tags
+        self.header_tags = header_tags
         self.title = title
         self.content = content
+        self.content_ref = content_ref
+        self._content_digest = None
+
+    def GetContent(self):
+        """
+        Returns the content of the entry, reading it from the source file
+        if the item only holds a content_ref.
+        """
+        if self.content is None and self.content_ref is not None:
+            return self.content_ref.Read()
+        return self.content
+
+    def ContentDigest(self):
+        """
+        Returns a hex digest that identifies the content of the entry.
+
+        This uses the content_ref's digest when there's one, so the content
+        need not be read. Otherwise the in-memory content is hashed.
+        """
+        if self.content_ref is not None:
+            return self.content_ref.digest
+        digest = self._content_digest
+        if digest is None:
+            digest = self._content_digest = sha.new(self.content or "").hexdigest()
+        return digest
 
     def __eq__(self, rhs):
         if not super(SourceContent, self).__eq__(rhs):
@@ -259,6 +326,8 @@ class SourceContent(SourceItem):
                     self.tags == rhs.tags  and
                     self.title == rhs.title and
                     self.content == rhs.content and
+                    self.content_ref == rhs.content_ref and
+                    self.header_tags == rhs.header_tags and
                     self.rel_file == rhs.rel_file)
 
     def RigHash(self, md=None):
@@ -273,20 +342,32 @@ class SourceContent(SourceItem):
     def ContentHash(self, md=None):
         """
         Computes a hash that only depends on the content.
+        When the item has a content_ref, the reference is hashed instead
+        of reading the content.
+
+        Note that this does not depend on the timestamp of the source file,
+        which is shared with other entries.
         """
         md = super(SourceContent, self).ContentHash(md)
         md = self.UpdateHash(md, self.tags)
         md = self.UpdateHash(md, self.title)
-        md = self.UpdateHash(md, self.content)
+        if self.content_ref is not None:
+            md = self.UpdateHash(md, self.content_ref)
+        else:
+            md = self.UpdateHash(md, self.ContentDigest())
         md = self.UpdateHash(md, self.rel_file.realpath())
         return md
 
     def __repr__(self):
-        return "<%s (%s) %s, %s, %s>" % (self.__class__.__name__,
-                                         self.date,
-                                         self.title,
-                                         self.tags,
-                                         self.source_settings)
+        # The content digest is part of the representation since the repr
+        # is what the cache uses to compute keys.
+        return "<%s (%s) %s, %s%s, %s, #%s>" % (self.__class__.__name__,
+                                                self.date,
+                                                self.title,
+                                                self.tags,
+                                                self.header_tags and " +content tags" or "",
+                                                self.source_settings,
+                                                self.ContentDigest())
 
     def PrettyRepr(self):
         """
@@ -24,14 +24,24 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 __author__ = "ralfoide at gmail com"
 
-import codecs
 import os
+import posixpath
 import re
+import sha
+import tarfile
+import threading
+import time
+import zipfile
 import zlib
 from datetime import datetime
 
+from rig import source_buffer
+from rig import stats
+from rig.cache import Cache
+from rig.catalog import Catalog
+from rig.hashable import Hashable
 from rig.source_item import SourceDir, SourceFile, SourceContent
-from rig.parser.dir_parser import DirParser, RelFile, PathTimestamp
+from rig.parser.dir_parser import RelDir, RelFile, PathTimestamp, TreeStamp, SharedParse
 from rig.parser.izu_parser import IzuParser
 
 
@@ -45,6 +55,10 @@ class SourceReaderBase(object):
     path. The settings are used for specific configuration, for example
     filtering patterns.
     """
+
+    # Files which changes are tracked by Stamp()
+    STAMP_FILES = re.compile(r"\.(?:izu|html)$")
+
     def __init__(self, log, site_settings, source_settings, path):
         self._log = log
         self._path = path
@@ -68,6 +82,20 @@ class SourceReaderBase(object):
         """
         raise NotImplementedError("Must be derived by subclasses")
 
+    def Stamp(self):
+        """
+        Returns a cheap stamp of the source that changes when the source
+        changes, without parsing it. The site uses it to skip a run when
+        none of its sources changed, see the skip_unchanged setting.
+
+        The default is a TreeStamp() of the source path with the izu and
+        html files as item files: it covers the directories and the
+        content files of the entries, or the file itself for archives and
+        catalogs. Images rewritten in place are not detected.
+        Derived classes can override this if needed.
+        """
+        return TreeStamp(self._path, self.STAMP_FILES)
+
     def __eq__(self, rhs):
         """
         Two readers are equal if they have the same type, the same path
@@ -110,6 +138,7 @@ class SourceBlogReader(SourceReaderBase):
         self._dir_pattern     = site_settings and site_settings.blog_dir_pattern     or self.DIR_PATTERN
         self._dir_valid_files = site_settings and site_settings.blog_dir_valid_files or self.DIR_VALID_FILES
         self._file_pattern    = site_settings and site_settings.blog_file_pattern    or self.FILE_PATTERN
+        self._index_caches = {}
 
     def Parse(self, dest_dir):
         """
@@ -125,8 +154,9 @@ class SourceBlogReader(SourceReaderBase):
 
         Returns a list of SourceItem.
         """
-        tree = DirParser(self._log).Parse(os.path.realpath(self.GetPath()),
-                                          os.path.realpath(dest_dir))
+        tree = SharedParse(self._log,
+                           os.path.realpath(self.GetPath()),
+                           os.path.realpath(dest_dir))
 
         dir_pattern = re.compile(self._dir_pattern)
         dir_valid_files = re.compile(self._dir_valid_files)
@@ -181,31 +211,42 @@ class SourceBlogReader(SourceReaderBase):
     _RE_INTER_IZU_LINK = re.compile(r"(?<!\[)\[(?P<label>[^\|\]]+)\|(?P<page>[^#:|\]]+)#s:(?P<date>[0-9]{8})(?::(?P<title>[^\]]+))?\]")
 
 
+    # Bump this when the format of the persisted .blog.izu index changes.
+    _OLD_IZU_INDEX_VERSION = 2
+
     def _ParseOldIzu(self, rel_file, cat, items):
         """
-        """
-
-        SEP = "----"
+        Parses a legacy Izumi .blog.izu file, which contains many entries
+        separated by [s:YYYYMMDD:title] headers.
 
+        The content of the entries is not loaded here. Instead an index of
+        the byte offset and length of each entry is built (and persisted in
+        the cache dir when there's one) and each SourceContent only carries
+        an OldIzuContentRef that reads the entry on demand.
+        """
         if self._source_settings.encoding:
             encoding = self._source_settings.encoding
         else:
             encoding = self._site_settings.encoding
 
-        # First line must have some izu tags
-        tags = IzuParser(self._log, None, None).ParseFileFirstLine(rel_file.abs_path, encoding)
-
-        # If we find an encoding tag, reparse the tags using that encoding
-        if "encoding" in tags:
-            tags = IzuParser(self._log, None, None).ParseFileFirstLine(rel_file.abs_path, encoding)
+        st = os.stat(rel_file.abs_path)
+        file_stamp = (st.st_size, st.st_mtime)
+
+        index_key = [ "old_izu_index",
+                      self._OLD_IZU_INDEX_VERSION,
+                      rel_file.realpath(),
+                      file_stamp,
+                      encoding ]
+        index_cache = self._IndexCache("old_izu_index")
+        if index_cache:
+            index = index_cache.Compute(
+                            index_key,
+                            lambda: self._IndexOldIzu(rel_file, encoding),
+                            stat_prefix="1.0 Blog Index")
+        else:
+            index = self._IndexOldIzu(rel_file, encoding)
 
-        f = codecs.open(rel_file.abs_path, mode="rU",
-                        encoding=encoding,
-                        errors="xmlcharrefreplace")
-        # Skip to the first section
-        for line in f:
-            if line.strip() == SEP:
-                break
+        tags = dict(index["tags"])
 
         # Use the category based on the filename if there's no override in the file tags
         if not "cat" in tags:
@@ -215,92 +256,126 @@ class SourceBlogReader(SourceReaderBase):
         if izumi_base_url and not izumi_base_url.endswith("/"):
             izumi_base_url += "/"
 
-        content = None
-        date = None
-        title = None
-        for line in f:
-            if isinstance(line, unicode):
-                # Internally we only process ISO-8859-1 and replace
-                # unknown entities by their XML hexa encoding
-                line = line.encode("iso-8859-1", "xmlcharrefreplace")
-
-            if line.strip() == SEP:
-                continue
-
-            elif line.startswith("[s:"):
-                # Flush content
-                if content:
-                    # Inject date in tags
-                    tags = dict(tags)
-                    tags["date"] = date
-                    item = SourceContent(date, rel_file, title, content, tags, self._source_settings)
-                    items.append(item)
-                    self._log.Debug("[%s] Append item '%s'",
-                                    self._site_settings and self._site_settings.public_name or "[Unnamed Site]",
-                                    item)
-
-                content = ""
-                date = None
-                title = None
-
-                m = self._RE_OLD_IZU_HEADER.match(line)
-                if m:
-                    date = datetime(
-                                 int(m.group("year")),
-                                 int(m.group("month")),
-                                 int(m.group("day")))
-                    title = m.group("title")
-
-            elif date and title:
-                if "#s" in line and not "|#s" in line:
-                    pass
-                if izumi_base_url:
-                    # Convert old inter-izumi links into hard URLs (e.g. only links
-                    # from one izumi page to another. This does not affect intra-izumi
-                    # links inside the same category, as those will be supported by
-                    # rig3 directly.)
-                    line = self._RE_INTER_IZU_LINK.sub(
-                               lambda m: self._ConvertInterIzuLinks(m, izumi_base_url), line)
-
-                content += line
-
-        if content:
+        for date, title, offset, length, digest in index["entries"]:
+            ref = OldIzuContentRef(rel_file.abs_path,
+                                   offset,
+                                   length,
+                                   encoding,
+                                   izumi_base_url,
+                                   digest)
             # Inject date in tags
-            tags = dict(tags)
-            tags["date"] = date
-            # Flush content
-            item = SourceContent(date, rel_file, title, content, tags, self._source_settings)
+            item_tags = dict(tags)
+            item_tags["date"] = date
+            item = SourceContent(date, rel_file, title, None, item_tags, self._source_settings,
+                                 content_ref=ref)
             items.append(item)
             self._log.Debug("[%s] Append item '%s'",
                             self._site_settings and self._site_settings.public_name or "[Unnamed Site]",
                             item)
 
-        f.close()
+    def _IndexOldIzu(self, rel_file, encoding):
+        """
+        Scans a legacy .blog.izu file once and returns its index as a dict:
+        - "tags": the izu tags from the first line of the file.
+        - "entries": a list of (date, title, offset, length, digest) for each entry.
+          Offset and length are in bytes in the file and exclude the header line.
+          Digest is the SHA1 hex digest of these bytes.
+          Entries with an invalid header or no content are skipped.
+
+        The file is read line by line and not kept in the source buffers: the
+        entries are only read later, by range, see OldIzuContentRef.
+        """
+        SEP = OldIzuContentRef.SEP
+
+        # First line must have some izu tags
+        tags = IzuParser(self._log, None, None).ParseFileFirstLine(rel_file.abs_path, encoding,
+                                                                   keep=False)
 
-    def _ConvertInterIzuLinks(self, m, izumi_base_url):
-        label = m.group("label")
-        date  = m.group("date")
-        title = m.group("title")
-        page  = m.group("page")
-
-        # Compute the same key than RBlog::BlogEntryKey from izumi.sourforge.net
-        # see http://izumi.cvs.sourceforge.net/viewvc/izumi/izumi/src/RBlog.php?view=markup&pathrev=HEAD
-        # at line 348.
-        if title:
-            key = title.lower()
-            key = re.sub(r"[ \-_=+\[\]{};:'\",./<>?`~!@#$%^&*()\\|]", "_", key)
-            key = re.sub(r"[^0123456789abcdefghijklmnopqrstuvwxyz_]", "", key)
-            key = date + "_" + key
-            if len(key) > 32:
-                # shorten with a crc32
-                # The adler32 CRC is returned as an int and can thus "seem" negative
-                # convert to its true long 64-bit value, always positive
-                crc = zlib.adler32(date + title) & 0x0FFffFFffL
-                key = "%s_%8x" % (key[0:23], crc)
-        else:
-            key = date
+        # If we find an encoding tag, reparse the tags using that encoding
+        if "encoding" in tags:
+            tags = IzuParser(self._log, None, None).ParseFileFirstLine(rel_file.abs_path, encoding,
+                                                                       keep=False)
+
+        entries = []
+        f = file(rel_file.abs_path, "rb")
+        try:
+            offset = 0
+
+            # Skip to the first section
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                if line.strip() == SEP:
+                    break
+
+            curr = None  # [ date, title, offset, has_content, sha ]
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                pos = offset
+                offset += len(line)
+
+                if line.strip() == SEP:
+                    continue
+
+                elif line.startswith("[s:"):
+                    # Flush current entry
+                    if curr and curr[3]:
+                        entries.append((curr[0], curr[1], curr[2], pos - curr[2],
+                                        curr[4].hexdigest()))
+                    curr = None
+
+                    if encoding:
+                        # Internally we only process ISO-8859-1 and replace
+                        # unknown entities by their XML hexa encoding
+                        line = line.decode(encoding, "xmlcharrefreplace")
+                        line = line.encode("iso-8859-1", "xmlcharrefreplace")
+                    m = self._RE_OLD_IZU_HEADER.match(line)
+                    if m:
+                        date = datetime(
+                                     int(m.group("year")),
+                                     int(m.group("month")),
+                                     int(m.group("day")))
+                        title = m.group("title")
+                        if title:
+                            curr = [ date, title, offset, False, sha.new() ]
+
+                elif curr:
+                    curr[3] = True
+
+                if curr:
+                    curr[4].update(line)
+
+            if curr and curr[3]:
+                entries.append((curr[0], curr[1], curr[2], offset - curr[2],
+                                curr[4].hexdigest()))
+        finally:
+            f.close()
+
+        return { "tags": tags, "entries": entries }
 
-        return "[%s|%s%s?s=%s]" % (label, izumi_base_url, page, key)
+    def _IndexCache(self, name):
+        """
+        Returns the Cache used to persist source indexes, e.g. the .blog.izu
+        indexes. It lives in a directory with the given name under the
+        site's cache_dir.
+
+        Returns False if there's no cache_dir or the cache is disabled.
+        """
+        index_cache = self._index_caches.get(name)
+        if index_cache is None:
+            index_cache = self._index_caches[name] = False
+            cache_dir = self._site_settings and self._site_settings.cache_dir
+            if cache_dir and os.getenv("DISABLE_RIG3_CACHE") is None:
+                index_cache = self._index_caches[name] = Cache(self._log,
+                                                       os.path.join(cache_dir, name))
+        return index_cache
+
+    def _ConvertInterIzuLinks(self, m, izumi_base_url):
+        return _ConvertInterIzuLinks(m, izumi_base_url)
 
 
     # Utilities, overridable for unit tests
@@ -331,6 +406,535 @@ class SourceBlogReader(SourceReaderBase):
 
 
 
+#------------------------
+def _ConvertInterIzuLinks(m, izumi_base_url):
+    """
+    Converts an inter-izumi link match (see SourceBlogReader._RE_INTER_IZU_LINK)
+    into a hard link on the izumi_base_url.
+    """
+    label = m.group("label")
+    date  = m.group("date")
+    title = m.group("title")
+    page  = m.group("page")
+
+    # Compute the same key than RBlog::BlogEntryKey from izumi.sourforge.net
+    # see http://izumi.cvs.sourceforge.net/viewvc/izumi/izumi/src/RBlog.php?view=markup&pathrev=HEAD
+    # at line 348.
+    if title:
+        key = title.lower()
+        key = re.sub(r"[ \-_=+\[\]{};:'\",./<>?`~!@#$%^&*()\\|]", "_", key)
+        key = re.sub(r"[^0123456789abcdefghijklmnopqrstuvwxyz_]", "", key)
+        key = date + "_" + key
+        if len(key) > 32:
+            # shorten with a crc32
+            # The adler32 CRC is returned as an int and can thus "seem" negative
+            # convert to its true long 64-bit value, always positive
+            crc = zlib.adler32(date + title) & 0x0FFffFFffL
+            key = "%s_%8x" % (key[0:23], crc)
+    else:
+        key = date
+
+    return "[%s|%s%s?s=%s]" % (label, izumi_base_url, page, key)
+
+
+#------------------------
+class OldIzuContentRef(Hashable):
+    """
+    A reference on the content of one entry in a legacy .blog.izu file,
+    as created by SourceBlogReader._ParseOldIzu.
+
+    Only the byte offset and length of the entry are kept. The content is
+    read from the file on demand by Read(), which also removes separator
+    lines and converts inter-izumi links.
+
+    Parameters:
+    - abs_path (str): Absolute path of the .blog.izu file.
+    - offset, length (int): Byte range of the entry content in the file.
+    - encoding (str): Text encoding of the file.
+    - izumi_base_url (str): Base URL for inter-izumi links, or None.
+    - digest (str): SHA1 hex digest of the entry's bytes.
+
+    The identity of the reference (RigHash, equality) depends on the digest
+    and not on the file timestamp or the offset, so editing one entry of a
+    file does not change the identity of the other entries.
+    """
+    SEP = "----"
+
+    def __init__(self, abs_path, offset, length, encoding, izumi_base_url, digest):
+        super(OldIzuContentRef, self).__init__()
+        self.abs_path = abs_path
+        self.offset = offset
+        self.length = length
+        self.encoding = encoding
+        self.izumi_base_url = izumi_base_url
+        self.digest = digest
+
+    def Read(self):
+        """
+        Reads the content of the entry from the file.
+        Returns the content as an ISO-8859-1 string.
+        """
+        data = source_buffer.ReadRange(self.abs_path, self.offset, self.length)
+
+        if self.encoding:
+            data = data.decode(self.encoding, "xmlcharrefreplace")
+
+        content = []
+        for line in data.splitlines(True):
+            if isinstance(line, unicode):
+                # Internally we only process ISO-8859-1 and replace
+                # unknown entities by their XML hexa encoding
+                line = line.encode("iso-8859-1", "xmlcharrefreplace")
+
+            if line.strip() == self.SEP:
+                continue
+
+            if self.izumi_base_url:
+                # Convert old inter-izumi links into hard URLs (e.g. only links
+                # from one izumi page to another. This does not affect intra-izumi
+                # links inside the same category, as those will be supported by
+                # rig3 directly.)
+                line = SourceBlogReader._RE_INTER_IZU_LINK.sub(
+                           lambda m: _ConvertInterIzuLinks(m, self.izumi_base_url), line)
+
+            content.append(line)
+
+        return "".join(content)
+
+    def __eq__(self, rhs):
+        return (isinstance(rhs, OldIzuContentRef) and
+                self.abs_path == rhs.abs_path and
+                self.encoding == rhs.encoding and
+                self.izumi_base_url == rhs.izumi_base_url and
+                self.digest == rhs.digest)
+
+    def RigHash(self, md=None):
+        md = self.UpdateHash(md, self.abs_path)
+        md = self.UpdateHash(md, self.encoding)
+        md = self.UpdateHash(md, self.izumi_base_url)
+        md = self.UpdateHash(md, self.digest)
+        return md
+
+    def __repr__(self):
+        return "<%s %s @%d+%d #%s>" % (self.__class__.__name__,
+                                       self.abs_path,
+                                       self.offset,
+                                       self.length,
+                                       self.digest)
+
+
+#------------------------
+class SourceArchiveReader(SourceBlogReader):
+    """
+    Source reader for rig3 blog entries stored in a tar or zip archive.
+
+    Members are matched using the same rules as the SourceBlogReader: a
+    directory which name matches the "date title" pattern is one entry and
+    its content is its index.izu or index.html. Otherwise individual
+    "date title.izu" or "date title.html" files are entries.
+
+    The archive is never extracted. Each entry is a SourceContent which
+    content is read from the archive on demand via an ArchiveMemberRef.
+
+    The list of members is only read when the index of the archive is
+    built, which is persisted in the site's cache_dir. When the archive
+    has not changed, the index is used and the archive is only opened to
+    read the content of the entries.
+
+    Differences with the SourceBlogReader:
+    - The index only has the izu tags from the header of each member, i.e.
+      its first 2 lines. The items are created with header_tags=True so
+      that the izu tags further down an izu member are added once it is
+      rendered, like for izu files. HTML members only use their first line
+      in both cases.
+    - Images are not supported: the rigimg and riglink tags of an entry
+      resolve against its directory inside the archive, which does not
+      exist on disk, so they generate nothing.
+    - Compressed tar archives (.tar.gz, .tar.bz2) can't seek: reading a
+      member before the previous one read restarts the decompression from
+      the start of the archive. Use plain tar or zip files for archives
+      with many entries.
+    """
+
+    INDEX_FILES = [ "index.izu", "index.html" ]
+
+    # Bump this when the format of the persisted archive index changes.
+    _ARCHIVE_INDEX_VERSION = 1
+
+    def Parse(self, dest_dir):
+        """
+        Reads the list of members of the archive and generates new items.
+
+        Parameter:
+        - dest_dir (string): Destination directory. Unused.
+
+        Returns a list of SourceItem.
+        """
+        abs_path = os.path.realpath(self.GetPath())
+
+        if self._source_settings.encoding:
+            encoding = self._source_settings.encoding
+        else:
+            encoding = self._site_settings.encoding
+
+        archive = _GetArchive(abs_path)
+
+        index_key = [ "archive_index",
+                      self._ARCHIVE_INDEX_VERSION,
+                      abs_path,
+                      archive.Stamp(),
+                      encoding,
+                      [ getattr(p, "pattern", p) for p in (self._dir_pattern,
+                                                           self._dir_valid_files,
+                                                           self._file_pattern) ] ]
+        index_cache = self._IndexCache("archive_index")
+        if index_cache:
+            index = index_cache.Compute(
+                            index_key,
+                            lambda: self._IndexArchive(archive, encoding),
+                            stat_prefix="1.0 Archive Index")
+        else:
+            index = self._IndexArchive(archive, encoding)
+
+        items = []
+        for name, title, mtime, tags, item_encoding, digest in index:
+            ref = ArchiveMemberRef(abs_path, name, item_encoding, digest)
+            item = SourceContent(datetime.fromtimestamp(mtime),
+                                 RelFile(abs_path, name),
+                                 title,
+                                 None,
+                                 tags,
+                                 self._source_settings,
+                                 content_ref=ref,
+                                 header_tags=True)
+            items.append(item)
+            self._log.Debug("[%s] Append item '%s'",
+                            self._site_settings and self._site_settings.public_name or "[Unnamed Site]",
+                            item)
+        return items
+
+    def _IndexArchive(self, archive, encoding):
+        """
+        Matches the members of the archive and returns a list of
+        (name, title, mtime, tags, encoding, digest) for each entry:
+        - name: the archive member with the content of the entry.
+        - title: the directory or file name the date & title are extracted from.
+        - mtime: the most recent modification time of the entry's members.
+        - tags: the izu tags from the header of the member.
+        - encoding: the encoding of the member, which the header can override.
+        - digest: the SHA1 hex digest of the member's name, size, time and CRC.
+        """
+        dir_pattern = re.compile(self._dir_pattern)
+        dir_valid_files = re.compile(self._dir_valid_files)
+        file_pattern = re.compile(self._file_pattern)
+
+        # Group the file members by directory, keeping the archive order
+        dirs = {}
+        dir_names = []
+        for member in archive.Members():
+            d, f = posixpath.split(member[0])
+            if not d in dirs:
+                dirs[d] = []
+                dir_names.append(d)
+            dirs[d].append((f, ) + member)
+
+        entries = []
+        for d in dir_names:
+            files = dirs[d]
+            basename = posixpath.basename(d)
+
+            if dir_pattern.match(basename):
+                # This directory looks like one entry.
+                names = [f[0] for f in files]
+                if not [f for f in names if dir_valid_files.search(f)]:
+                    continue
+                index = [f for f in files if f[0] in self.INDEX_FILES]
+                if not index:
+                    self._log.Debug("[%s] No index for '%s' in '%s'",
+                                    self._site_settings and self._site_settings.public_name or "[Unnamed Site]",
+                                    d, self.GetPath())
+                    continue
+                index.sort(key=lambda f: self.INDEX_FILES.index(f[0]))
+                mtime = max([f[3] for f in files])
+                entries.append(self._IndexArchiveMember(archive, index[0], basename, mtime, encoding))
+            else:
+                # Not a directory entry, so check individual files to see if they
+                # qualify as individual entries
+                for f in files:
+                    if self.OLD_IZU_PATTERN.match(f[0]):
+                        self._log.Info("[%s] Ignore legacy blog file '%s' in archive '%s'",
+                                       self._site_settings and self._site_settings.public_name or "[Unnamed Site]",
+                                       f[1], self.GetPath())
+                    elif file_pattern.match(f[0]):
+                        title = os.path.splitext(f[0])[0]
+                        entries.append(self._IndexArchiveMember(archive, f, title, f[3], encoding))
+
+        return entries
+
+    def _IndexArchiveMember(self, archive, member, title, mtime, encoding):
+        """
+        Reads the header of an archive member and returns its index entry.
+        See _IndexArchive.
+        """
+        basename, name, size, member_mtime, crc = member
+
+        header = archive.ReadHeader(name)
+        tags = self._ParseArchiveHeader(basename, header, encoding, "replace")
+
+        # If we find an encoding tag, reparse the tags using that encoding
+        if "encoding" in tags:
+            encoding = tags["encoding"]
+            tags = self._ParseArchiveHeader(basename, header, encoding)
+
+        digest = sha.new(repr((name, size, member_mtime, crc))).hexdigest()
+        return (name, title, mtime, tags, encoding, digest)
+
+    def _ParseArchiveHeader(self, basename, header, encoding, errors="xmlcharrefreplace"):
+        """
+        Returns the izu tags of the header of a member, i.e. its 2 first lines.
+        Only the first line is used for HTML members.
+
+        The header is first parsed with errors="replace" since it may only
+        be valid once its own encoding tag is known.
+        """
+        if encoding:
+            # Internally we only process ISO-8859-1 and replace
+            # unknown entities by their XML hexa encoding
+            header = header.decode(encoding, errors)
+            header = header.encode("iso-8859-1", "xmlcharrefreplace")
+        if not basename.endswith(".html"):
+            header = re.sub("[\r\n]", "", header)
+        return IzuParser(self._log, None, None).ParseFirstLine(header)
+
+
+#------------------------
+class ArchiveMemberRef(Hashable):
+    """
+    A reference on the content of one member of a tar or zip archive,
+    as created by SourceArchiveReader.
+
+    Parameters:
+    - abs_path (str): Absolute path of the archive.
+    - name (str): Name of the member in the archive.
+    - encoding (str): Text encoding of the member.
+    - digest (str): SHA1 hex digest of the member's name, size, time and CRC.
+    """
+    def __init__(self, abs_path, name, encoding, digest):
+        super(ArchiveMemberRef, self).__init__()
+        self.abs_path = abs_path
+        self.name = name
+        self.encoding = encoding
+        self.digest = digest
+
+    def Read(self):
+        """
+        Reads the content of the member from the archive.
+        Returns the content as an ISO-8859-1 string.
+        """
+        data = _GetArchive(self.abs_path).Read(self.name)
+        if self.encoding:
+            # Internally we only process ISO-8859-1 and replace
+            # unknown entities by their XML hexa encoding
+            data = data.decode(self.encoding, "xmlcharrefreplace")
+            data = data.encode("iso-8859-1", "xmlcharrefreplace")
+        return data
+
+    def __eq__(self, rhs):
+        return (isinstance(rhs, ArchiveMemberRef) and
+                self.abs_path == rhs.abs_path and
+                self.name == rhs.name and
+                self.encoding == rhs.encoding and
+                self.digest == rhs.digest)
+
+    def RigHash(self, md=None):
+        md = self.UpdateHash(md, self.abs_path)
+        md = self.UpdateHash(md, self.name)
+        md = self.UpdateHash(md, self.encoding)
+        md = self.UpdateHash(md, self.digest)
+        return md
+
+    def __repr__(self):
+        return "<%s %s:%s #%s>" % (self.__class__.__name__,
+                                   self.abs_path,
+                                   self.name,
+                                   self.digest)
+
+
+#------------------------
+class _Archive(object):
+    """
+    A tar or zip archive and the list of its file members.
+
+    The archive is only opened and its list of members read on first use,
+    once per run. Tar archives can be compressed with gzip or bzip2.
+    """
+    def __init__(self, abs_path):
+        st = os.stat(abs_path)
+        self._abs_path = abs_path
+        self._stamp = (st.st_ino, st.st_size, st.st_mtime)
+        self._lock = threading.Lock()
+        self._members = None
+        self._zip = None
+        self._tar = None
+        self._tar_members = {}
+
+    def _Load(self):
+        """
+        Opens the archive and reads its list of members, if not done yet.
+        Must be called with the lock held.
+        """
+        if self._members is not None:
+            return
+        stats.Start("1.0 Archive Open").Stop()
+        members = []
+        if zipfile.is_zipfile(self._abs_path):
+            self._zip = zipfile.ZipFile(self._abs_path)
+            for info in self._zip.infolist():
+                if not info.filename.endswith("/"):
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    members.append((info.filename, info.file_size, mtime, info.CRC))
+        else:
+            self._tar = tarfile.open(self._abs_path)
+            for info in self._tar.getmembers():
+                if info.isfile():
+                    self._tar_members[info.name] = info
+                    members.append((info.name, info.size, info.mtime, info.chksum))
+        self._members = members
+
+    def Stamp(self):
+        """
+        Returns the (inode, size, mtime) of the archive file when it was opened.
+        """
+        return self._stamp
+
+    def Members(self):
+        """
+        Returns the list of (name, size, mtime, crc) of the file members,
+        in archive order. For tar archives the crc is the header checksum.
+        """
+        self._lock.acquire()
+        try:
+            self._Load()
+            return self._members
+        finally:
+            self._lock.release()
+
+    def _Open(self, name):
+        self._Load()
+        if self._zip:
+            return self._zip.open(name)
+        else:
+            return self._tar.extractfile(self._tar_members[name])
+
+    def Read(self, name):
+        """
+        Returns the content of a member as a byte string.
+        """
+        self._lock.acquire()
+        try:
+            f = self._Open(name)
+            try:
+                return f.read()
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+    def ReadHeader(self, name):
+        """
+        Returns the first 2 lines of a member as a byte string.
+        """
+        self._lock.acquire()
+        try:
+            f = self._Open(name)
+            try:
+                return f.readline() + f.readline()
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+
+_ARCHIVES = {}  # abs_path => _Archive
+_ARCHIVES_LOCK = threading.Lock()
+
+def _GetArchive(abs_path):
+    """
+    Returns the _Archive for the given path. The same _Archive is used for
+    the whole run, unless the archive changes, so its list of members is
+    only read once per run.
+    """
+    _ARCHIVES_LOCK.acquire()
+    try:
+        archive = _ARCHIVES.get(abs_path)
+        if archive is not None:
+            st = os.stat(abs_path)
+            if archive.Stamp() != (st.st_ino, st.st_size, st.st_mtime):
+                archive = None
+        if archive is None:
+            archive = _ARCHIVES[abs_path] = _Archive(abs_path)
+        return archive
+    finally:
+        _ARCHIVES_LOCK.release()
+
+
+#------------------------
+class SourceCatalogReader(SourceReaderBase):
+    """
+    Source reader for rig3 blog entries listed in an sqlite catalog.
+
+    The path is the one of the catalog file, see rig.catalog.Catalog for its
+    schema. Directory and file entries of the catalog become SourceDir and
+    SourceFile items identified by the catalog's content digest. The source
+    tree is not accessed until the content of the items is needed.
+    """
+    def __init__(self, log, site_settings, source_settings, path):
+        """
+        Constructs a new SourceCatalogReader.
+
+        Arguments:
+        - log (Log)
+        - site_settings (SiteSettings)
+        - path (String): The catalog file
+        - source_settings(SourceSettings)
+        """
+        super(SourceCatalogReader, self).__init__(log, site_settings, source_settings, path)
+
+    def Parse(self, dest_dir):
+        """
+        Reads the items from the catalog.
+
+        Parameter:
+        - dest_dir (string): Destination directory. Unused.
+
+        Returns a list of SourceItem.
+        """
+        catalog = Catalog(self._log, self.GetPath()).Open()
+        try:
+            base = catalog.GetBase()
+            rows = catalog.Items()
+        finally:
+            catalog.Close()
+
+        items = []
+        for path, kind, date, files, tags, digest in rows:
+            if kind == "dir":
+                item = SourceDir(date, RelDir(base, path), files, self._source_settings,
+                                 content_digest=digest)
+            elif kind == "file":
+                item = SourceFile(date, RelFile(base, path), self._source_settings,
+                                  content_digest=digest)
+            else:
+                self._log.Error("Unknown item kind '%s' for '%s' in catalog %s",
+                                kind, path, self.GetPath())
+                continue
+            items.append(item)
+            self._log.Debug("[%s] Append item '%s'",
+                            self._site_settings and self._site_settings.public_name or "[Unnamed Site]",
+                            item)
+        return items
+
+
 #------------------------
 class SourceDirReader(SourceReaderBase):
     """
@@ -374,10 +978,11 @@ class SourceDirReader(SourceReaderBase):
 
         Returns a list of SourceItem.
         """
-        tree = DirParser(self._log).Parse(os.path.realpath(self.GetPath()),
-                                          os.path.realpath(dest_dir),
-                                          file_pattern=self.VALID_FILES,
-                                          dir_pattern=self.DIR_PATTERN)
+        tree = SharedParse(self._log,
+                           os.path.realpath(self.GetPath()),
+                           os.path.realpath(dest_dir),
+                           file_pattern=self.VALID_FILES,
+                           dir_pattern=self.DIR_PATTERN)
 
         items = []
         for source_dir, dest_dir, all_files in tree.TraverseDirs():
@@ -481,9 +1086,10 @@ class SourceFileReader(SourceReaderBase):
 
         Returns a list of SourceItem.
         """
-        tree = DirParser(self._log).Parse(os.path.realpath(self.GetPath()),
-                                          os.path.realpath(dest_dir),
-                                          file_pattern=self.FILE_PATTERN)
+        tree = SharedParse(self._log,
+                           os.path.realpath(self.GetPath()),
+                           os.path.realpath(dest_dir),
+                           file_pattern=self.FILE_PATTERN)
 
         items = []
         for source_dir, dest_dir, all_files in tree.TraverseDirs():
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Spill files, to keep large text content on disk
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import sha
+import tempfile
+
+
+#------------------------
+class SpillFile(object):
+    """
+    A reference on text content written in a file by a SpillWriter.
+
+    A SpillFile only holds the path, digest and size of the content, so it
+    can be pickled in the cache instead of the content itself. Its repr
+    only depends on the digest, which makes it usable in cache keys.
+
+    Unicode content is stored as UTF-8 and decoded when read.
+    """
+    def __init__(self, path, digest, size, is_unicode=False):
+        self._path = path
+        self._digest = digest
+        self._size = size
+        self._is_unicode = is_unicode
+
+    def Path(self):
+        return self._path
+
+    def Digest(self):
+        return self._digest
+
+    def Size(self):
+        """
+        Returns the size of the content in bytes, as stored in the file.
+        """
+        return self._size
+
+    def Exists(self):
+        return os.path.exists(self._path)
+
+    def __nonzero__(self):
+        return self._size > 0
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self._digest)
+
+    def Read(self):
+        """
+        Returns the whole content.
+        """
+        f = file(self._path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if self._is_unicode:
+            data = data.decode("utf-8")
+        return data
+
+    def Lines(self):
+        """
+        Iterates through the lines of the content, with their end-of-line.
+        """
+        f = file(self._path, "rb")
+        try:
+            for line in f:
+                if self._is_unicode:
+                    line = line.decode("utf-8")
+                yield line
+        finally:
+            f.close()
+
+    def Remove(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+
+#------------------------
+class SpillWriter(object):
+    """
+    Writes text content to a new file in the given spill directory and
+    returns a SpillFile for it once closed.
+
+    Content can be stored under its digest, in which case files with the
+    same content are only stored once and are never removed by rig3: they
+    are expected to be cleared along with the cache that refers to them.
+    Otherwise the file keeps a temporary name and must be removed by the
+    caller.
+    """
+    def __init__(self, spill_dir):
+        self._spill_dir = spill_dir
+        if not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir, 0777)
+        fd, self._path = tempfile.mkstemp(suffix=".tmp", dir=spill_dir)
+        self._file = os.fdopen(fd, "wb")
+        self._md = sha.new()
+        self._size = 0
+        self._is_unicode = False
+
+    def Write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+            self._is_unicode = True
+        self._file.write(text)
+        self._md.update(text)
+        self._size += len(text)
+
+    def Close(self, store=True):
+        """
+        Closes the file and returns its SpillFile.
+        When store is true, the file is moved to a path matching its digest.
+        """
+        self._file.close()
+        digest = self._md.hexdigest()
+        path = self._path
+        if store:
+            path = os.path.join(self._spill_dir, digest[0:2], digest)
+            if os.path.exists(path):
+                os.unlink(self._path)
+            else:
+                d = os.path.dirname(path)
+                if not os.path.isdir(d):
+                    os.makedirs(d, 0777)
+                os.rename(self._path, path)
+        return SpillFile(path, digest, self._size, self._is_unicode)
+
+    def Discard(self):
+        """
+        Closes and removes the file if it has not been closed by Close(),
+        e.g. when generating its content failed.
+        """
+        if not self._file.closed:
+            self._file.close()
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Rig3 module: Template compiler
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+from rig.template.node import JoinContent, NodeLiteral, NodeTag
+from rig.template.tag import TagComment, TagFor, TagIf, TagRaw, TagHtml, TagXml, TagUrl
+from rig.template.tag import TagInsert, TagEval
+
+_INDENT = "    "
+
+#------------------------
+class Compiler(object):
+    """
+    Translates the NodeList of a parsed template into the Python source of
+    a single render function, which generates the same content as the
+    NodeList.Generate() interpreter:
+    - tag expressions are compiled once to code objects, which are still
+      evaluated with a copy of the context like the tags do,
+    - adjacent literals are merged, comments are dropped,
+    - [[if]] and [[for]] become Python if and for statements over the
+      content of their nodes,
+    - all the content goes in one list joined at the end, see JoinContent.
+
+    Tags which expression can't be compiled, or which are unknown to the
+    compiler, are generated by their Tag.Generate() at render time so that
+    they fail or succeed exactly like with the interpreter.
+    """
+    def __init__(self, filename="<source>"):
+        self._filename = filename
+        self._consts = []
+        self._lines = []
+
+    def Source(self, nodes):
+        """
+        Returns the Python source of the render function for the NodeList.
+        The function refers to the constants returned by Consts().
+        """
+        self._consts = []
+        self._lines = [ "def _Render(log, ctx0, _k=_k, _eval=eval, _dict=dict, _join=_join):",
+                        _INDENT + "_out = []",
+                        _INDENT + "_a = _out.append" ]
+        self._EmitList(nodes, 1, "ctx0")
+        self._lines.append(_INDENT + "return _join(_out)")
+        return "\n".join(self._lines) + "\n"
+
+    def Consts(self):
+        return self._consts
+
+    def Compile(self, nodes):
+        """
+        Returns the render function for the NodeList. The function takes
+        the log and the context, like NodeList.Generate().
+        """
+        source = self.Source(nodes)
+        namespace = { "_k": self._consts, "_join": JoinContent }
+        exec compile(source, "<template %s>" % self._filename, "exec") in namespace
+        return namespace["_Render"]
+
+    def _Const(self, value):
+        self._consts.append(value)
+        return "_k[%d]" % (len(self._consts) - 1)
+
+    def _Emit(self, depth, line):
+        self._lines.append(_INDENT * depth + line)
+
+    def _EmitList(self, nodes, depth, ctx):
+        """
+        Emits the statements of a NodeList, indented by depth, which
+        generate it for the context variable named ctx.
+        Returns the number of statements emitted.
+        """
+        count = len(self._lines)
+        literals = []
+        for node in nodes.Nodes():
+            if isinstance(node, NodeLiteral):
+                if node.Literal():
+                    literals.append(node.Literal())
+                continue
+            if isinstance(node, NodeTag) and isinstance(node.Tag(), TagComment):
+                continue
+            if literals:
+                self._Emit(depth, "_a(%s)" % self._Const(JoinContent(literals)))
+                literals = []
+            self._EmitTag(node, depth, ctx)
+        if literals:
+            self._Emit(depth, "_a(%s)" % self._Const(JoinContent(literals)))
+        return len(self._lines) - count
+
+    def _EmitTag(self, node, depth, ctx):
+        tag = node.Tag()
+        try:
+            if isinstance(tag, TagIf):
+                self._Emit(depth, "if _eval(%s, _dict(%s)):" % (self._Code(node.Parameters()), ctx))
+                if not self._EmitList(node.Content(), depth + 1, ctx):
+                    self._Emit(depth + 1, "pass")
+                return
+
+            if isinstance(tag, TagFor):
+                var, expr = tag.Loop(node.Parameters())
+                self._Emit(depth, "for _v%d in _eval(%s, _dict(%s)):" % (depth, self._Code(expr), ctx))
+                self._Emit(depth + 1, "ctx%d = _dict(%s)" % (depth, ctx))
+                self._Emit(depth + 1, "ctx%d[%s] = _v%d" % (depth, self._Const(var), depth))
+                self._EmitList(node.Content(), depth + 1, "ctx%d" % depth)
+                return
+
+            if isinstance(tag, (TagRaw, TagHtml, TagXml, TagUrl, TagEval)):
+                self._Emit(depth, "_a(%s(log, %s, %s, %s))" % (self._Const(tag.Expand),
+                                                               self._Const(node),
+                                                               ctx,
+                                                               self._Code(node.Parameters())))
+                return
+
+            if isinstance(tag, TagInsert):
+                self._Emit(depth, "_a(%s(log, %s, %s, %s, True))" % (self._Const(tag.Expand),
+                                                                     self._Const(node),
+                                                                     ctx,
+                                                                     self._Code(node.Parameters())))
+                return
+        except (SyntaxError, AssertionError, AttributeError, TypeError, ValueError):
+            # Let the tag raise the same error when it is generated
+            pass
+
+        self._Emit(depth, "_a(%s(log, %s, %s))" % (self._Const(tag.Generate),
+                                                   self._Const(node),
+                                                   ctx))
+
+    def _Code(self, expr):
+        """
+        Compiles a tag expression like eval() does.
+        """
+        return self._Const(compile(expr, "<template %s>" % self._filename, "eval", 0, True))
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
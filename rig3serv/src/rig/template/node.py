@@ -23,6 +23,22 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 __author__ = "ralfoide at gmail com"
 
 
+#------------------------
+def JoinContent(parts):
+    """
+    Concatenates generated content.
+
+    Content is normally made of ISO-8859-1 strings. When some of the parts
+    are unicode (see the site's unicode_text setting), the other strings
+    are decoded as ISO-8859-1 and the result is unicode.
+    """
+    try:
+        return "".join(parts)
+    except UnicodeDecodeError:
+        return u"".join([ isinstance(p, str) and p.decode("iso-8859-1") or p
+                          for p in parts ])
+
+
 #------------------------
 class Node(object):
     def __init__(self):
@@ -61,6 +77,9 @@ class NodeList(Node):
         self._list.append(node)
         return self
 
+    def Nodes(self):
+        return self._list
+
     def __eq__(self, rhs):
         if isinstance(rhs, NodeList):
             return self._list == rhs._list
@@ -73,10 +92,7 @@ class NodeList(Node):
         """
         Generates content by concatenating content from all children nodes.
         """
-        s = ""
-        for n in self._list:
-            s += n.Generate(log, context)
-        return s
+        return JoinContent([ n.Generate(log, context) for n in self._list ])
 
 
 #------------------------
@@ -89,6 +105,9 @@ class NodeLiteral(Node):
     def __init__(self, literal):
         self._literal = literal
 
+    def Literal(self):
+        return self._literal
+
     def __eq__(self, rhs):
         if isinstance(rhs, NodeLiteral):
             return self._literal == rhs._literal
@@ -27,6 +27,8 @@ import re
 import cgi
 import urllib
 
+from rig.template.node import JoinContent
+
 _RE_FIRST_WORD = re.compile(r"\s*(\w+)\s+(.*)")
 _RE_URL = re.compile(r"(?:(?P<proto>[a-z]+)://(?P<host>[^/#]+))?(?P<path>.*)")
 
@@ -54,6 +56,15 @@ class Tag(object):
         """
         raise NotImplementedError("TagDef is abstract")
 
+    def Expand(self, log, tag_node, context, expr):
+        """
+        Generates content for a tag without content which parameters are
+        the given expression, either a string or a code object compiled by
+        rig.template.compiler. Generate() is Expand() with the parameters
+        of the node.
+        """
+        raise NotImplementedError("TagDef is abstract")
+
 
 #------------------------
 class TagComment(Tag):
@@ -80,8 +91,11 @@ class TagRaw(Tag):
         super(TagRaw, self).__init__(tag="raw", has_content=False)
 
     def Generate(self, log, tag_node, context):
+        return self.Expand(log, tag_node, context, tag_node.Parameters())
+
+    def Expand(self, log, tag_node, context, expr):
         try:
-            result = eval(tag_node.Parameters(), dict(context))
+            result = eval(expr, dict(context))
             if not isinstance(result, (str, unicode)):
                 result = str(result)
             return result
@@ -102,8 +116,11 @@ class TagHtml(Tag):
         super(TagHtml, self).__init__(tag="html", has_content=False)
 
     def Generate(self, log, tag_node, context):
+        return self.Expand(log, tag_node, context, tag_node.Parameters())
+
+    def Expand(self, log, tag_node, context, expr):
         try:
-            result = eval(tag_node.Parameters(), dict(context))
+            result = eval(expr, dict(context))
             if not isinstance(result, (str, unicode)):
                 result = str(result)
             return cgi.escape(result)
@@ -125,8 +142,11 @@ class TagXml(Tag):
         super(TagXml, self).__init__(tag="xml", has_content=False)
 
     def Generate(self, log, tag_node, context):
+        return self.Expand(log, tag_node, context, tag_node.Parameters())
+
+    def Expand(self, log, tag_node, context, expr):
         try:
-            result = eval(tag_node.Parameters(), dict(context))
+            result = eval(expr, dict(context))
             if not isinstance(result, (str, unicode)):
                 result = str(result)
             return cgi.escape(result)
@@ -146,8 +166,11 @@ class TagUrl(Tag):
         super(TagUrl, self).__init__(tag="url", has_content=False)
 
     def Generate(self, log, tag_node, context):
+        return self.Expand(log, tag_node, context, tag_node.Parameters())
+
+    def Expand(self, log, tag_node, context, expr):
         try:
-            result = eval(tag_node.Parameters(), dict(context))
+            result = eval(expr, dict(context))
             if not isinstance(result, (str, unicode)):
                 result = str(result)
             result = _RE_URL.sub(_UrlEncode, result)
@@ -179,8 +202,22 @@ class TagFor(Tag):
         super(TagFor, self).__init__(tag="for", has_content=True)
 
     def Generate(self, log, tag_node, context):
-        params = tag_node.Parameters()
+        var, expr = self.Loop(tag_node.Parameters())
+        result = eval(expr, dict(context))
+        s = []
+        content = tag_node.Content()
+        for value in result:
+            d = dict(context)  # clone context before udpating it
+            d[var] = value
+            s.append(content.Generate(log, d))
 
+        return JoinContent(s)
+
+    def Loop(self, params):
+        """
+        Parses the "x in python_expression" parameters of the tag.
+        Returns a tuple (variable name, expression of the list of values).
+        """
         matches = _RE_FIRST_WORD.match(params)
         var, params = matches.group(1), matches.group(2)
         assert var != ""
@@ -190,16 +227,7 @@ class TagFor(Tag):
         assert word == "in"
         assert params != ""
 
-        result = eval("[%s for %s in %s]" % (var, var, params), dict(context))
-        s = ""
-        content = tag_node.Content()
-        for value in result:
-            d = dict(context)  # clone context before udpating it
-            d[var] = value
-            u = content.Generate(log, d)
-            s += u
-
-        return s
+        return var, "[%s for %s in %s]" % (var, var, params)
 
 
 #------------------------
@@ -233,7 +261,14 @@ class TagInsert(Tag):
         super(TagInsert, self).__init__(tag="insert", has_content=False)
 
     def Generate(self, log, tag_node, context):
-        filename = eval(tag_node.Parameters(), dict(context))
+        return self.Expand(log, tag_node, context, tag_node.Parameters())
+
+    def Expand(self, log, tag_node, context, expr, compiled=False):
+        """
+        Inserts the template file which path is the value of expr.
+        When compiled is true, the inserted template is compiled too.
+        """
+        filename = eval(expr, dict(context))
 
         if not not filename:
             template_file = None
@@ -266,7 +301,7 @@ class TagInsert(Tag):
                 raise IOError("Template '%s' not found for [[insert]] tag" % filename)
 
             from rig.template.template import Template
-            template = Template(log, file=template_file)
+            template = Template(log, file=template_file, compiled=compiled)
             result = template.Generate(context)
             return result
         return ""
@@ -289,7 +324,10 @@ class TagEval(Tag):
         super(TagEval, self).__init__(tag="eval", has_content=False)
 
     def Generate(self, log, tag_node, context):
-        source = eval(tag_node.Parameters(), dict(context))
+        return self.Expand(log, tag_node, context, tag_node.Parameters())
+
+    def Expand(self, log, tag_node, context, expr):
+        source = eval(expr, dict(context))
 
         if not not source:
             from rig.template.template import Template
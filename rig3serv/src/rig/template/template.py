@@ -24,8 +24,10 @@ __author__ = "ralfoide at gmail com"
 
 import os
 import re
+import threading
 
 from rig.template.buffer import Buffer, _WS, _EOL
+from rig.template.compiler import Compiler
 from rig.template.node import *
 from rig.template.tag import *
 
@@ -48,16 +50,31 @@ class Template(object):
     - if file is present, it must be a filename or a file object to be read from.
     - otherwise, source must be defined and it must be a string with the content
       of the template to parse.
+    - otherwise, nodes must be a NodeList already parsed, e.g. built by the
+      IzuParser, which generates like the source it represents.
     If there's a parsing error, a SyntaxError exception is thrown.
-    If neither file nor source is defined, TypeError is thrown.
+    If neither file, source nor nodes is defined, TypeError is thrown.
+
+    When compiled is true, the parsed template is translated to a Python
+    render function, see rig.template.compiler, which generates the same
+    content faster. Templates read from a file name are then parsed and
+    compiled once for the rest of the run, until the file changes.
     """
-    def __init__(self, log, file=None, source=None):
+    def __init__(self, log, file=None, source=None, compiled=False, nodes=None):
         self._log = log
         self._nodes = None
+        self._render = None
         self._filename = None
         self._filters = {}
+        self._compiled = compiled
         self.__InitTags()
-        self.__InitFileSource(file, source)
+        self.__InitFileSource(file, source, nodes)
+
+    def Nodes(self):
+        """
+        Returns the NodeList of the parsed template.
+        """
+        return self._nodes
 
     def Generate(self, keywords, template_dirs=None):
         """
@@ -79,6 +96,8 @@ class Template(object):
             if template_dirs:
                 k[CONTEXT_DIRS] = template_dirs
             # generate the template
+            if self._render is not None:
+                return self._render(self._log, k)
             return self._nodes.Generate(self._log, k)
         else:
             return ""
@@ -91,7 +110,7 @@ class Template(object):
             tag = tag_def()
             self._tags[tag.Tag()] = tag
 
-    def __InitFileSource(self, file, source):
+    def __InitFileSource(self, file, source, nodes):
         _file = file
         if _file is not None:
             if isinstance(_file, (str, unicode)):
@@ -106,12 +125,20 @@ class Template(object):
                 return self._Parse(_file_name(_file), _file.read())
         elif source is not None:
             return self._Parse("<source>", source)
-        raise TypeError("Template: missing file or source parameters")
+        elif nodes is not None:
+            self._filename = "<source>"
+            self._nodes = nodes
+            if self._compiled:
+                self._render = Compiler(self._filename).Compile(self._nodes)
+            return self
+        raise TypeError("Template: missing file, source or nodes parameters")
 
     def _ParseFile(self, filename):
         """
         Helper to parse a file given by its filename.
         """
+        if self._compiled:
+            return self._ParseCompiledFile(filename)
         f = None
         try:
             f = file(filename)
@@ -126,6 +153,36 @@ class Template(object):
         self._filename = filename
         buffer = Buffer(os.path.basename(filename), source, 0)
         self._nodes = self._GetNodeList(buffer, end_expected=False)
+        if self._compiled:
+            self._render = Compiler(filename).Compile(self._nodes)
+        return self
+
+    def _ParseCompiledFile(self, filename):
+        """
+        Reuses the nodes and render function of a file already compiled
+        during this run, or parses and compiles it.
+        """
+        st = os.stat(filename)
+        key = (filename, st.st_mtime, st.st_size)
+        _COMPILED_LOCK.acquire()
+        try:
+            entry = _COMPILED.get(key)
+        finally:
+            _COMPILED_LOCK.release()
+        if entry is None:
+            f = file(filename)
+            try:
+                self._Parse(filename, f.read())
+            finally:
+                f.close()
+            entry = (self._nodes, self._render)
+            _COMPILED_LOCK.acquire()
+            try:
+                _COMPILED[key] = entry
+            finally:
+                _COMPILED_LOCK.release()
+        self._filename = filename
+        self._nodes, self._render = entry
         return self
 
     def _GetNodeList(self, buffer, end_expected):
@@ -200,6 +257,56 @@ class Template(object):
                             buffer.CurrCol(),
                             msg))
 
+
+#------------------------
+_COMPILED = {}   # (filename, mtime, size) => (NodeList, render function)
+_COMPILED_LOCK = threading.Lock()
+
+def ClearCompiled():
+    """
+    Forgets the templates compiled from files.
+    """
+    _COMPILED_LOCK.acquire()
+    try:
+        _COMPILED.clear()
+    finally:
+        _COMPILED_LOCK.release()
+
+
+#------------------------
+def GenerateChunks(log, lines, keywords, chunk_size=64 * 1024):
+    """
+    Generates a template source given as an iterable of lines, such as a
+    file, and yields the generated content chunk by chunk.
+
+    Lines are grouped in chunks of about chunk_size characters. A chunk is
+    only generated once it can be parsed, i.e. once all the tags it opens
+    are closed, which gives the same result as generating the whole source
+    at once but without keeping it in memory.
+
+    If there's a parsing error, a SyntaxError exception is thrown at the
+    end of the source.
+    """
+    chunk = []
+    size = 0
+    limit = chunk_size
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= limit:
+            try:
+                template = Template(log, source="".join(chunk))
+            except SyntaxError:
+                # Some tag is not closed yet, try again with more lines
+                limit = size + chunk_size
+                continue
+            yield template.Generate(keywords)
+            chunk = []
+            size = 0
+            limit = chunk_size
+    if chunk:
+        yield Template(log, source="".join(chunk)).Generate(keywords)
+
 #------------------------
 # Local Variables:
 # mode: python
@@ -25,14 +25,22 @@ import os
 import sys
 import getopt
 from rig import stats
+from rig.catalog import Catalog
 from rig.log import Log
+from rig.parser import dir_parser
+from rig.parser import img_gen
+from rig.parser import img_size
 from rig.site import CreateSite
-from rig.sites_settings import SitesSettings
+from rig.sites_settings import SitesSettings, SiteSettings
+from rig.template import template
+from rig.source_item import SourceDir, SourceFile, SourceSettings
+from rig.source_reader import SourceBlogReader
 
 #------------------------
 class Rig3(object):
     _USAGE = """
 Rig3 [-h] [-v]
+Rig3 --build-catalog catalog_file [source_dir]
 
 Options:
     -h, --help:    This help
@@ -41,6 +49,9 @@ Options:
     -q, --quiet:   Quiet logging
     -c, --config:  Configuration file (default: %(_configPaths)s)
     -f, --force:   Force generation even if cache is hot and unmodified
+    -b, --build-catalog: Creates or updates the sqlite catalog of the given
+                   blog source directory (default: the catalog's one)
+                   for use with a "catalog:" source. No site is generated.
 """
 
     def __init__(self):
@@ -49,6 +60,8 @@ Options:
         self._verbose = Log.LEVEL_NORMAL
         self._dry_run = False
         self._force = False
+        self._build_catalog = None
+        self._catalog_source = None
         self._configPaths = [ "/etc/rig3.rc",
                               os.path.expanduser(os.path.join("~", ".rig3rc")) ]
 
@@ -67,10 +80,10 @@ Options:
         """
         try:
             options, args = getopt.getopt(argv[1:],
-                                          "hHvqc:nf",
+                                          "hHvqc:nfb:",
                                           ["help", "verbose", "quiet", "config=",
                                            "dry-run", "dry_run", "dryrun",
-                                           "force"])
+                                           "force", "build-catalog="])
             for opt, value in options:
                 if opt in ["-h",  "-H", "--help"]:
                     self._UsageAndExit()
@@ -84,6 +97,10 @@ Options:
                     self._dry_run = True
                 elif opt in ["-f", "--force"]:
                     self._force = True
+                elif opt in ["-b", "--build-catalog"]:
+                    self._build_catalog = value
+            if self._build_catalog and args:
+                self._catalog_source = args[0]
         except getopt.error, msg:
             self._UsageAndExit(msg)
 
@@ -92,6 +109,9 @@ Options:
         Runs rig3.
         """
         self._log = Log(verbose_level=self._verbose, use_stderr=self._verbose)
+        if self._build_catalog:
+            self.BuildCatalog()
+            return
         self._sites_settings = SitesSettings(self._log).Load(self._configPaths)
         self.ProcessSites()
 
@@ -108,6 +128,43 @@ Options:
             site.Dispose()
 
         st.Stop(len(s.Sites()))
+        self._log.Info("Directory walks saved by sharing sources: %d",
+                       dir_parser.WalksSaved())
+        self._log.Info("Directory listings saved by glob lookups: %d",
+                       dir_parser.ListingsSaved())
+        dir_parser.ClearSharedTrees()
+        dir_parser.ClearListings()
+        img_gen.StopAll()
+        img_size.SaveAll()
+        template.ClearCompiled()
+        stats.Display(self._log)
+
+    def BuildCatalog(self):
+        """
+        Creates or updates the catalog file with the entries of the source
+        directory, using the default blog source settings.
+        """
+        st = stats.Start("0-Build Catalog")
+
+        catalog = Catalog(self._log, self._build_catalog).Open(create=True)
+        try:
+            source_dir = self._catalog_source or catalog.GetBase()
+            if not source_dir:
+                self._UsageAndExit("Missing source directory for catalog %s" % self._build_catalog)
+            source_dir = os.path.realpath(source_dir)
+
+            site_settings = SiteSettings(public_name=self._build_catalog)
+            reader = SourceBlogReader(self._log, site_settings, SourceSettings(), source_dir)
+            items = [ i for i in reader.Parse(source_dir)
+                      if isinstance(i, (SourceDir, SourceFile)) ]
+
+            updated, removed = catalog.Update(source_dir, items, site_settings.encoding)
+            self._log.Info("Catalog %s: %d items, %d updated, %d removed",
+                           self._build_catalog, len(items), updated, removed)
+        finally:
+            catalog.Close()
+
+        st.Stop(len(items))
         stats.Display(self._log)
 
     def Close(self):
@@ -23,10 +23,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 __author__ = "ralfoide at gmail com"
 
 import os
+import re
 from StringIO import StringIO
 
 from tests.rig_test_case import RigTestCase
+from rig import stats
 from rig.parser.dir_parser import DirParser, RelPath, RelDir, _EXCLUDE
+from rig.parser import dir_parser
 
 
 #------------------------
@@ -286,6 +289,162 @@ class DirParserTest(RigTestCase):
 
 
 
+#------------------------
+class SharedParseTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        os.mkdir(os.path.join(self._tempdir, "sub"))
+        for name in [ "a.izu", os.path.join("sub", "b.izu") ]:
+            f = file(os.path.join(self._tempdir, name), "w")
+            f.close()
+        dir_parser.ClearSharedTrees()
+
+    def tearDown(self):
+        dir_parser.ClearSharedTrees()
+        self.RemoveDir(self._tempdir)
+
+    def testSharedParse(self):
+        t1 = dir_parser.SharedParse(self.Log(), self._tempdir, "dest1", r"\.izu$")
+        self.assertEquals(DirParser(self.Log()).Parse(self._tempdir, "dest1", r"\.izu$"), t1)
+        self.assertEquals(0, dir_parser.WalksSaved())
+
+        # Same source and pattern, another destination
+        t2 = dir_parser.SharedParse(self.Log(), self._tempdir, "dest2", re.compile(r"\.izu$"))
+        self.assertEquals(DirParser(self.Log()).Parse(self._tempdir, "dest2", r"\.izu$"), t2)
+        self.assertEquals(1, dir_parser.WalksSaved())
+
+        # Another pattern
+        dir_parser.SharedParse(self.Log(), self._tempdir, "dest1", ".")
+        self.assertEquals(1, dir_parser.WalksSaved())
+
+        # The tree is parsed again when a directory changes
+        f = file(os.path.join(self._tempdir, "sub", "c.izu"), "w")
+        f.close()
+        os.utime(os.path.join(self._tempdir, "sub"), (0, 1000000000))
+        t3 = dir_parser.SharedParse(self.Log(), self._tempdir, "dest1", r"\.izu$")
+        self.assertEquals(DirParser(self.Log()).Parse(self._tempdir, "dest1", r"\.izu$"), t3)
+        self.assertNotEquals(t1, t3)
+        self.assertEquals(1, dir_parser.WalksSaved())
+
+        # Or when a file is added to an empty directory
+        os.mkdir(os.path.join(self._tempdir, "empty"))
+        dir_parser.SharedParse(self.Log(), self._tempdir, "dest1", r"\.izu$")
+        f = file(os.path.join(self._tempdir, "empty", "d.izu"), "w")
+        f.close()
+        os.utime(os.path.join(self._tempdir, "empty"), (0, 1000000000))
+        t4 = dir_parser.SharedParse(self.Log(), self._tempdir, "dest1", r"\.izu$")
+        self.assertEquals(DirParser(self.Log()).Parse(self._tempdir, "dest1", r"\.izu$"), t4)
+        self.assertEquals(1, dir_parser.WalksSaved())
+
+
+#------------------------
+class CachedListDirTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        for name in [ "a.jpg", "b.jpg" ]:
+            f = file(os.path.join(self._tempdir, name), "w")
+            f.close()
+        dir_parser.ClearListings()
+
+    def tearDown(self):
+        dir_parser.ClearListings()
+        self.RemoveDir(self._tempdir)
+
+    def testCachedListDir(self):
+        s = stats.Start("1.0 Listdir")
+        listings = s.count
+
+        names = dir_parser.CachedListDir(self._tempdir)
+        self.assertListEquals([ "a.jpg", "b.jpg" ], names, sort=True)
+        self.assertSame(names, dir_parser.CachedListDir(self._tempdir))
+        self.assertEquals(1, dir_parser.ListingsSaved())
+        self.assertEquals(listings + 1, s.count)
+
+        # The directory is listed again when it changes
+        f = file(os.path.join(self._tempdir, "c.jpg"), "w")
+        f.close()
+        os.utime(self._tempdir, (0, 1000000000))
+        self.assertListEquals([ "a.jpg", "b.jpg", "c.jpg" ],
+                              dir_parser.CachedListDir(self._tempdir), sort=True)
+        self.assertEquals(1, dir_parser.ListingsSaved())
+        self.assertEquals(listings + 2, s.count)
+
+        dir_parser.ClearListings()
+        self.assertEquals(0, dir_parser.ListingsSaved())
+        dir_parser.CachedListDir(self._tempdir)
+        self.assertEquals(listings + 3, s.count)
+
+        self.assertRaises(OSError, dir_parser.CachedListDir,
+                          os.path.join(self._tempdir, "unknown"))
+
+
+#------------------------
+class TreeStampTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._album = os.path.join(self._tempdir, "2007-01-01 Album")
+        os.mkdir(self._album)
+        for name in [ "index.izu", "a.jpg" ]:
+            self._Write(os.path.join(self._album, name), "data")
+        self._pattern = re.compile(r"\.izu$")
+
+    def tearDown(self):
+        self.RemoveDir(self._tempdir)
+
+    def _Write(self, path, data):
+        f = file(path, "w")
+        f.write(data)
+        f.close()
+
+    def _Stamp(self):
+        return dir_parser.TreeStamp(self._tempdir, self._pattern)
+
+    def testTreeStamp(self):
+        stamp = self._Stamp()
+        self.assertNotEquals(None, stamp)
+        self.assertEquals(stamp, self._Stamp())
+
+        # An item file restored with an older time
+        index = os.path.join(self._album, "index.izu")
+        os.utime(index, (0, 1000000000))
+        self.assertNotEquals(stamp, self._Stamp())
+        stamp = self._Stamp()
+
+        # An item file with the same time but another size
+        self._Write(index, "more data")
+        os.utime(index, (0, 1000000000))
+        self.assertNotEquals(stamp, self._Stamp())
+        stamp = self._Stamp()
+
+        # Other files are not looked at
+        os.utime(self._album, (0, 1100000000))
+        stamp = self._Stamp()
+        image = os.path.join(self._album, "a.jpg")
+        self._Write(image, "another image")
+        os.utime(image, (0, 1000000000))
+        os.utime(self._album, (0, 1100000000))
+        self.assertEquals(stamp, self._Stamp())
+
+        # but adding one changes its directory
+        self._Write(os.path.join(self._album, "b.jpg"), "")
+        os.utime(self._album, (0, 1000000000))
+        self.assertNotEquals(stamp, self._Stamp())
+
+    def testFile(self):
+        index = os.path.join(self._album, "index.izu")
+        stamp = dir_parser.TreeStamp(index, self._pattern)
+        self.assertNotEquals(None, stamp)
+        os.utime(index, (0, 1000000000))
+        self.assertNotEquals(stamp, dir_parser.TreeStamp(index, self._pattern))
+
+        self.assertEquals(None, dir_parser.TreeStamp(os.path.join(self._tempdir, "unknown"),
+                                                     self._pattern))
+
+
+
 #------------------------
 # Local Variables:
 # mode: python
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for ImgGenServer
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import sys
+
+from tests.rig_test_case import RigTestCase
+from rig import stats
+from rig.cache import Cache
+from rig.parser import img_gen
+from rig.parser.dir_parser import RelFile
+from rig.parser.izu_parser import IzuParser
+
+# A server script which replies with its pid and the number of requests,
+# and exits on the request for "exit.jpg".
+_SCRIPT = """#!%s
+import json, os, sys
+assert sys.argv[1:] == [ "--json-lines" ]
+n = 0
+for line in iter(sys.stdin.readline, ""):
+    env = json.loads(line)
+    if env["IMG_NAME"] == "exit.jpg":
+        sys.exit(1)
+    n += 1
+    if env["IMG_NAME"] == "fail.jpg":
+        reply = { "ret": 3 }
+    else:
+        reply = { "output": "http://img/%%s?pid=%%d&n=%%d&t=%%s" %% (
+                  env["IMG_NAME"], os.getpid(), n, env["OPT_TITLE"]) }
+    sys.stdout.write(json.dumps(reply) + "\\n")
+    sys.stdout.flush()
+"""
+
+# A slow one-shot script which logs its requests and fails for "fail.jpg".
+_SLOW_SCRIPT = """#!%s
+import os, sys, time
+abs_dir, rel_file, img_name = sys.argv[1:4]
+f = open(os.path.join(abs_dir, "requests.log"), "a")
+f.write(img_name + "\\n")
+f.close()
+time.sleep(%f)
+if img_name != "fail.jpg":
+    sys.stdout.write("http://img/%%s?t=%%s" %% (img_name, sys.argv[6]))
+"""
+
+#------------------------
+class ImgGenServerTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._script = os.path.join(self._tempdir, "img_gen.py")
+        f = file(self._script, "w")
+        f.write(_SCRIPT % sys.executable)
+        f.close()
+        os.chmod(self._script, 0755)
+        img_gen.StopAll()
+
+    def tearDown(self):
+        img_gen.StopAll()
+        self.RemoveDir(self._tempdir)
+
+    def _Env(self, name, title=""):
+        return { "ABS_DIR": self._tempdir, "REL_FILE": "", "IMG_NAME": name, "IS_LINK": "0",
+                 "OPT_SIZE": "", "OPT_TITLE": title, "OPT_CAPTION": "", "RIG_BASE": "" }
+
+    def testRequest(self):
+        s = stats.Start("1.2 Img Gen Start")
+        starts = s.count
+
+        server = img_gen.Get(self.Log(), self._script)
+        self.assertSame(server, img_gen.Get(self.Log(), self._script))
+        ret, output = server.Request(self._Env("a.jpg", "\xe9t\xe9"))
+        self.assertEquals(0, ret)
+        self.assertTrue(output.startswith("http://img/a.jpg?pid="))
+        self.assertTrue(output.endswith("&n=1&t=\xe9t\xe9"))
+        pid = output.split("pid=")[1].split("&")[0]
+        self.assertEquals((0, "http://img/b.jpg?pid=%s&n=2&t=" % pid),
+                          server.Request(self._Env("b.jpg")))
+        self.assertEquals((3, ""), server.Request(self._Env("fail.jpg")))
+        self.assertEquals(starts + 1, s.count)
+
+        # a script that dies is started again on the next request
+        self.assertEquals((-1, ""), server.Request(self._Env("exit.jpg")))
+        ret, output = server.Request(self._Env("c.jpg"))
+        self.assertEquals(0, ret)
+        self.assertTrue(output.endswith("&n=1&t="))
+        self.assertNotEquals(pid, output.split("pid=")[1].split("&")[0])
+        self.assertEquals(starts + 2, s.count)
+
+        img_gen.StopAll()
+        self.assertNotSame(server, img_gen.Get(self.Log(), self._script))
+
+    def testIzuParser(self):
+        for name in [ "a.jpg", "b.jpg" ]:
+            f = file(os.path.join(self._tempdir, name), "w")
+            f.close()
+        cache = Cache(self.Log(), os.path.join(self._tempdir, "cache"))
+        text = "[A|rigimg:a.jpg]\n[B|rigimg:b.jpg]\n[A|rigimg:a.jpg]\n"
+        rel_file = RelFile(self._tempdir, "index.izu")
+
+        s = stats.Start("1.2 Img Gen Request")
+        requests = s.count
+
+        p = IzuParser(self.Log(), "http://rig", self._script, cache, img_gen_server=True)
+        tags, sections = p.RenderStringToHtml(text, rel_file=rel_file)
+        html = sections["en"]
+        self.assertTrue('<img title="A" src="http://img/a.jpg?' in html)
+        self.assertTrue('<img title="B" src="http://img/b.jpg?' in html)
+        # the 2nd request for a.jpg comes from the cache
+        self.assertEquals(requests + 2, s.count)
+        self.assertTrue("&n=2&" in html)
+        self.assertFalse("&n=3&" in html)
+
+        # results are kept across runs until the image changes
+        img_gen.StopAll()
+        p = IzuParser(self.Log(), "http://rig", self._script, cache, img_gen_server=True)
+        self.assertEquals(html, p.RenderStringToHtml(text, rel_file=rel_file)[1]["en"])
+        self.assertEquals(requests + 2, s.count)
+
+        os.utime(os.path.join(self._tempdir, "b.jpg"), (0, 1000000000))
+        html2 = p.RenderStringToHtml(text, rel_file=rel_file)[1]["en"]
+        self.assertNotEquals(html, html2)
+        self.assertTrue('<img title="B" src="http://img/b.jpg?' in html2)
+        self.assertEquals(requests + 3, s.count)
+
+        # or until the script changes
+        os.utime(self._script, (0, 1000000000))
+        p.RenderStringToHtml(text, rel_file=rel_file)
+        self.assertEquals(requests + 5, s.count)
+
+
+#------------------------
+class ImgGenWorkersTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._script = os.path.join(self._tempdir, "img_gen.py")
+        f = file(self._script, "w")
+        f.write(_SLOW_SCRIPT % (sys.executable, 0.05))
+        f.close()
+        os.chmod(self._script, 0755)
+        self._rel_file = RelFile(self._tempdir, "index.izu")
+        self._text = ""
+        for i in xrange(8):
+            name = "img%d.jpg" % i
+            f = file(os.path.join(self._tempdir, name), "w")
+            f.close()
+            self._text += "[T%d|rigimg:%s]\n" % (i, name)
+        self._text += "[s:images]\n[T0|rigimg:img0.jpg]\n[U1|rigimg:img1.jpg]\n"
+
+    def tearDown(self):
+        self.RemoveDir(self._tempdir)
+
+    def _Requests(self):
+        f = file(os.path.join(self._tempdir, "requests.log"))
+        try:
+            return f.read().split()
+        finally:
+            f.close()
+            os.unlink(os.path.join(self._tempdir, "requests.log"))
+
+    def _Render(self, text, num_workers, img_dims=False):
+        p = IzuParser(self.Log(), "http://rig", self._script, img_gen_workers=num_workers,
+                      img_dims=img_dims)
+        tags, sections = p.RenderStringToHtml(text, rel_file=self._rel_file)
+        return sections
+
+    def testWorkers(self):
+        # The time with several workers is checked by izu_bench, see
+        # bench_izu.py --img-gen.
+        sections1 = self._Render(self._text, 1)
+        requests = self._Requests()
+        self.assertEquals(10, len(requests))
+
+        # the images are not read while the requests are collected
+        reads = stats.Start("1.0 Img Size Read").count
+        hits = stats.Start("1.0 Img Size Hit").count
+        sections4 = self._Render(self._text, 4, img_dims=True)
+        self.assertEquals(reads, stats.Start("1.0 Img Size Read").count)
+        self.assertEquals(hits, stats.Start("1.0 Img Size Hit").count)
+        self.assertEquals(sections1, sections4)
+        self.assertTrue('<img title="T7" src="http://img/img7.jpg?t=T7">' in sections4["en"])
+        # images used twice with the same options only run the script once
+        requests.remove("img0.jpg")
+        self.assertListEquals(requests, self._Requests(), sort=True)
+
+    def testFailure(self):
+        f = file(os.path.join(self._tempdir, "fail.jpg"), "w")
+        f.close()
+        text = "[F|rigimg:fail.jpg]\n" + self._text
+        self.assertRaises(SystemExit, self._Render, text, 4)
+        # all the requests were executed before exiting
+        self.assertEquals(10, len(self._Requests()))
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for img_size
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import struct
+
+from tests.rig_test_case import RigTestCase
+from rig import stats
+from rig.cache import Cache
+from rig.parser import img_size
+
+#------------------------
+class ImgSizeTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._cachedir = self.MakeTempDir()
+        img_size.SaveAll()
+
+    def tearDown(self):
+        img_size.SaveAll()
+        self.RemoveDir(self._tempdir)
+        self.RemoveDir(self._cachedir)
+
+    def _Write(self, name, data):
+        path = os.path.join(self._tempdir, name)
+        f = file(path, "wb")
+        f.write(data)
+        f.close()
+        return path
+
+    def _Png(self, width, height):
+        return ("\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + "IHDR" +
+                struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0) + "\0\0\0\0")
+
+    def _Jpeg(self, width, height, sof="\xC2"):
+        # a large EXIF segment, a table with a fill byte and a frame
+        exif = "Exif\0\0" + "x" * 60000
+        return ("\xFF\xD8" +
+                "\xFF\xE1" + struct.pack(">H", len(exif) + 2) + exif +
+                "\xFF\xFF\xC4" + struct.pack(">H", 5) + "abc" +
+                "\xFF" + sof + struct.pack(">HBHHB", 11, 8, height, width, 3) + "\0" * 6 +
+                "\xFF\xDA" + "scan data")
+
+    def testReadImageSize(self):
+        self.assertEquals((640, 480), img_size.ReadImageSize(self._Write("a.png", self._Png(640, 480))))
+        self.assertEquals((300, 2000), img_size.ReadImageSize(self._Write("a.jpg", self._Jpeg(300, 2000))))
+        self.assertEquals((3, 2), img_size.ReadImageSize(self._Write("b.jpg", self._Jpeg(3, 2, "\xC0"))))
+        path = os.path.join(self.getTestDataPath(), "album", "blog1", "2007-10-07_Folder 1",
+                            "T12896_tiny_jpeg.jpg")
+        self.assertEquals((128, 96), img_size.ReadImageSize(path))
+
+        # not images, or truncated ones
+        self.assertEquals(None, img_size.ReadImageSize(self._Write("c.jpg", "not an image")))
+        self.assertEquals(None, img_size.ReadImageSize(self._Write("d.jpg", self._Jpeg(3, 2)[:60020])))
+        self.assertEquals(None, img_size.ReadImageSize(self._Write("e.png", self._Png(3, 2)[:20])))
+        self.assertEquals(None, img_size.ReadImageSize(self._Write("f.jpg", "\xFF\xD8\xFF\xDAscan")))
+        self.assertEquals(None, img_size.ReadImageSize(os.path.join(self._tempdir, "missing.jpg")))
+
+    def testFitSize(self):
+        self.assertEquals((400, 300), img_size.FitSize((800, 600), 400))
+        self.assertEquals((300, 400), img_size.FitSize((600, 800), 400))
+        self.assertEquals((133, 400), img_size.FitSize((200, 601), 400))
+        # images are not scaled up
+        self.assertEquals((800, 600), img_size.FitSize((800, 600), 1024))
+        self.assertEquals((0, 0), img_size.FitSize((0, 0), 10))
+
+    def testAlbumSizes(self):
+        self._Write("a.png", self._Png(640, 480))
+        self._Write("b.txt", "text")
+        cache = Cache(self.Log(), self._cachedir)
+        s_read = stats.Start("1.0 Img Size Read")
+        s_hit = stats.Start("1.0 Img Size Hit")
+        reads = s_read.count
+        hits = s_hit.count
+
+        album = img_size.Get(cache, self._tempdir)
+        self.assertSame(album, img_size.Get(cache, self._tempdir + os.sep))
+        self.assertEquals((640, 480), album.Get("a.png"))
+        self.assertEquals(None, album.Get("b.txt"))
+        self.assertEquals(None, album.Get("missing.png"))
+        self.assertEquals((640, 480), album.Get("a.png"))
+        self.assertEquals(None, album.Get("b.txt"))
+        self.assertEquals(reads + 2, s_read.count)
+        self.assertEquals(hits + 2, s_hit.count)
+
+        # the table is kept in the cache for the next runs
+        img_size.SaveAll()
+        album = img_size.Get(cache, self._tempdir)
+        self.assertEquals((640, 480), album.Get("a.png"))
+        self.assertEquals(reads + 2, s_read.count)
+
+        # and an image is read again when it changes
+        path = self._Write("a.png", self._Png(64, 48) + "more")
+        os.utime(path, (0, 1000000000))
+        self.assertEquals((64, 48), album.Get("a.png"))
+        self.assertEquals(reads + 3, s_read.count)
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for izu_bench
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+
+from tests.rig_test_case import RigTestCase
+from rig.parser import izu_bench
+from rig.parser.izu_parser import IzuParser
+
+#------------------------
+class IzuBenchTest(RigTestCase):
+
+    def testGenerateCorpus(self):
+        text, images = izu_bench.GenerateCorpus(num_lines=500, seed=1)
+        self.assertEquals((text, images), izu_bench.GenerateCorpus(num_lines=500, seed=1))
+        self.assertNotEquals(text, izu_bench.GenerateCorpus(num_lines=500, seed=2)[0])
+        self.assertTrue(text.count("\n") >= 500)
+        for s in [ "[izu:cat:", "__", "[table:begin:", "[!--", "[!html:", "rigimg:", "\xe9" ]:
+            self.assertTrue(s in text, s)
+        self.assertEquals(len(images), text.count("rigimg:") + text.count("riglink:"))
+
+        text, images = izu_bench.GenerateCorpus(num_lines=500, tag_density=0, accent_density=0,
+                                                table_density=0, rigimg_density=0,
+                                                escape_density=0)
+        for s in [ "__", "[table:begin:", "[!--", "rigimg:", "\xe9" ]:
+            self.assertFalse(s in text, s)
+        self.assertEquals([], images)
+
+        tags, sections = IzuParser(self.Log(), "http://rig", "").RenderStringToHtml(text)
+        self.assertEquals({ "bench": True, "perf": True }, tags["cat"])
+        self.assertTrue(sections["en"])
+
+    def testRun(self):
+        settings = { "num_lines": 200 }
+        text, images = izu_bench.GenerateCorpus(**settings)
+        results = izu_bench.IzuBench(self.Log(), text, images, settings, repeat=1).Run()
+
+        self.assertEquals(200, results["corpus"]["num_lines"])
+        self.assertEquals(len(text), results["corpus"]["bytes"])
+        self.assertEquals(text.count("\n"), results["corpus"]["lines"])
+        self.assertListEquals([ "RenderFileToHtml", "RenderStringToHtml" ],
+                              results["renders"].keys(), sort=True)
+        for name in [ "Compile", "_FormatLinks", "_ConvertAccents", "Render" ]:
+            self.assertTrue(name in results["stages"], name)
+        for r in results["renders"].values() + results["stages"].values():
+            self.assertTrue(r["lines_per_sec"] > 0)
+            self.assertTrue(r["mb_per_sec"] > 0)
+        self.assertEquals(len(text), results["stages"]["Compile"]["bytes"])
+
+        path = os.path.join(self.MakeTempDir(), "bench.json")
+        try:
+            izu_bench.Save(results, path)
+            self.assertEquals(results, izu_bench.Load(path))
+        finally:
+            self.RemoveDir(os.path.dirname(path))
+
+    def testScaling(self):
+        bench = izu_bench.IzuBench(self.Log(), "", [], repeat=1)
+        scaling = bench.Scaling([ ("lines", "Some __text__\n", 10), ("long", "[a|http://x ", 10) ])
+        self.assertListEquals([ "lines", "long" ], scaling.keys(), sort=True)
+        for r in scaling.values():
+            self.assertEquals(10, r["count"])
+            self.assertTrue(r["small"] >= 0 and r["large"] >= 0)
+            self.assertTrue(r["ratio"] >= 0)
+
+        results = { "scaling": { "lines": { "ratio": 4.2 }, "long": { "ratio": 15.0 } } }
+        self.assertEquals([ ("long", 15.0) ], izu_bench.CheckScaling(results))
+        self.assertEquals([], izu_bench.CheckScaling(results, max_ratio=20))
+        self.assertEquals([], izu_bench.CheckScaling({}))
+
+    def testImgGen(self):
+        bench = izu_bench.IzuBench(self.Log(), "", [], repeat=1)
+        img_gen = bench.ImgGen(num_images=3, delay=0, workers=(1, 2))
+        self.assertEquals(3, img_gen["images"])
+        self.assertListEquals([ "1", "2" ], img_gen["seconds"].keys(), sort=True)
+        self.assertTrue(img_gen["speedup"] > 0)
+
+        self.assertEquals([], izu_bench.CheckImgGen({ "img_gen": { "speedup": 3.5 } }))
+        self.assertEquals([ ("img_gen", 1.2) ],
+                          izu_bench.CheckImgGen({ "img_gen": { "speedup": 1.2 } }))
+        self.assertEquals([], izu_bench.CheckImgGen({}))
+
+    def testCompare(self):
+        def _results(string_lps, links_lps, lines=100):
+            return { "version": izu_bench.RESULTS_VERSION,
+                     "corpus": { "lines": lines },
+                     "renders": { "RenderStringToHtml": { "lines_per_sec": string_lps } },
+                     "stages": { "_FormatLinks": { "lines_per_sec": links_lps } } }
+
+        baseline = _results(1000, 5000)
+        self.assertTrue(izu_bench.SameCorpus(baseline, _results(1, 1)))
+        self.assertFalse(izu_bench.SameCorpus(baseline, _results(1, 1, lines=50)))
+
+        self.assertEquals([], izu_bench.Compare(baseline, _results(950, 6000)))
+        self.assertEquals([ ("RenderStringToHtml", 1000, 850) ],
+                          izu_bench.Compare(baseline, _results(850, 6000)))
+        self.assertEquals([ ("RenderStringToHtml", 1000, 950), ("_FormatLinks", 5000, 4000) ],
+                          izu_bench.Compare(baseline, _results(950, 4000), tolerance=0.01))
+
+        # entries missing from the baseline are not compared
+        del baseline["stages"]["_FormatLinks"]
+        self.assertEquals([], izu_bench.Compare(baseline, _results(1000, 1)))
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -25,18 +25,28 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 __author__ = "ralfoide at gmail com"
 
+import codecs
 import os
+import random
 from datetime import datetime
+from StringIO import StringIO
 
 from tests.rig_test_case import RigTestCase
+from rig import stats
+from rig.cache import Cache
+from rig.parser import dir_parser
+from rig.parser import izu_parser
+from rig.parser import izu_bench
 from rig.parser.izu_parser import IzuParser
 from rig.parser.dir_parser import RelFile
+from rig.spill_file import SpillFile
+from rig.template.template import Template
 
 _j_ = os.path.join  # shortcut
 
 #------------------------
 class MockIzuParser(IzuParser):
-    def __init__(self, log, glob, rig_base, img_gen_script):
+    def __init__(self, log, glob, rig_base, img_gen_script, cache=None):
         self._popen_args = None
         self._popen_kw = None
         self._popen_ret = None
@@ -44,7 +54,7 @@ class MockIzuParser(IzuParser):
 
         self._glob = glob or {}
 
-        super(MockIzuParser, self).__init__(log, rig_base, img_gen_script)
+        super(MockIzuParser, self).__init__(log, rig_base, img_gen_script, cache)
 
     def _GlobGlob(self, dir, pattern):
         return self._glob.get(pattern, None)
@@ -248,6 +258,11 @@ class IzuParserTest(RigTestCase):
             '<span class="izu">\n<table border="0" ><tr valign="top"><td >my column 1</td><td >my column 2</td></tr><tr valign="top"><td >second row</td></tr></table></span>',
             self._Render("[table:begin]my column 1[col]my column 2[row]second row[table:end]"))
 
+        # several columns and rows on the same line
+        self.assertEquals(
+            '<span class="izu">\n<table border="0" ><tr valign="top"><td >1</td><td  width="10%">2</td><td >3</td></tr><tr valign="top"><td >4</td></tr><tr valign="top"><td  width="5px">5</td></tr></table></span>',
+            self._Render("[table:begin]1[col:10%]2[col]3[row]4[row:5px]5[table:end]"))
+
     def testIzuImage(self):
         self.assertEquals(
             '<span class="izu">\n<a href="http://en.wikipedia.org/wiki/Apple_iic"><img src="http://upload.wikimedia.org/wikipedia/commons/thumb/1/1b/Apple_iicb.jpg/150px-Apple_iicb.jpg"  title="Apple IIc (Wikipedia)" /></a></span>',
@@ -411,6 +426,33 @@ class IzuParserTest(RigTestCase):
         self.assertEquals(
               "&ccedil;a, o&ugrave; est le pr&eacute; pr&egrave;s du pr&ecirc;t?",
               self.m._ConvertAccents("a, o est le pr prs du prt?"))
+        self.assertEquals(
+              u"&ccedil;a, o&ugrave; est le pr&eacute; pr&egrave;s du pr&ecirc;t?",
+              self.m._ConvertAccents(u"a, o est le pr prs du prt?"))
+        # ASCII lines and characters which are not in the table are unchanged
+        self.assertEquals("a <b>c</b>", self.m._ConvertAccents("a <b>c</b>"))
+        self.assertEquals(u"\u20ac ", self.m._ConvertAccents(u"\u20ac "))
+        self.assertEquals("\xc3\xa9t\xc3\xa9", self.m._ConvertAccents("\xc3\xa9t\xc3\xa9"))
+
+    def _OldConvertAccents(self, line):
+        # Reference implementation which replaces each accent of the table
+        # one after the other.
+        is_unicode = isinstance(line, unicode)
+        for k, v in izu_parser._ACCENTS_TO_HTML.iteritems():
+            if is_unicode:
+                k = unicode(k, "iso-8859-1")
+            if k in line:
+                line = line.replace(k, v)
+        return line
+
+    def testConvertAccentsReference(self):
+        # The timing of _ConvertAccents is measured by the izu_bench stages.
+        accents = "".join(izu_parser._ACCENTS_TO_HTML.keys())
+        line = "L't, a chauffe prs du pr o %s va " % accents
+        lines = [ line, unicode(line, "iso-8859-1"), 3 * "No accent here. ", u"Nor here." ]
+        for line in lines:
+            line = 20 * line
+            self.assertEquals(self._OldConvertAccents(line), self.m._ConvertAccents(line))
 
     def testAutoLink(self):
         self.assertEquals(
@@ -443,6 +485,22 @@ class IzuParserTest(RigTestCase):
             '<span class="izu">\n<img alt="My Image" title="My Image" src="http://www.example.code/image.gif"></span>',
             self._Render("[My Image|http://www.example.code/image.gif]"))
 
+    def testPostLink(self):
+        self.assertEquals(
+            '<span class="izu">\n<a href="izu-post::20070102:">A post</a></span>',
+            self._Render("[A post|#s:20070102]"))
+
+        # the category and title are left alone by the rest of the formatting
+        html = self._Render("[L\xe9 ''post''|/my_cat#s:20070102:__t\xe9 t\xe9__]")
+        self.assertEquals(
+            '<span class="izu">\n<a href="izu-post:my%5Fcat:20070102:t%E9%20t%E9">'
+            'L&eacute; <i>post</i></a></span>',
+            html)
+        m = izu_parser.RE_POST_LINK.search(html)
+        self.assertEquals("L&eacute; <i>post</i>", m.group(4))
+        self.assertEquals(("my_cat", "20070102", "t\xe9 t\xe9"),
+                          izu_parser.PostLinkTarget(*m.group(1, 2, 3)))
+
     def testRigLink(self):
         self.m = MockIzuParser(self.Log(),
                    glob={ "A01234*.jpg": "A01234 My Image.jpg",
@@ -570,6 +628,44 @@ class IzuParserTest(RigTestCase):
             '</span>',
             self._Render("Here: [caption|rigimg:*dir/flag*.gif] [caption|rigimg:*dir" + os.path.sep + "flag*.gif]"))
 
+    def testRigImageDims(self):
+        # the dimensions of the 128x96 image scaled to the displayed size
+        album = os.path.join(self.getTestDataPath(), "album", "blog1", "2007-10-07_Folder 1")
+        m = IzuParser(self.Log(), "http://rig", None, img_dims=True)
+        text = ("[A|rigimg:64:T*_jpeg.jpg]\n[B|rigimg:T*_jpeg.jpg]\n"
+                "[C|rigimg:64:T*_jpeg.jpg|caption]\n[D|rigimg:size:T*_jpeg.jpg]\n")
+        tags, sections = m.RenderStringToHtml(text, rel_file=RelFile(album, "index.izu"))
+        keywords = { "rig_base": "http://rig", "curr_album": "a",
+                     "rig_thumb_url": "%(img)s@%(size)s", "rig_img_size": 100,
+                     "rig_img_dims": 'width="%(width)s" height="%(height)s"' }
+        self.assertEquals(
+            '<span class="izu">\n'
+            '<img title="A" src="T12896_tiny_jpeg.jpg@64" width="64" height="48">\n'
+            '<img title="B" src="T12896_tiny_jpeg.jpg@100" width="100" height="75">\n'
+            '<img title="C" src="T12896_tiny_jpeg.jpg@64" width="64" height="48"><br/><tt>caption</tt>\n'
+            '<img title="D" src="T12896_tiny_jpeg.jpg@size"></span>',
+            Template(self.Log(), source=sections["en"]).Generate(keywords))
+
+        # nothing is added when rig_img_dims is empty
+        keywords["rig_img_dims"] = ""
+        keywords["rig_img_size"] = 512
+        self.assertEquals(
+            '<span class="izu">\n'
+            '<img title="A" src="T12896_tiny_jpeg.jpg@64">\n'
+            '<img title="B" src="T12896_tiny_jpeg.jpg@512">\n'
+            '<img title="C" src="T12896_tiny_jpeg.jpg@64"><br/><tt>caption</tt>\n'
+            '<img title="D" src="T12896_tiny_jpeg.jpg@size"></span>',
+            Template(self.Log(), source=sections["en"]).Generate(keywords))
+
+        # the images are not read unless the parser wants their dimensions
+        reads = stats.Start("1.0 Img Size Read").count
+        hits = stats.Start("1.0 Img Size Hit").count
+        m = IzuParser(self.Log(), "http://rig", None)
+        tags, sections = m.RenderStringToHtml(text, rel_file=RelFile(album, "index.izu"))
+        self.assertFalse("rig_img_dims" in sections["en"])
+        self.assertEquals(reads, stats.Start("1.0 Img Size Read").count)
+        self.assertEquals(hits, stats.Start("1.0 Img Size Hit").count)
+
     def testSectionImage(self):
         self.m = MockIzuParser(self.Log(),
                                glob={ "A01234*.jpg": "A01234 My Image.jpg" },
@@ -757,6 +853,310 @@ class IzuParserTest(RigTestCase):
                                   is_link=True, size="size4", caption="caption5"))
 
 
+    def testCompileRender(self):
+        text = ("[izu:cat:foo] Some __text__\n"
+                "[Image|rigimg:T*.jpg]\n"
+                "[!html:<b>raw</b>--]\n"
+                "[s:images]\n"
+                "[rigimg:T*.jpg]")
+        self.m = MockIzuParser(self.Log(),
+                               glob={ "T*.jpg": "T12896.jpg" },
+                               rig_base=None,
+                               img_gen_script=None)
+        doc = self.m.Compile(StringIO(text))
+        self.assertDictEquals({ "cat": { "foo": True } }, doc.tags)
+        self.assertListEquals(
+            [ ("en", "line", " Some <b>text</b>"),
+              ("en", "raw", "[Image|rigimg:T*.jpg]"),
+              ("en", "append", "<b>raw</b>\n"),
+              ("en", "line", ""),
+              ("images", "raw", ""),
+              ("images", "raw", "[rigimg:T*.jpg]") ],
+            doc.ops)
+
+        tags, sections = self.m.Render(doc, "file.izu", None)
+        self.assertEquals(self.m.RenderStringToHtml(text), (tags, sections))
+        self.assertHtmlEquals(
+            '<span class="izu">\n Some <b>text</b>\n[[if rig_base]]<img title="Image" '
+            'src="[[raw rig_thumb_url % { "rig_base": rig_base, "album": curr_album, '
+            '"img": "T12896.jpg", "size": rig_img_size } ]]">[[end]]<b>raw</b>\n</span>',
+            sections["en"])
+
+        # The same document rendered with an image generation script
+        m = MockIzuParser(self.Log(),
+                          glob={ "T*.jpg": "T12896.jpg" },
+                          rig_base="/pix/for/rig",
+                          img_gen_script="/path/to/my/script")
+        m.SetPopenValues(0, "some-url")
+        tags, sections = m.Render(doc, "file.izu", None)
+        self.assertHtmlEquals(
+            '<span class="izu">\n Some <b>text</b>\n<img title="Image" src="some-url">'
+            '<b>raw</b>\n</span>',
+            sections["en"])
+        self.assertListEquals([ '<img src="some-url">' ], sections["images"])
+
+    def testCompileCache(self):
+        tempdir = self.MakeTempDir()
+        try:
+            filename = os.path.join(tempdir, "index.izu")
+            f = file(filename, "w")
+            f.write("[izu:title:Title]\nSome [Image|rigimg:T*.jpg]\n")
+            f.close()
+
+            cache = Cache(self.Log(), tempdir)
+            s_load = stats.Start("1.1 Izu Compile Load")
+            s_miss = stats.Start("1.1 Izu Compile Miss")
+            loads = s_load.count
+            misses = s_miss.count
+
+            m = MockIzuParser(self.Log(), glob={ "T*.jpg": "T12896.jpg" },
+                              rig_base=None, img_gen_script=None, cache=cache)
+            result1 = m.RenderFileToHtml(filename, "iso-8859-1")
+            self.assertEquals(misses + 1, s_miss.count)
+            self.assertEquals(result1, m.RenderFileToHtml(filename, "iso-8859-1"))
+            self.assertEquals(loads + 1, s_load.count)
+
+            # Another parser with another image script reuses the document
+            m = MockIzuParser(self.Log(), glob={ "T*.jpg": "T12896.jpg" },
+                              rig_base="/pix/for/rig", img_gen_script="/path/to/my/script",
+                              cache=cache)
+            m.SetPopenValues(0, "some-url")
+            tags, sections = m.RenderFileToHtml(filename, "iso-8859-1")
+            self.assertEquals(misses + 1, s_miss.count)
+            self.assertEquals(loads + 2, s_load.count)
+            self.assertDictEquals({ "title": "Title" }, tags)
+            self.assertHtmlEquals('<span class="izu">\nSome <img title="Image" src="some-url"></span>',
+                                  sections["en"])
+        finally:
+            self.RemoveDir(tempdir)
+
+    _FUZZ_TOKENS = [ "[", "]", "[[", "|", ":", " ", '"', "<", ">", "/", "a", ".png",
+                     "http://", "ftp://", "#", "[izu:", "[izu:image:", "[s:", "[!--", "--]",
+                     "[!html:", "[html:", "b]", "[table:begin", "[col", "[row", "[table:end]",
+                     ":50%", "[izu_image:", ",align=left", "[youtube:", ":t=12", ":10x20",
+                     "[c]", "[br]", "[p]", "__", "''", "==", "_", "rigimg:", "rigimglink:",
+                     "riglink:", "#s:20070101", "* " ]
+
+    def testFuzz(self):
+        # Random soups of tags and special characters must never break the parser
+        m = MockIzuParser(self.Log(), glob={ "*a*": "a.jpg" }, rig_base=None, img_gen_script=None)
+        r = random.Random(42)
+        for i in xrange(2000):
+            text = "".join([ r.choice(self._FUZZ_TOKENS) for j in xrange(r.randint(1, 20)) ])
+            tags, sections = m.RenderStringToHtml(text + "\n" + text)
+            self.assertTrue(isinstance(tags, dict), repr(text))
+            self.assertTrue(isinstance(sections, dict), repr(text))
+
+    def testLongLines(self):
+        # Pathological lines: unclosed tags, runs of special characters, many
+        # tags or pasted HTML. Their render time is checked by the
+        # izu_bench.SCALING cases, see bench_izu.py --scaling.
+        m = MockIzuParser(self.Log(), glob=None, rig_base=None, img_gen_script=None)
+
+        def _en(html):
+            return {}, { "en": '<span class="izu">\n%s</span>' % html }
+        def _same(pattern):
+            return lambda n: _en(n * pattern)
+        def _toggle(pattern, tag):
+            # pairs of markers toggle the tag, an odd one is left as is
+            return lambda n: _en((n / 2) * ("<%s>x</%s>x" % (tag, tag)) +
+                                 (n % 2 and pattern[0] + "x" or ""))
+        html = '<a href="http://www.example.com/x.html">link</a> <div class="y">'
+        table = '[table:begin][col][row][table:end]'
+        youtube = '[youtube:a:10x20]'
+        expected = {
+            "some text ":               _same("some text "),
+            html:                       _same(html.replace("<", "&lt;").replace(">", "&gt;")),
+            "[x ":                      _same("[x "),
+            "[[":                       lambda n: _en((2 * n - 1) * "["),
+            "__x":                      _toggle("__x", "b"),
+            "''x":                      _toggle("''x", "i"),
+            "==x":                      _toggle("==x", "code"),
+            "__":                       lambda n: _en((2 * n - 1) * "_"),
+            "[izu:":                    _same("[izu:"),
+            "[izu:a:b]":                lambda n: ({ "a": "b" }, { "en": "" }),
+            "[izu:image:http://a.png]": _same('<img src="http://a.png"  />'),
+            "[s:":                      _same("[s:"),
+            "[s:a]x":                   lambda n: ({}, { "a": '<span class="izu">\nx%s\nx</span>' %
+                                                              ((n - 2) * "[s:a]x") }),
+            "[!--":                     lambda n: ({}, {}),
+            "[!--x--]":                 lambda n: ({}, { "en": "" }),
+            "[html:b]":                 _same("<b>"),
+            table:                      _same('<table border="0" ><tr valign="top"><td ></td>'
+                                              '<td ></td></tr><tr valign="top"><td ></td></tr>'
+                                              '</table>'),
+            "[izu_image:http://":       lambda n: _en('[izu_image:<a href="%s">%s</a>' %
+                                                      (2 * ("http://" + (n - 1) * "[izu_image:http://",))),
+            youtube:                    _same('[[raw youtube_html % { "id": "a", "sx": 10, '
+                                              '"sy": 20, "url_extra": "" } ]]'),
+            "[c]":                      lambda n: _en("<center></center>"),
+            "[a|http://x":              _same("[a|http://x"),
+            "[http://x":                _same("[http://x"),
+            "[a|http://x.png":          _same("[a|http://x.png"),
+            "[a|riglink:":              _same("[a|riglink:"),
+            "[a|rigimg:":               _same("[a|rigimg:"),
+            "[rigimg:a|b":              _same("[rigimg:a|b"),
+            "[a|#s:":                   _same("[a|#s:"),
+            "http://":                  lambda n: _en('<a href="%s">%s</a>' % (2 * (n * "http://",))),
+            "http://a_b":               lambda n: _en('<a href="%s">%s</a>' % (2 * (n * "http://a_b",))),
+            }
+        for name, pattern, count in izu_bench.SCALING:
+            if "\n" not in pattern:
+                self.assertEquals(expected[pattern](count), m.RenderStringToHtml(pattern * count),
+                                  name)
+
+    def testManyLines(self):
+        # The render time of many lines is checked by the "lines" case of
+        # izu_bench.SCALING, see bench_izu.py --scaling.
+        m = MockIzuParser(self.Log(), glob=None, rig_base=None, img_gen_script=None)
+        line = "Line of text with a <br> and a __bold__ word"
+        tags, sections = m.RenderStringToHtml(10000 * (line + "\n\n"))
+        html = "Line of text with a &lt;br&gt; and a <b>bold</b> word"
+        self.assertEquals('<span class="izu">\n' + "\n<p/>\n".join(10000 * [ html ]) + "</span>",
+                          sections["en"])
+
+    def testGlobGlob(self):
+        tempdir = self.MakeTempDir()
+        try:
+            os.mkdir(os.path.join(tempdir, "sub"))
+            for i in xrange(80):
+                f = file(os.path.join(tempdir, "sub", "img%02d.jpg" % i), "w")
+                f.close()
+            dir_parser.ClearListings()
+            s = stats.Start("1.0 Listdir")
+            listings = s.count
+
+            p = IzuParser(self.Log(), "http://example.com/rig", None)
+            self.assertEquals(os.path.join("sub", "img42.jpg"), p._GlobGlob(tempdir, "s*/*42.jp[eg]"))
+            self.assertEquals(None, p._GlobGlob(tempdir, "sub/*.png"))
+
+            # An image-heavy post lists each directory once
+            text = "".join([ "[Image %d|rigimg:256:sub/*%02d.jpg]\n" % (i, i) for i in xrange(80) ])
+            tags, sections = p.RenderStringToHtml(text, rel_file=RelFile(tempdir, "index.izu"))
+            for i in xrange(80):
+                self.assertTrue('"img": "img%02d.jpg"' % i in sections["en"])
+            self.assertEquals(listings + 2, s.count)
+        finally:
+            dir_parser.ClearListings()
+            self.RemoveDir(tempdir)
+
+    def testSpill(self):
+        tempdir = self.MakeTempDir()
+        try:
+            text = ("[s:en]\n" + 50 * "Line of __text__<br>[youtube:ab_CdefgGh]\n\n" +
+                    "[s:fr]\nCourt\n[s:html]\n<b>html</b>")
+            tags, expected = IzuParser(self.Log(), None, None).RenderStringToHtml(text)
+            p = IzuParser(self.Log(), None, None, spill_dir=tempdir, spill_size=100)
+            tags, sections = p.RenderStringToHtml(text)
+            self.assertListEquals([ "en", "fr", "html" ], sections.keys(), sort=True)
+            self.assertTrue(isinstance(sections["en"], SpillFile))
+            self.assertEquals(expected["en"], sections["en"].Read())
+            self.assertEquals(expected["fr"], sections["fr"])
+            self.assertEquals(expected["html"], sections["html"])
+
+            # spilled sections are temporary files removed by the caller
+            self.assertListEquals([ os.path.basename(sections["en"].Path()) ], os.listdir(tempdir))
+            sections["en"].Remove()
+            self.assertListEquals([], os.listdir(tempdir))
+        finally:
+            self.RemoveDir(tempdir)
+
+    def testUnicodeText(self):
+        source = (u"[izu:cat:\xc9t\xe9,foo] [izu:title:Caf\xe9 \u20ac\xa0]\n"
+                  u"[s:\xe9]\xa0Un \xe9t\xe9 \xe0 3\u20ac\x85 __tr\xe8s__ [\xe9|http://x/\xe9]\n"
+                  u"[s:en]\n* \xe7a\u2028\n")
+        for encoding in [ "iso-8859-1", "utf-8" ]:
+            data = source.encode(encoding, "xmlcharrefreplace")
+            f = codecs.getreader(encoding)(StringIO(data))
+            tags, expected = IzuParser(self.Log(), None, None).RenderFileToHtml(f)
+            f = codecs.getreader(encoding)(StringIO(data))
+            p = IzuParser(self.Log(), None, None, unicode_text=True)
+            tags2, sections = p.RenderFileToHtml(f)
+
+            # tags and section names are still ISO-8859-1 strings
+            self.assertEquals(repr(tags), repr(tags2))
+            self.assertListEquals([ "en", "\xe9" ], sections.keys(), sort=True)
+            for k, v in sections.iteritems():
+                self.assertTrue(isinstance(v, unicode))
+                self.assertEquals(expected[k].decode("iso-8859-1"), v)
+
+    def testSectionBuffer(self):
+        b = izu_parser._SectionBuffer()
+        self.assertFalse(b)
+        self.assertEquals("", b.Text())
+        self.assertFalse(b.EndsWith("\n"))
+        b.Append("")
+        self.assertFalse(b)
+        for c in "abc<b":
+            b.Append(c)
+        b.Append("r>")
+        self.assertTrue(b)
+        self.assertTrue(b.EndsWith("<br>"))
+        b.Append("\n0123456789<p/>")
+        self.assertTrue(b.EndsWith("<p/>"))
+        self.assertFalse(b.EndsWith("<br>"))
+        self.assertEquals("abc<br>\n0123456789<p/>", b.Text())
+        self.assertEquals("abc<br>\n0123456789<p/>", b.Text())
+        b.Append(u"\xe9")
+        self.assertEquals(u"abc<br>\n0123456789<p/>\xe9", b.Text())
+
+    def testTagsToNodes(self):
+        log = self.Log()
+        t = izu_parser._Tag
+        html = ('<span class="izu">\n' + t("if rig_base") + '<img src="' +
+                t('raw rig_thumb_url % { "img": "A%20B.jpg", "size": "64" } ') + '"' +
+                t("if rig_img_dims") + " " + t('raw rig_img_dims % { "width": 64, "height": 48 } ') +
+                t("end") + ">" + t("end") + "\n" +
+                t('raw youtube_html % { "id": "ab_CdefgGh", "sx": 640, "sy": 385, "url_extra": "" } ') +
+                ".</span>")
+        self.assertFalse("[[" in html)
+        self.assertEquals(
+            '<span class="izu">\n[[if rig_base]]<img src="'
+            '[[raw rig_thumb_url % { "img": "A%20B.jpg", "size": "64" } ]]"'
+            '[[if rig_img_dims]] [[raw rig_img_dims % { "width": 64, "height": 48 } ]][[end]]>'
+            '[[end]]\n[[raw youtube_html % { "id": "ab_CdefgGh", "sx": 640, "sy": 385, "url_extra": "" } ]]'
+            '.</span>',
+            izu_parser._TagsToText(html))
+        self.assertEquals(Template(log, source=izu_parser._TagsToText(html)).Nodes(),
+                          izu_parser._TagsToNodes(log, html))
+
+        # text with template tags of its own is parsed as a template
+        html = "[[raw a]] " + t("if b") + "[[raw c]]" + t("end")
+        self.assertEquals("[[raw a]] [[if b]][[raw c]][[end]]", izu_parser._TagsToText(html))
+        self.assertEquals(Template(log, source="[[raw a]] [[if b]][[raw c]][[end]]").Nodes(),
+                          izu_parser._TagsToNodes(log, html))
+
+    def testTemplateNodes(self):
+        log = self.Log()
+        album = os.path.join(self.getTestDataPath(), "album", "blog1", "2007-10-07_Folder 1")
+        text = ("[A|rigimg:64:T*_jpeg.jpg]\n[B|riglink:T*_jpeg.jpg]\n"
+                "[youtube:ab_CdefgGh:640x385]\n[s:fr]\nCourt [[[raw foo]]\n"
+                "[s:images][C|rigimg:T*_jpeg.jpg]\n[D|rigimg:64:T*_jpeg.jpg|caption]")
+        keywords = { "rig_base": "http://rig", "curr_album": "a", "foo": "<foo>",
+                     "rig_img_url": "%(img)s", "rig_thumb_url": "%(img)s@%(size)s",
+                     "rig_img_size": 100, "rig_img_dims": 'width="%(width)s"',
+                     "youtube_html": "%(id)s %(sx)s %(sy)s" }
+        m = IzuParser(log, "http://rig", None, img_dims=True)
+        tags, expected = m.RenderStringToHtml(text, rel_file=RelFile(album, "index.izu"))
+        m = IzuParser(log, "http://rig", None, img_dims=True, template_nodes=True)
+        tags, sections = m.RenderStringToHtml(text, rel_file=RelFile(album, "index.izu"))
+        self.assertListEquals([ "en", "fr", "images" ], sections.keys(), sort=True)
+        for k in [ "en", "fr" ]:
+            self.assertEquals(Template(log, source=expected[k]).Generate(keywords),
+                              Template(log, nodes=sections[k]).Generate(keywords))
+        self.assertEquals(2, len(sections["images"]))
+        self.assertListEquals(
+            [ Template(log, source=v).Generate(keywords) for v in expected["images"] ],
+            [ Template(log, nodes=n).Generate(keywords) for n in sections["images"] ])
+        self.assertEquals(
+            '<span class="izu">\n'
+            '<img title="A" src="T12896_tiny_jpeg.jpg@64" width="64">\n'
+            '<a title="B" href="T12896_tiny_jpeg.jpg">B</a>\n'
+            'ab_CdefgGh 640 385</span>',
+            Template(log, nodes=sections["en"]).Generate(keywords))
+        self.assertEquals('<span class="izu">\nCourt <foo></span>',
+                          Template(log, nodes=sections["fr"]).Generate(keywords))
+
 
 #------------------------
 # Local Variables:
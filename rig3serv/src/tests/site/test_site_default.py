@@ -23,7 +23,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 __author__ = "ralfoide at gmail com"
 
 import os
+import shutil
+import time
 import types
+import zipfile
 from datetime import datetime
 
 from tests.rig_test_case import RigTestCase
@@ -32,10 +35,13 @@ from rig.site.site_default import SiteDefault, ContentEntry
 from rig.site_base import DEFAULT_THEME, SiteItem
 from rig.sites_settings import SiteSettings
 from rig.parser.dir_parser import DirParser, RelDir, RelFile
-from rig.source_reader import SourceDirReader
+from rig.source_reader import SourceBlogReader, SourceDirReader, SourceArchiveReader
 from rig.source_item import SourceDir, SourceSettings, SourceContent
-from rig.sites_settings import SiteSettings, SitesSettings
+from rig.sites_settings import SiteSettings, SitesSettings, IncludeExclude
 from rig.sites_settings import DEFAULT_ITEMS_PER_PAGE
+from rig.spill_file import SpillFile, SpillWriter
+from rig import stats
+from rig.parser import izu_parser
 
 #------------------------
 class MockSiteDefault(SiteDefault):
@@ -299,6 +305,190 @@ class SiteDefaultTest(RigTestCase):
         self.assertHtmlMatches(r'<div class="entry">.+</div>', item.content_gen(SiteDefault._TEMPLATE_HTML_ENTRY))
         self.assertListEquals([ "foo", "bar", "other" ], item.categories, sort=True)
 
+    def testGenerateItems_Spill(self):
+        source_dir = os.path.join(self.getTestDataPath(), "album", "blog1")
+        item = SourceDir(datetime.today(),
+                         RelDir(source_dir, "2007-10-07_Folder 1"),
+                         [ "index.izu" ],
+                         self.sos)
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        expected = m.GenerateItem(item).content_gen(SiteDefault._TEMPLATE_HTML_ENTRY)
+
+        self.sis.spill_size = 10
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        m._cache.Clear()
+
+        # keep the sections returned by the full renders
+        m.org_GenItem_GetSections = m._GenItem_GetSections
+        m.sections = []
+        def Patch_GenItem_GetSections(self, *args):
+            sections, tags = self.org_GenItem_GetSections(*args)
+            self.sections.append(sections)
+            return sections, tags
+        m._GenItem_GetSections = types.MethodType(Patch_GenItem_GetSections, m, SiteDefault)
+
+        content = m.GenerateItem(item).content_gen(SiteDefault._TEMPLATE_HTML_ENTRY)
+        self.assertEquals(expected, content)
+        self.assertEquals(1, len(m.sections))
+
+        # the cache refers to the generated sections, the spilled izu
+        # sections have been removed
+        spilled = [ v for v in m.sections[0].itervalues() if isinstance(v, SpillFile) ]
+        self.assertTrue(spilled)
+        for v in spilled:
+            self.assertTrue(v.Exists())
+            self.assertEquals(m._spill_dir, os.path.dirname(os.path.dirname(v.Path())))
+        self.assertListEquals([], [ f for f in os.listdir(m._spill_dir) if f.endswith(".tmp") ])
+
+        # spill files removed behind the cache's back are generated again
+        m.GenerateItem(item)
+        self.assertEquals(1, len(m.sections))
+        for v in spilled:
+            v.Remove()
+        content = m.GenerateItem(item).content_gen(SiteDefault._TEMPLATE_HTML_ENTRY)
+        self.assertEquals(expected, content)
+        self.assertEquals(2, len(m.sections))
+        for v in spilled:
+            self.assertTrue(v.Exists())
+
+        # a spilled section which template fails leaves no temporary file
+        writer = SpillWriter(m._spill_dir)
+        writer.Write("<b>[[if rig_base]]not closed\n")
+        spill_file = writer.Close(store=False)
+        self.assertRaises(SyntaxError, m._GenItem_GenerateSpillFile, spill_file, {})
+        self.assertFalse(spill_file.Exists())
+        self.assertListEquals([], [ f for f in os.listdir(m._spill_dir) if f.endswith(".tmp") ])
+
+    def testGenerateItems_CatPrefilter(self):
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        m._enable_cache = False
+
+        # count the number of full renders
+        m.org_GenItem_GetSections = m._GenItem_GetSections
+        m.count_sections = 0
+        def Patch_GenItem_GetSections(self, *args):
+            self.count_sections += 1
+            return self.org_GenItem_GetSections(*args)
+        m._GenItem_GetSections = types.MethodType(Patch_GenItem_GetSections, m, SiteDefault)
+
+        source_dir = os.path.join(self.getTestDataPath(), "album", "blog1")
+        izu_item = SourceDir(datetime.today(),
+                             RelDir(source_dir, "2007-10-07_Folder 1"),
+                             [ "index.izu" ],
+                             self.sos)
+        content_item = SourceContent(
+                date=datetime(2006, 5, 28, 17, 18, 5),
+                rel_file=RelFile(source_dir, "Main.blog.izu"),
+                title="Title",
+                content="[izu:cat:ignored]\nContent",
+                tags={ "cat": { "main": True } },
+                source_settings=self.sos)
+
+        s = stats.Start("1.1 Izu Skipped")
+        skipped = s.count
+
+        # the izu header has the categories foo, bar and other
+        self.sis.cat_filter = IncludeExclude()
+        self.sis.cat_filter.Set("cat_filter", "!foo")
+        self.assertEquals(None, m.GenerateItem(izu_item))
+        self.assertEquals(0, m.count_sections)
+        self.assertEquals(skipped + 1, s.count)
+
+        # an izu item not included by its header is still rendered since
+        # later izu:cat tags could add an included category
+        self.sis.cat_filter = IncludeExclude()
+        self.sis.cat_filter.Set("cat_filter", "main")
+        self.assertEquals(None, m.GenerateItem(izu_item))
+        self.assertEquals(1, m.count_sections)
+        self.assertNotEquals(None, m.GenerateItem(content_item))
+        self.assertEquals(2, m.count_sections)
+        self.assertEquals(skipped + 1, s.count)
+
+        self.sis.cat_filter = IncludeExclude()
+        self.sis.cat_filter.Set("cat_filter", "other")
+        self.assertNotEquals(None, m.GenerateItem(izu_item))
+        self.assertEquals(None, m.GenerateItem(content_item))
+        self.assertEquals(3, m.count_sections)
+        self.assertEquals(skipped + 2, s.count)
+
+    def testGenerateItems_CatPrefilterLaterCat(self):
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        m._enable_cache = False
+        album = self.MakeTempDir()
+        try:
+            f = file(os.path.join(album, "index.izu"), "w")
+            f.write("[izu:cat:foo]\n[s:en]\nSome text\n[izu:cat:main]\nMore text\n")
+            f.close()
+            izu_item = SourceDir(datetime.today(), RelDir(album, ""), [ "index.izu" ], self.sos)
+
+            self.sis.cat_filter = IncludeExclude()
+            self.sis.cat_filter.Set("cat_filter", "main")
+            item = m.GenerateItem(izu_item)
+            self.assertNotEquals(None, item)
+            self.assertListEquals([ "foo", "main" ], item.categories)
+
+            self.sis.cat_filter = IncludeExclude()
+            self.sis.cat_filter.Set("cat_filter", "!main")
+            self.assertEquals(None, m.GenerateItem(izu_item))
+        finally:
+            self.RemoveDir(album)
+
+    def testGenerateItems_ArchiveContent(self):
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        m._enable_cache = False
+        album = self.MakeTempDir()
+        try:
+            path = os.path.join(album, "blog.zip")
+            z = zipfile.ZipFile(path, "w")
+            z.writestr("2007-10-07 Post.izu",
+                       "[izu:cat:foo]\n[s:en]\nText [Image|rigimg:J1234*.jpg]\n[izu:cat:main]\n")
+            z.writestr("J1234-image.jpg", "not really a jpeg")
+            z.close()
+            items = SourceArchiveReader(self.Log(), self.sis, self.sos, path).Parse(album)
+            self.assertEquals(1, len(items))
+
+            # The izu tags after the header are added when rendering
+            self.sis.cat_filter = IncludeExclude()
+            self.sis.cat_filter.Set("cat_filter", "main")
+            item = m.GenerateItem(items[0])
+            self.assertNotEquals(None, item)
+            self.assertListEquals([ "foo", "main" ], item.categories)
+
+            # Images are not supported in archives
+            self.assertFalse("J1234" in item.content_gen(SiteDefault._TEMPLATE_HTML_ENTRY))
+
+            self.sis.cat_filter = IncludeExclude()
+            self.sis.cat_filter.Set("cat_filter", "!main")
+            self.assertEquals(None, m.GenerateItem(items[0]))
+
+            # An entry without header categories may get one further down
+            z = zipfile.ZipFile(path, "w")
+            z.writestr("2007-10-08 Later.izu", "[s:en]\nText\n[izu:cat:main]\n")
+            z.close()
+            items = SourceArchiveReader(self.Log(), self.sis, self.sos, path).Parse(album)
+            self.sis.cat_filter = IncludeExclude()
+            self.sis.cat_filter.Set("cat_filter", "!$")
+            item = m.GenerateItem(items[0])
+            self.assertNotEquals(None, item)
+            self.assertListEquals([ "main" ], item.categories)
+        finally:
+            self.RemoveDir(album)
+
+    def testGenerateItems_HtmlContent(self):
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        source_dir = os.path.join(self.getTestDataPath(), "album", "blog2")
+        item = m.GenerateItem(SourceContent(
+                date=datetime(2006, 5, 28, 17, 18, 5),
+                rel_file=RelFile(source_dir, "2006-05_Movies/index.html"),
+                title="2006-05_Movies",
+                content="<!-- [izu:cat:videos] -->\n<b>Html</b> content",
+                tags={ "cat": { "videos": True } },
+                source_settings=self.sos))
+        self.assertNotEquals(None, item)
+        self.assertHtmlMatches(r'<div class="entry">.+<b>Html</b> content.+</div>',
+                               item.content_gen(SiteDefault._TEMPLATE_HTML_ENTRY))
+        self.assertListEquals([ "videos" ], item.categories, sort=True)
+
     def testGenerateItems_Html(self):
         m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
         source_dir = os.path.join(self.getTestDataPath(), "album", "blog2")
@@ -416,6 +606,58 @@ class SiteDefaultTest(RigTestCase):
             '<table class="image-table"><tr><td>\n' + m._GetRigLink(keywords, RelDir("base", ""), "J1234-image.jpg", 300) + '</td></tr></table>',
             m._GenerateImages(RelDir("base", ""), [ "J1234-image.jpg" ], keywords))
 
+    def testGenerateImages_Manifest(self):
+        album = self.MakeTempDir()
+        try:
+            files = [ "J1234-image.jpg", "J1235_other.jpg", "index.izu" ]
+            for name in files:
+                f = file(os.path.join(album, name), "w")
+                f.close()
+            source_dir = RelDir(album, "")
+            self.sis.img_manifest = True
+            s_hit = stats.Start("2.1 Img Manifest Hit")
+            s_scan = stats.Start("2.1 Img Manifest Scan")
+
+            def _generate():
+                m = MockSiteDefault(self, self.Log(), False, True, self.sis)
+                calls = []
+                scan = m._ScanImages
+                m._ScanImages = lambda *args: calls.append(args) or scan(*args)
+                html = m._GenerateImages(source_dir, files, self.keywords)
+                # the manifest is kept for the other pages of the run
+                self.assertEquals(html, m._GenerateImages(source_dir, files, self.keywords))
+                m.Dispose()
+                return html, len(calls)
+
+            hits = s_hit.count
+            scans = s_scan.count
+            html, calls = _generate()
+            self.assertEquals(1, calls)
+            self.assertTrue("J1234-image.jpg" in html)
+            self.assertEquals(scans + 1, s_scan.count)
+
+            # the next run doesn't look at the images
+            self.assertEquals((html, 0), _generate())
+            self.assertEquals(hits + 1, s_hit.count)
+
+            # until the album changes
+            f = file(os.path.join(album, "J1236-new.jpg"), "w")
+            f.close()
+            os.utime(album, (0, time.time() + 10))
+            html2, calls = _generate()
+            self.assertEquals(1, calls)
+            self.assertTrue("J1236-new.jpg" not in html2)
+            files.append("J1236-new.jpg")
+            html2, calls = _generate()
+            self.assertEquals(1, calls)
+            self.assertTrue("J1236-new.jpg" in html2)
+
+            # the manifest gives the same table as a scan of each page
+            self.sis.img_manifest = False
+            self.assertEquals((html2, 2), _generate())
+        finally:
+            self.RemoveDir(album)
+
     def testGenerateIndexPage(self):
         m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
 
@@ -1038,6 +1280,86 @@ class SiteDefaultTest(RigTestCase):
         m._ClearCache(new_sis)
         self.assertEquals(2, m.CacheClearCount(reset=False))
 
+    def testClearIzuCache(self):
+        """
+        The izu cache shared by the sites is named after the parser code
+        and the entries of older code are removed.
+        """
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis)
+        izu_dir = m._IzuCacheDir(self._cachedir)
+        self.assertEquals(os.path.join(self._cachedir, "izu_documents"), os.path.dirname(izu_dir))
+        m._izu_cache.Store("document", "key")
+        self.assertEquals("document", m._izu_cache.Find("key"))
+
+        # A new site with the same code keeps the entries
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis)
+        self.assertEquals(izu_dir, m._IzuCacheDir(self._cachedir))
+        self.assertTrue(os.path.isdir(izu_dir))
+
+        # Another version of the parser uses another directory and
+        # removes the older ones.
+        old_digest = izu_parser._CODE_DIGEST[:]
+        try:
+            izu_parser._CODE_DIGEST[:] = [ "another code" ]
+            m = MockSiteDefault(self, self.Log(), False, True, self.sis)
+            self.assertNotEquals(izu_dir, m._IzuCacheDir(self._cachedir))
+            self.assertFalse(os.path.exists(izu_dir))
+            self.assertEquals(None, m._izu_cache.Find("key"))
+        finally:
+            izu_parser._CODE_DIGEST[:] = old_digest
+
+    def testProcess_UpToDate(self):
+        source_dir = os.path.join(self.MakeTempDir(), "blog1")
+        try:
+            shutil.copytree(os.path.join(self.getTestDataPath(), "album", "blog1"), source_dir)
+            self.sis.source_list = [ SourceBlogReader(self.Log(), self.sis, self.sos, source_dir) ]
+            s = stats.Start("1-parse")
+
+            def _process(force=False):
+                m = MockSiteDefault(self, self.Log(), False, force, self.sis)
+                m.Process()
+                m.Dispose()
+                return len(m._write_file_params)
+
+            # Sites are only skipped when skip_unchanged is set
+            for i in xrange(2):
+                count = s.count
+                _process()
+                self.assertNotEquals(count, s.count)
+            self.sis.skip_unchanged = True
+
+            count = s.count
+            self.assertNotEquals(0, _process())
+            self.assertNotEquals(count, s.count)
+
+            # Nothing changed: the sources are not even parsed
+            count = s.count
+            self.assertEquals(0, _process())
+            self.assertEquals(count, s.count)
+
+            # Unless generation is forced
+            self.assertNotEquals(0, _process(force=True))
+            self.assertNotEquals(count, s.count)
+
+            # A source file changed
+            filename = os.path.join(source_dir, "2007-10-07_Folder 1", "index.izu")
+            os.utime(filename, (0, time.time() + 10))
+            count = s.count
+            _process()
+            self.assertNotEquals(count, s.count)
+
+            count = s.count
+            self.assertEquals(0, _process())
+            self.assertEquals(count, s.count)
+
+            # A source file restored with an older time
+            os.utime(filename, (0, 1000000000))
+            count = s.count
+            _process()
+            self.assertNotEquals(count, s.count)
+        finally:
+            self.RemoveDir(os.path.dirname(source_dir))
+
 
     def testGenerateItems_Pipeline(self):
         m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
@@ -1079,9 +1401,8 @@ crosslink: [To folder 1 in another category|/bar#s:20071007:Folder 1]""",
 youtube: <object width="345" height="678"> <param name="movie" value="http://www.youtube-nocookie.com/v/ID&hl=en&fs=1&rel=0&color1=0x234900&color2=0x4e9e00&t=12"></param>\n<param name="allowFullScreen" value="true"></param>\n<param name="allowscriptaccess" value="always"></param>\n<embed src="http://www.youtube-nocookie.com/v/ID&hl=en&fs=1&rel=0&color1=0x234900&color2=0x4e9e00" type="application/x-shockwave-flash" allowscriptaccess="always" allowfullscreen="true" width="345" height="678"></embed>\n</object>
 riglink: <a title="link name" href="http://example.com/photos/index.php?album=&img=T12896_tiny1.jpg">link name</a>
 rigimg: <img title="img name" src="http://example.com/photos/index.php?th=&album=&img=T12896_tiny2.jpg&sz=size&q=75">
-innerlink: <pre> *** curr_category=[[raw locals().get(\'curr_category\', \'NOT-SET2\')]] permalink_url=[[raw locals().get(\'permalink_url\', \'NOT-SET\')]] rel_permalink_url=[[raw locals().get(\'rel_permalink_url\', \'NOT-SET\')]] </pre>
-crosslink: <pre> *** curr_category=[[raw locals().get(\'curr_category\', \'NOT-SET2\')]] permalink_url=[[raw locals().get(\'permalink_url\', \'NOT-SET\')]] rel_permalink_url=[[raw locals().get(\'rel_permalink_url\', \'NOT-SET\')]]
-</pre></span>""",
+innerlink: <a href="izu-post::20071007:Folder%201">To folder 1 in same category</a>
+crosslink: <a href="izu-post:bar:20071007:Folder%201">To folder 1 in another category</a></span>""",
                 sections["en"])
 
             return sections, tags
@@ -1113,6 +1434,58 @@ crosslink: <pre> *** curr_category=[[raw locals().get(\'curr_category\', \'NOT-S
         # category.
         self.assertEquals(4+3, len(data_result))
 
+    def testPostLinks(self):
+        m = MockSiteDefault(self, self.Log(), False, True, self.sis).MakeDestDirs()
+        m._enable_cache = False
+
+        source_dir = os.path.join(self.getTestDataPath(), "album", "blog2", "2007-10-07 11.00_Folder 2")
+        def _Item(date, title, cats, content):
+            tags = { "date": date }
+            if cats:
+                tags["cat"] = dict([ (c, True) for c in cats ])
+            return m.GenerateItem(SourceContent(date=date,
+                                                rel_file=RelFile(source_dir, title + ".izu"),
+                                                title=title,
+                                                content=content,
+                                                tags=tags,
+                                                source_settings=self.sos))
+
+        a = _Item(datetime(2007, 1, 1), "Post A", [ "foo" ],
+                  "[To B|#s:20070102:Post B] [To B in bar|/bar#s:20070102:post b] "
+                  "[To B in foo|/foo#s:20070102:Post B] [To C|#s:20070103] "
+                  "[To D|#s:20070104:Post D]")
+        b = _Item(datetime(2007, 1, 2), "Post B", [ "bar", "foo" ], "Content of B")
+        c = _Item(datetime(2007, 1, 3), "Post C", None, "[To A|#s:20070101:Post A]")
+        m.GeneratePages(categories=[ "bar", "foo" ], items=[ a, b, c ])
+
+        pages = dict([ (p[m._LEAFNAME], p[m._DATA])
+                       for p in m._write_file_params ])
+        # links without category go to the current one, or the first one
+        self.assertSearch('<a href="cat/bar/post_2007-01-02_post-b.html">To B</a>',
+                          pages["index.html"])
+        self.assertSearch('<a href="cat/foo/post_2007-01-01_post-a.html">To A</a>',
+                          pages["post_2007-01-03_post-c.html"])
+        foo_post = pages[os.path.join("cat", "foo", "post_2007-01-01_post-a.html")]
+        self.assertSearch('<a href="../../cat/foo/post_2007-01-02_post-b.html">To B</a>',
+                          foo_post)
+        self.assertSearch('<a href="../../cat/bar/post_2007-01-02_post-b.html">To B in bar</a>',
+                          foo_post)
+        self.assertSearch('<a href="../../cat/foo/post_2007-01-02_post-b.html">To B in foo</a>',
+                          foo_post)
+        self.assertSearch('<a href="../../post_2007-01-03_post-c.html">To C</a>', foo_post)
+        # links to missing posts only keep their label
+        self.assertSearch('</a> To D</span>', foo_post)
+        self.assertNotSearch("izu-post:", foo_post)
+
+        # without category pages, posts with categories are linked in the month pages
+        m._write_file_params = []
+        m.GeneratePages(categories=[ "foo" ], items=[ a, b, c ])
+        pages = dict([ (p[m._LEAFNAME], p[m._DATA])
+                       for p in m._write_file_params ])
+        self.assertSearch('<a href="2007-01.html#post-b">To B</a>', pages["2007-01.html"])
+        self.assertSearch('<a href="2007-01.html#post-a">To A</a>',
+                          pages["post_2007-01-03_post-c.html"])
+
 #------------------------
 # Local Variables:
 # mode: python
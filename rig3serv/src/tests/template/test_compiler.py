@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for the template Compiler
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+
+from tests.rig_test_case import RigTestCase
+from rig.template.compiler import Compiler
+from rig.template.template import Template
+
+#------------------------
+class CompilerTest(RigTestCase):
+
+    def _Generate(self, source, keywords, compiled):
+        """
+        Returns the content generated by a template, or the type and message
+        of the exception it raised.
+        """
+        try:
+            return Template(self.Log(), source=source, compiled=compiled).Generate(keywords)
+        except Exception, e:
+            return type(e), str(e)
+
+    def _AssertSame(self, source, keywords):
+        expected = self._Generate(source, keywords, compiled=False)
+        self.assertEquals(expected, self._Generate(source, keywords, compiled=True))
+        return expected
+
+    def testSource(self):
+        t = Template(self.Log(), source="a[[# comment]]b[[[c]] [[raw x]][[if x]]d[[end]]"
+                                         "[[for v in l]][[html v]][[end]]")
+        c = Compiler()
+        source = c.Source(t._nodes)
+        # literals around the comment and the escape are merged
+        self.assertTrue("ab[[c]] " in c.Consts())
+        self.assertEquals(1, source.count("_a(_k[0])"))
+        self.assertTrue("    if _eval(" in source)
+        self.assertTrue("    for _v1 in _eval(" in source)
+        self.assertTrue("        ctx1 = _dict(ctx0)" in source)
+        # expressions are compiled once
+        self.assertEquals(4, len([ k for k in c.Consts() if hasattr(k, "co_code") ]))
+
+    def testGenerate(self):
+        keywords = { "a": 42,
+                     "s": "<a href='x?a=1&b=2'>\xe9t\xe9</a>",
+                     "u": u"\xe9t\xe9 \u20ac",
+                     "l": [ 1, 2, 3 ],
+                     "d": { "k": [ "x", "y" ] },
+                     "empty": [] }
+        for source in [ "",
+                        "no tag at all\n",
+                        "[[raw a+1]] [[raw a==1]] [[raw d['k']]]",
+                        "[[html s]] [[xml s]] [[url 'http://ex ample.com/a b#c']]",
+                        "[[raw s]] and [[raw u]]",
+                        "[[[raw a]] [[[[ [[#comment]]]]",
+                        "[[if a == 42]]yes[[end]][[if a == 1]]no[[end]][[if empty]][[end]]",
+                        "[[for v in l]]<[[raw v]]>[[end]][[for v in empty]]x[[end]]",
+                        "[[for v in l]][[for w in d['k']]][[raw v]][[raw w]],[[end]][[end]]",
+                        "[[for v in l]][[if v > 1]][[for v in d['k']]][[raw v]][[end]][[end]][[raw v]][[end]]",
+                        "[[for v in l]][[raw v]][[end]][[raw v]]",
+                        "[[raw ', '.join([ str(a) for a in l ])]]:[[raw a]]",
+                        "[[eval '[[raw a]] [[for v in l]][[raw v]][[end]]']]",
+                        "[[for k in d]][[raw k]][[raw d[k] ]][[end]]",
+                        ]:
+            self._AssertSame(source, keywords)
+
+        # the loop variable only exists in the loop
+        self.assertEquals("1,2,3,-x",
+                          self._AssertSame("[[for v in l]][[raw v]],[[end]]-[[raw v]]",
+                                           { "l": [ 1, 2, 3 ], "v": "x" }))
+
+    def testErrors(self):
+        keywords = { "a": 42 }
+        for source in [ "[[raw b]]",
+                        "[[html 1 +]]",
+                        "[[if b]]x[[end]]",
+                        "[[for v on a]]x[[end]]",
+                        "[[for v in a]]x[[end]]",
+                        "[[if 0]][[for v]]x[[end]][[raw 1 +]][[end]]ok",
+                        "[[insert 'missing.html']]",
+                        "[[raw a]]\n[[raw a + 'x']]",
+                        ]:
+            self._AssertSame(source, keywords)
+
+    def testInsert(self):
+        alt_header = os.path.join(self.getTestDataPath(), "templates", "default", "alt_header.html")
+        keywords = { "mypath": alt_header, "public_name": "My Name", "title": "My Title" }
+        self.assertHtmlEquals(" Name is My Name Title is My Title ",
+                              self._AssertSame("[[insert mypath]]", keywords))
+        self.assertEquals("", self._AssertSame("[[insert mypath]]", { "mypath": "" }))
+
+    def testThemes(self):
+        """
+        Parses and compiles all the templates of the bundled and test themes.
+        """
+        dirs = [ os.path.join(self.getTestDataPath(), "templates"),
+                 os.path.join(self.getTestDataPath(), "..", "templates") ]
+        count = 0
+        for d in dirs:
+            for root, subdirs, files in os.walk(d):
+                for name in files:
+                    if os.path.splitext(name)[1] in [ ".html", ".xml" ]:
+                        path = os.path.join(root, name)
+                        t = Template(self.Log(), file=path)
+                        Compiler(path).Compile(t._nodes)
+                        count += 1
+        self.assertTrue(count > 10)
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
@@ -44,6 +44,15 @@ class NodeTest(RigTestCase):
         self.assertEquals(NodeTag(Tag("for", True), [ "param1", "param2" ], content),
                           NodeTag(Tag("for", True), [ "param1", "param2" ], content))
 
+    def testJoinContent(self):
+        self.assertEquals("", JoinContent([]))
+        self.assertEquals("a\xe9b", JoinContent([ "a", "\xe9", "b" ]))
+        self.assertEquals(u"a\u20acb", JoinContent([ "a", u"\u20ac", "b" ]))
+        # ISO-8859-1 strings mixed with unicode are decoded
+        self.assertEquals(u"\xe9\u20ac", JoinContent([ "\xe9", u"\u20ac", "" ]))
+        self.assertEquals(u"\xe9\u20ac", NodeList([ NodeLiteral("\xe9"),
+                                                   NodeLiteral(u"\u20ac") ]).Generate(None, {}))
+
 
 #------------------------
 # Local Variables:
@@ -26,7 +26,7 @@ import os
 import StringIO
 
 from tests.rig_test_case import RigTestCase
-from rig.template.template import Template, _TagEnd
+from rig.template.template import Template, GenerateChunks, _TagEnd
 from rig.template.buffer import Buffer
 from rig.template.node import *
 from rig.template.tag import *
@@ -37,10 +37,10 @@ class MockParse(Template):
     A mock Template that overrides the _Parse method just to check if the
     constructor calls it adequately.
     """
-    def __init__(self, log, file=None, source=None):
+    def __init__(self, log, file=None, source=None, nodes=None):
         self.filename = None
         self.source = None
-        super(MockParse, self).__init__(log, file=file, source=source)
+        super(MockParse, self).__init__(log, file=file, source=source, nodes=nodes)
 
     def _Parse(self, filename, source):
         self.filename = filename
@@ -86,6 +86,18 @@ class TemplateTest(RigTestCase):
         self.assertEquals("template from StringIO", m.source)
         self.assertEquals("<file>", m.filename)
 
+    def testInitNodes(self):
+        """
+        Test that calling the constructor with nodes uses them without
+        parsing them.
+        """
+        nodes = Template(self.Log(), source="a [[if b]][[raw b]][[end]]").Nodes()
+        m = MockParse(self.Log(), nodes=nodes)
+        self.assertEquals(None, m.source)
+        self.assertSame(nodes, m.Nodes())
+        self.assertEquals("a 42", m.Generate({ "b": 42 }))
+        self.assertEquals("a 42", Template(self.Log(), nodes=nodes, compiled=True).Generate({ "b": 42 }))
+
     def testTags(self):
         m = MockParse(self.Log(), file=None, source="something")
         self.rigAssertIsInstance(dict, m._tags)
@@ -165,6 +177,32 @@ class TemplateTest(RigTestCase):
                           m._GetNextNode(b))
         self.assertTrue(b.EndReached())
 
+    def testGenerateChunks(self):
+        keywords = { "a": 42, "items": [ 1, 2 ] }
+        lines = [ "line [[raw a]]\n",
+                  "[[if a]]\n",
+                  "in if\n",
+                  "[[end]]\n",
+                  "[[for i in items]]\n",
+                  "[[raw i]]\n",
+                  "[[end]]\n",
+                  "[[[escaped]]\n",
+                  "[[raw\n",
+                  "a + 1]]\n",
+                  "last line" ]
+        expected = Template(self.Log(), source="".join(lines)).Generate(keywords)
+        for chunk_size in [ 1, 10, 30, 1000 ]:
+            chunks = list(GenerateChunks(self.Log(), lines, keywords, chunk_size))
+            self.assertEquals(expected, "".join(chunks))
+        # tags are never split between chunks
+        self.assertEquals([ "line 42\n", "\nin if\n\n", "\n1\n\n2\n\n",
+                            "[[escaped]]\n", "43\n", "last line" ],
+                          list(GenerateChunks(self.Log(), lines, keywords, 1)))
+
+        self.assertEquals([], list(GenerateChunks(self.Log(), [], keywords)))
+        self.assertRaises(SyntaxError, list,
+                          GenerateChunks(self.Log(), [ "[[if a]]\n", "no end\n" ], keywords, 1))
+
 
 #------------------------
 # Local Variables:
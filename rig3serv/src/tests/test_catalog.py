@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for Catalog
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import shutil
+
+from tests.rig_test_case import RigTestCase
+
+from rig.catalog import Catalog
+from rig.sites_settings import SiteSettings
+from rig.source_item import SourceDir, SourceFile, SourceSettings
+from rig.source_reader import SourceBlogReader, SourceCatalogReader
+
+#------------------------
+class CatalogTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._source = os.path.join(self._tempdir, "blog1")
+        shutil.copytree(os.path.join(self.getTestDataPath(), "album", "blog1"), self._source)
+        self._catalog = os.path.join(self._tempdir, "catalog.db")
+        self.sis = SiteSettings(public_name="Test Album")
+        self.sos = SourceSettings()
+
+    def tearDown(self):
+        self.RemoveDir(self._tempdir)
+
+    def _Update(self):
+        reader = SourceBlogReader(self.Log(), self.sis, self.sos, self._source)
+        items = [ i for i in reader.Parse(self._source)
+                  if isinstance(i, (SourceDir, SourceFile)) ]
+        c = Catalog(self.Log(), self._catalog).Open(create=True)
+        try:
+            return items, c.Update(self._source, items, self.sis.encoding)
+        finally:
+            c.Close()
+
+    def testOpen(self):
+        self.assertRaises(IOError, Catalog(self.Log(), self._catalog).Open)
+        c = Catalog(self.Log(), self._catalog).Open(create=True)
+        self.assertEquals(None, c.GetBase())
+        self.assertListEquals([], c.Items())
+        c.Close()
+        Catalog(self.Log(), self._catalog).Open().Close()
+
+    def testUpdate(self):
+        items, (updated, removed) = self._Update()
+        self.assertEquals(len(items), updated)
+        self.assertEquals(0, removed)
+
+        c = Catalog(self.Log(), self._catalog).Open()
+        self.assertEquals(self._source, c.GetBase())
+        rows = c.Items()
+        c.Close()
+        self.assertEquals(len(items), len(rows))
+
+        row = [ r for r in rows if r[0] == "2007-10-07_Folder 1" ][0]
+        self.assertEquals("dir", row[1])
+        self.assertListEquals([ "T12896_tiny_jpeg.jpg", "index.izu" ], row[3], sort=True)
+        self.assertListEquals([ "bar", "foo", "other" ], row[4]["cat"])
+
+        row = [ r for r in rows if r[0] == "file_items/2007-09-09 Izu File Item.izu" ][0]
+        self.assertEquals("file", row[1])
+        self.assertListEquals([], row[3])
+
+        # Nothing changed
+        items, (updated, removed) = self._Update()
+        self.assertEquals(0, updated)
+        self.assertEquals(0, removed)
+
+        # Change one entry and remove another one
+        f = file(os.path.join(self._source, "file_items", "2007-09-09 Izu File Item.izu"), "a")
+        f.write("More content\n")
+        f.close()
+        os.utime(os.path.join(self._source, "file_items", "2007-09-09 Izu File Item.izu"),
+                 (0, 1000000000))
+        os.unlink(os.path.join(self._source, "file_items", "2008-01-12 Some Html File.html"))
+
+        items, (updated, removed) = self._Update()
+        self.assertEquals(1, updated)
+        self.assertEquals(1, removed)
+
+        c = Catalog(self.Log(), self._catalog).Open()
+        rows2 = c.Items()
+        c.Close()
+        self.assertEquals(len(rows) - 1, len(rows2))
+        for r in rows2:
+            r1 = [ r1 for r1 in rows if r1[0] == r[0] ][0]
+            if r[0] == "file_items/2007-09-09 Izu File Item.izu":
+                self.assertNotEquals(r1[5], r[5])
+            else:
+                self.assertEquals(r1, r)
+
+    def testSourceCatalogReader(self):
+        items, _ = self._Update()
+
+        m = SourceCatalogReader(self.Log(), self.sis, self.sos, self._catalog)
+        catalog_items = m.Parse(self._tempdir)
+        self.assertEquals(len(items), len(catalog_items))
+
+        items.sort(key=lambda i: i.PrettyRepr())
+        catalog_items.sort(key=lambda i: i.PrettyRepr())
+        for item, catalog_item in zip(items, catalog_items):
+            self.assertEquals(type(item), type(catalog_item))
+            self.assertEquals(item.PrettyRepr(), catalog_item.PrettyRepr())
+            self.assertNotEquals(None, catalog_item.content_digest)
+            self.assertEquals(item.date.replace(microsecond=0), catalog_item.date)
+            if isinstance(item, SourceDir):
+                self.assertEquals(item.rel_dir, catalog_item.rel_dir)
+                self.assertListEquals(item.all_files, catalog_item.all_files)
+            else:
+                self.assertEquals(item.rel_file, catalog_item.rel_file)
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
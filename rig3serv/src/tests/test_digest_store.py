@@ -0,0 +1,114 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for DigestStore
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+
+from tests.rig_test_case import RigTestCase
+
+from rig import stats
+from rig.cache import Cache
+from rig.digest_store import DigestStore
+
+#------------------------
+class DigestStoreTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._cachedir = self.MakeTempDir()
+        self._cache = Cache(self.Log(), self._cachedir)
+        self._filename = os.path.join(self._tempdir, "index.izu")
+        self.m = DigestStore(self.Log(), self._cache)
+
+    def tearDown(self):
+        self.m = None
+        self._cache = None
+        self.RemoveDir(self._tempdir)
+        self.RemoveDir(self._cachedir)
+
+    def _Write(self, data):
+        f = file(self._filename, "wb")
+        f.write(data)
+        f.close()
+
+    def testFileDigest(self):
+        self._Write("Content")
+        s = stats.Start("1.0 Digest Read")
+        reads = s.count
+
+        d = self.m.FileDigest(self._filename)
+        self.assertEquals(40, len(d))
+        self.assertEquals(d, self.m.FileDigest(self._filename))
+        self.assertEquals(reads + 1, s.count)
+
+        # touched: read again, same digest
+        os.utime(self._filename, (0, 1000000000))
+        self.assertEquals(d, self.m.FileDigest(self._filename))
+        self.assertEquals(reads + 2, s.count)
+
+        # modified: new digest
+        self._Write("Other content")
+        self.assertNotEquals(d, self.m.FileDigest(self._filename))
+
+        self.assertRaises(OSError, self.m.FileDigest,
+                          os.path.join(self._tempdir, "unknown.izu"))
+
+    def testLoadSaveLoad(self):
+        self._Write("Content")
+        self.m.Load()
+        d = self.m.FileDigest(self._filename)
+        self.m.Save()
+
+        s = stats.Start("1.0 Digest Read")
+        reads = s.count
+
+        m2 = DigestStore(self.Log(), self._cache)
+        m2.Load()
+        self.assertEquals(d, m2.FileDigest(self._filename))
+        self.assertEquals(reads, s.count)
+
+    def testSaveUsedOnly(self):
+        self._Write("Content")
+        self.m.FileDigest(self._filename)
+        self.m.Save()
+
+        # A new run that does not use the file drops its digest
+        m2 = DigestStore(self.Log(), self._cache)
+        m2.Load()
+        self.assertEquals(1, len(m2._digests))
+        m2.Save()
+
+        m3 = DigestStore(self.Log(), self._cache)
+        m3.Load()
+        self.assertDictEquals({}, m3._digests)
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
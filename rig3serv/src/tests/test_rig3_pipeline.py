@@ -29,6 +29,8 @@ __author__ = "ralfoide gmail com"
 
 import types
 import os
+import re
+import shutil
 
 from tests.rig_test_case import RigTestCase
 from rig3 import Rig3
@@ -36,6 +38,7 @@ from rig.site_base import SiteBase
 from rig.site import CreateSite
 
 _DEST_DIR = "test_dest"  # in testdata dir
+_RE_GENERATED_ON = re.compile(r"Generated on [0-9: -]+")
 
 #------------------------
 class RenderPipeline(RigTestCase):
@@ -105,9 +108,9 @@ class RenderPipeline(RigTestCase):
             site.count_CollectCategories = 0
             site.count_GeneratePages = 0
 
-            def Patch_ProcessSourceItems(self, source, site_items, dups):
+            def Patch_ProcessSourceItems(self, source, site_items, dups, source_items=None):
                 self.count_ProcessSourceItems += 1
-                return self.old_ProcessSourceItems(source, site_items, dups)
+                return self.old_ProcessSourceItems(source, site_items, dups, source_items)
 
             def Patch_CollectCategories(self, site_items):
                 self.count_CollectCategories += 1
@@ -137,6 +140,73 @@ class RenderPipeline(RigTestCase):
         # Finally close the Rig3 instance
         r.Close()
 
+    def _RenderCopy(self, temp_dir, rc_defaults):
+        """
+        Renders a copy of the testdata in temp_dir, adding rc_defaults to the
+        [DEFAULT] section of its RC file, and returns the destination dir.
+        """
+        for name in [ "album", "templates" ]:
+            shutil.copytree(os.path.join(self._testdata, name), os.path.join(temp_dir, name))
+        items = os.path.join(temp_dir, "album", "blog1", "file_items")
+        f = file(os.path.join(items, "2008-02-02 Unicode Item.izu"), "wb")
+        f.write(u"[izu:encoding:utf-8] [izu:cat:\xe9t\xe9,foo] [izu:title:Caf\xe9 \u20ac]\n"
+                u"Un \xe9t\xe9 \xe0 3\u20ac, \u2028 __tr\xe8s__ [\xe9|http://example.com/\xe9]\n"
+                u"\xa0* \xe7a\x85\n".encode("utf-8"))
+        f.close()
+        f = file(os.path.join(items, "2008-02-03 Latin Item.izu"), "wb")
+        f.write(u"[izu:encoding:iso-8859-1] [izu:cat:foo]\n"
+                u"L'\xe9t\xe9 \xe0 Montr\xe9al \xa0 ''cr\xeapes''\n".encode("iso-8859-1"))
+        f.close()
+
+        rc = os.path.join(temp_dir, "z_last_render_testdata.rc")
+        f = file(os.path.join(self._testdata, "z_last_render_testdata.rc"))
+        data = f.read().replace("[DEFAULT]\n", "[DEFAULT]\n" + rc_defaults)
+        f.close()
+        f = file(rc, "w")
+        f.write(data)
+        f.close()
+
+        os.chdir(temp_dir)
+        os.mkdir(_DEST_DIR)
+        r = Rig3()
+        r.ParseArgs([ "rig3", "-c", rc, "--force" ])
+        r.Run()
+        r.Close()
+        return os.path.join(temp_dir, _DEST_DIR)
+
+    def testUnicodeText(self):
+        """
+        Tests that the unicode_text pipeline generates the same files as the
+        default ISO-8859-1 one, for Latin-1 and UTF-8 sources.
+        """
+        temp_dir = self.MakeTempDir()
+        try:
+            os.mkdir(os.path.join(temp_dir, "latin"))
+            os.mkdir(os.path.join(temp_dir, "unicode"))
+            latin = self._RenderCopy(os.path.join(temp_dir, "latin"), "")
+            unicode = self._RenderCopy(os.path.join(temp_dir, "unicode"), "unicode_text = True\n")
+
+            num_files = 0
+            found = False
+            for root, dirs, files in os.walk(latin):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    f = file(path, "rb")
+                    expected = _RE_GENERATED_ON.sub("", f.read())
+                    f.close()
+                    f = file(unicode + path[len(latin):], "rb")
+                    actual = _RE_GENERATED_ON.sub("", f.read())
+                    f.close()
+                    self.assertEquals(expected, actual, path)
+                    num_files += 1
+                    found = found or "Un &eacute;t&eacute; &agrave; 3&amp;#8364;" in actual
+            self.assertTrue(num_files > 50)
+            self.assertTrue(found)
+        finally:
+            os.chdir(self._pwd)
+            self.RemoveDir(temp_dir)
+
 
 
 #------------------------
@@ -23,6 +23,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 __author__ = "ralfoide at gmail com"
 
 import os
+import time
 from datetime import datetime
 
 from tests.rig_test_case import RigTestCase
@@ -83,6 +84,19 @@ class MockSourceReader(object):
     def Parse(self, dest_dir):
         return self._source_items
 
+class MockSlowSourceReader(MockSourceReader):
+    """
+    Like MockSourceReader except Parse waits for the given delay (in seconds)
+    before returning. Used to test _ParseSources with workers.
+    """
+    def __init__(self, source_items, delay):
+        super(MockSlowSourceReader, self).__init__(source_items)
+        self._delay = delay
+
+    def Parse(self, dest_dir):
+        time.sleep(self._delay)
+        return self._source_items
+
 #------------------------
 class SiteBaseTest(RigTestCase):
 
@@ -203,6 +217,99 @@ class SiteBaseTest(RigTestCase):
              ],
              in_out_items)
 
+    def testParseSources_Workers(self):
+        today = datetime.today()
+        sos2 = SourceSettings(rig_base="http://all.your.bases/are.../")
+
+        # The first source finishes parsing last, yet its items must
+        # come first and win over the duplicates of the other sources.
+        source1 = MockSlowSourceReader(
+             [
+             SourceFile(today, RelFile("/base", "file1"), self.sos),
+             SourceFile(today, RelFile("/base", "file2"), self.sos),
+             ], 0.2)
+        source2 = MockSlowSourceReader(
+             [
+             SourceFile(today, RelFile("/base", "file2"), self.sos),
+             SourceFile(today, RelFile("/base", "file3"), sos2),
+             ], 0.1)
+        source3 = MockSlowSourceReader(
+             [
+             SourceFile(today, RelFile("/base", "file3"), sos2),
+             SourceFile(today, RelFile("/base", "file1"), sos2),
+             ], 0)
+        source_list = [ source1, source2, source3 ]
+
+        self.sis.num_parse_workers = 3
+        m2 = MockSiteBase2(self, self.Log(), False, True, self.sis)
+
+        parsed = m2._ParseSources(source_list)
+        self.assertListEquals([ s._source_items for s in source_list ], parsed)
+
+        in_out_items = []
+        dups = {}
+        for source, source_items in zip(source_list, parsed):
+            m2._ProcessSourceItems(source, in_out_items, dups, source_items)
+
+        self.assertListEquals(
+             [
+             SourceFile(today, RelFile("/base", "file1"), self.sos),
+             SourceFile(today, RelFile("/base", "file2"), self.sos),
+             SourceFile(today, RelFile("/base", "file3"), sos2),
+             SourceFile(today, RelFile("/base", "file1"), sos2),
+             ],
+             in_out_items)
+
+    def testProcessSourceItems_ContentDigest(self):
+        tempdir = self.MakeTempDir()
+        try:
+            os.mkdir(os.path.join(tempdir, "dir1"))
+            for name in [ os.path.join("dir1", "index.izu"), "file1.izu" ]:
+                f = file(os.path.join(tempdir, name), "w")
+                f.write("Content of %s\n" % name)
+                f.close()
+
+            def _process():
+                # The dates typically come from the modification times
+                source = MockSourceReader(
+                     [
+                     SourceFile(datetime.today(), RelFile(tempdir, "file1.izu"), self.sos),
+                     SourceDir(datetime.today(), RelDir(tempdir, "dir1"), [ "index.izu" ], self.sos),
+                     SourceFile(datetime.today(), RelFile(tempdir, "file1.izu"), self.sos,
+                                content_digest="from a catalog"),
+                     ])
+                in_out_items = []
+                m2._ProcessSourceItems(source, in_out_items, {})
+                return in_out_items
+
+            self.sis.content_digest = True
+            m2 = MockSiteBase2(self, self.Log(), False, True, self.sis)
+            items = _process()
+            self.assertEquals(3, len(items))
+            self.assertEquals(40, len(items[0].content_digest))
+            self.assertEquals(40, len(items[1].content_digest))
+            self.assertEquals("from a catalog", items[2].content_digest)
+
+            # Touching the files keeps the same identity
+            time.sleep(0.01)
+            os.utime(os.path.join(tempdir, "file1.izu"), (0, 1000000000))
+            os.utime(os.path.join(tempdir, "dir1", "index.izu"), (0, 1000000000))
+            items2 = _process()
+            for i, i2 in zip(items, items2):
+                self.assertEquals(repr(i), repr(i2))
+                self.assertEquals(i.ContentHash().hexdigest(), i2.ContentHash().hexdigest())
+
+            # Changing the content changes it
+            f = file(os.path.join(tempdir, "dir1", "index.izu"), "a")
+            f.write("More content\n")
+            f.close()
+            items3 = _process()
+            self.assertEquals(repr(items[0]), repr(items3[0]))
+            self.assertNotEquals(repr(items[1]), repr(items3[1]))
+        finally:
+            self.RemoveDir(tempdir)
+
+
 
 #------------------------
 # Local Variables:
@@ -28,6 +28,7 @@ from tests.rig_test_case import RigTestCase
 
 from rig.source_item import SourceSettings
 from rig.source_reader import SourceDirReader, SourceFileReader, SourceBlogReader
+from rig.source_reader import SourceArchiveReader
 from rig.sites_settings import SitesSettings, SiteSettings, IncludeExclude
 
 #------------------------
@@ -170,6 +171,46 @@ class IncludeExcludeTest(RigTestCase):
         self.assertFalse(s.Matches([ "bar" ]))
         self.assertFalse(s.Matches([ "foo", "bar" ]))
 
+    def testExcludes(self):
+        s = IncludeExclude()
+        self.assertFalse(s.Excludes([]))
+        self.assertFalse(s.Excludes([ "foo" ]))
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "foo !bar")
+        self.assertFalse(s.Excludes([]))
+        self.assertFalse(s.Excludes([ "baz" ]))
+        self.assertTrue(s.Excludes([ "baz", "bar" ]))
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "!$")
+        self.assertTrue(s.Excludes([]))
+        self.assertFalse(s.Excludes([ "foo" ]))
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "!*")
+        self.assertTrue(s.Excludes([ "foo" ]))
+
+    def testMatchesAll(self):
+        s = IncludeExclude()
+        self.assertTrue(s.MatchesAll())
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "*")
+        self.assertTrue(s.MatchesAll())
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "foo")
+        self.assertFalse(s.MatchesAll())
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "!foo")
+        self.assertFalse(s.MatchesAll())
+
+        s = IncludeExclude()
+        s.Set("cat_filter", "!*")
+        self.assertFalse(s.MatchesAll())
+
 #------------------------
 class SitesSettingsTest(RigTestCase):
 
@@ -230,6 +271,13 @@ class SitesSettingsTest(RigTestCase):
             [ SourceFileReader(log, sis, SourceSettings(), "/my/path1,path2") ],
             sis.source_list)
 
+        # SourceArchiveReader
+        sis = SiteSettings()
+        self.m._ProcessSources(sis, { "sources": "archive:/my/blog.tar.gz" })
+        self.assertListEquals(
+            [ SourceArchiveReader(log, sis, SourceSettings(), "/my/blog.tar.gz") ],
+            sis.source_list)
+
         # Combined
         sis = SiteSettings()
         self.m._ProcessSources(sis, { "sources": "dir:/my/path1,file:/my/path2" })
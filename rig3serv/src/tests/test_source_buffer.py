@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for SourceBuffer
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+
+from tests.rig_test_case import RigTestCase
+
+from rig import source_buffer
+from rig import stats
+from rig.parser.dir_parser import RelFile
+from rig.parser.izu_parser import IzuParser
+
+#------------------------
+class SourceBufferTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._filename = os.path.join(self._tempdir, "index.izu")
+        source_buffer.Clear()
+
+    def tearDown(self):
+        source_buffer.Clear()
+        self.RemoveDir(self._tempdir)
+
+    def _Write(self, data):
+        f = file(self._filename, "wb")
+        f.write(data)
+        f.close()
+
+    def testGet(self):
+        self._Write("[izu:title:Title]\n[s:en]\nContent\n")
+        b = source_buffer.Get(self._filename)
+        self.assertNotEquals(None, b)
+        self.assertSame(b, source_buffer.Get(self._filename))
+        self.assertSame(b, source_buffer.Get(RelFile(self._tempdir, "index.izu")))
+
+        # the buffer changes with the file
+        self._Write("[izu:title:Another Title]\n[s:en]\nContent\n")
+        self.assertNotSame(b, source_buffer.Get(self._filename))
+
+        self.assertRaises(IOError, source_buffer.Get,
+                          os.path.join(self._tempdir, "unknown.izu"))
+
+    def testSingleOpen(self):
+        self._Write("[izu:title:Title] [izu:cat:foo]\n[s:en]\nContent\n")
+
+        s = stats.Start("1.0 Source Open")
+        opens = s.count
+
+        p = IzuParser(self.Log(), None, None)
+        tags = p.ParseFileFirstLine(self._filename, "iso-8859-1")
+        self.assertDictEquals({ "title": "Title", "cat": { "foo": True } }, tags)
+        tags, sections = p.RenderFileToHtml(self._filename, "iso-8859-1")
+        self.assertEquals("Title", tags["title"])
+        self.assertHtmlEquals('<span class="izu">Content</span>', sections["en"])
+
+        self.assertEquals(opens + 1, s.count)
+
+    def testLines(self):
+        self._Write("line 1\r\nline 2\rline 3\n\xc3\xa9t\xc3\xa9")
+        b = source_buffer.Get(self._filename)
+
+        # no encoding: universal end-of-lines
+        self.assertListEquals([ "line 1\n", "line 2\n", "line 3\n", "\xc3\xa9t\xc3\xa9" ],
+                              b.Lines(None))
+
+        # with an encoding: end-of-lines are preserved
+        self.assertListEquals([ u"line 1\r\n", u"line 2\r", u"line 3\n", u"\xe9t\xe9" ],
+                              b.Lines("utf-8"))
+
+        self.assertEquals(u"line 1\r\nline 2\rline 3\n\xe9t\xe9", b.Read("utf-8"))
+
+        f = b.Open("utf-8")
+        self.assertEquals(u"line 1\r\n", f.readline())
+        self.assertEquals(u"line 2\r", f.readline())
+        self.assertEquals(u"line 3\n", f.readline())
+        self.assertEquals(u"\xe9t\xe9", f.readline())
+        self.assertEquals("", f.readline())
+
+    def testHeaderLine(self):
+        # The header can be parsed using an encoding which is not valid
+        # for the rest of the file.
+        self._Write("[izu:encoding:iso-8859-1]\n[s:en]\n" + 80 * "-" + "\n\xe9t\xe9\n")
+        b = source_buffer.Get(self._filename)
+        self.assertEquals("[izu:encoding:iso-8859-1][s:en]", b.HeaderLine("utf-8"))
+        self.assertEquals("[izu:encoding:iso-8859-1][s:en]", b.HeaderLine(None))
+        self.assertEquals(u"[izu:encoding:iso-8859-1]\n[s:en]\n" + 80 * "-" + u"\n\xe9t\xe9\n",
+                          b.Read("iso-8859-1"))
+
+    def testHeaderLine_NotLoaded(self):
+        self._Write("[izu:title:T\xc3\xa9]\r\n[s:en]\r" + 200 * "-" + "\n\xe9t\xe9\n")
+        opens, reads = source_buffer.Counters()
+
+        # only the header is read and the file is not kept
+        self.assertEquals("[izu:title:T\xe9][s:en]",
+                          source_buffer.HeaderLine(self._filename, "utf-8"))
+        self.assertEquals("[izu:title:T\xc3\xa9][s:en]",
+                          source_buffer.HeaderLine(self._filename, None))
+        self.assertEquals((opens + 2, reads + 2), source_buffer.Counters())
+        self.assertEquals({}, source_buffer._BUFFERS)
+
+        # a loaded buffer is used instead of the file
+        b = source_buffer.Get(self._filename)
+        b.Data()
+        for encoding in [ "utf-8", None ]:
+            self.assertEquals(b.HeaderLine(encoding),
+                              source_buffer.HeaderLine(self._filename, encoding))
+        self.assertEquals(opens + 3, source_buffer.Counters()[0])
+
+        p = IzuParser(self.Log(), None, None)
+        source_buffer.Clear()
+        self.assertDictEquals({ "title": "T\xe9" }, p.ParseFileFirstLine(self._filename, "utf-8",
+                                                                         keep=False))
+        self.assertEquals({}, source_buffer._BUFFERS)
+
+        self.assertRaises(IOError, source_buffer.HeaderLine,
+                          os.path.join(self._tempdir, "unknown.izu"), None)
+
+    def testReadRange(self):
+        self._Write("0123456789")
+        opens, reads = source_buffer.Counters()
+
+        # the range is read without keeping the file
+        self.assertEquals("345", source_buffer.ReadRange(self._filename, 3, 3))
+        self.assertEquals((opens + 1, reads + 1), source_buffer.Counters())
+        self.assertEquals({}, source_buffer._BUFFERS)
+
+        # a loaded buffer is used instead of the file
+        b = source_buffer.Get(self._filename)
+        self.assertEquals("345", source_buffer.ReadRange(self._filename, 3, 3))
+        self.assertEquals((opens + 2, reads + 2), source_buffer.Counters())
+        b.Data()
+        self.assertEquals("789", source_buffer.ReadRange(self._filename, 7, 5))
+        self.assertEquals((opens + 3, reads + 3), source_buffer.Counters())
+
+        self.assertRaises(IOError, source_buffer.ReadRange,
+                          os.path.join(self._tempdir, "unknown.izu"), 0, 1)
+
+    def testXmlCharRefs(self):
+        for text in [ u"", u"abc", u"\xe9t\xe9\xa0\xff", u"3\u20ac \u2028\U0001d11e\xe9" ]:
+            expected = text.encode("iso-8859-1", "xmlcharrefreplace").decode("iso-8859-1")
+            self.assertEquals(expected, source_buffer.XmlCharRefs(text))
+        text = u"\xe9t\xe9"
+        self.assertSame(text, source_buffer.XmlCharRefs(text))
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End:
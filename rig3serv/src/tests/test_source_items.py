@@ -25,7 +25,7 @@ __author__ = "ralfoide at gmail com"
 from datetime import datetime
 
 from tests.rig_test_case import RigTestCase
-from rig.source_item import SourceDir, SourceFile, SourceSettings
+from rig.source_item import SourceDir, SourceFile, SourceContent, SourceSettings
 from rig.parser.dir_parser import RelDir, RelFile
 
 #------------------------
@@ -145,6 +145,37 @@ class SourceFileTest(RigTestCase):
         self.assertNotEquals(hash(s1), hash(s2))
 
 
+#------------------------
+class SourceContentTest(RigTestCase):
+
+    def testEqAndHash(self):
+        date1 = datetime.today()
+        sos = SourceSettings(rig_base="/rig/base")
+        rel_file = MockRelFile("/tmp", "foo.blog.izu")
+
+        s1 = SourceContent(date1, rel_file, "title", "content", { "cat": "foo" }, sos)
+        s2 = SourceContent(date1, rel_file, "title", "content", { "cat": "foo" }, sos)
+
+        # 2 equal but different objects
+        self.assertNotSame(s1, s2)
+        self.assertEquals(s1, s2)
+        self.assertEquals(hash(s1), hash(s2))
+        self.assertEquals(s1.ContentDigest(), s2.ContentDigest())
+        self.assertEquals(repr(s1), repr(s2))
+
+        # with a different content, the identity and the representation
+        # used for cache keys change.
+        s2 = SourceContent(date1, rel_file, "title", "content 2", { "cat": "foo" }, sos)
+        self.assertNotEquals(s1, s2)
+        self.assertNotEquals(hash(s1), hash(s2))
+        self.assertNotEquals(s1.ContentDigest(), s2.ContentDigest())
+        self.assertNotEquals(repr(s1), repr(s2))
+
+        # with a different title
+        s2 = SourceContent(date1, rel_file, "title 2", "content", { "cat": "foo" }, sos)
+        self.assertNotEquals(s1, s2)
+        self.assertNotEquals(hash(s1), hash(s2))
+
 
 #------------------------
 # Local Variables:
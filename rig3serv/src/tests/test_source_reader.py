@@ -23,14 +23,21 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 __author__ = "ralfoide at gmail com"
 
 import os
+import tarfile
+import zipfile
 from datetime import datetime
+from StringIO import StringIO
 
 from tests.rig_test_case import RigTestCase
 from rig.parser.dir_parser import RelDir, RelFile
 from rig.site_base import DEFAULT_THEME
 from rig.sites_settings import SiteSettings
 from rig.source_reader import SourceReaderBase, SourceDirReader, SourceFileReader, SourceBlogReader
-from rig.source_item import SourceDir, SourceFile, SourceSettings
+from rig.source_reader import OldIzuContentRef, SourceArchiveReader, ArchiveMemberRef
+from rig.source_item import SourceDir, SourceFile, SourceContent, SourceSettings
+from rig import stats
+from rig import source_buffer
+from rig import source_reader
 
 #------------------------
 class SourceReaderBaseTest(RigTestCase):
@@ -159,6 +166,142 @@ class SourceBlogReaderTest(RigTestCase):
             self.assertEquals("http://other/base/", item.source_settings.rig_base)
 
 
+#------------------------
+class MockOldIzuSourceBlogReader(SourceBlogReader):
+    """
+    Counts how many times a .blog.izu file gets indexed.
+    """
+    def __init__(self, log, settings, source_settings, path):
+        super(MockOldIzuSourceBlogReader, self).__init__(log, settings, source_settings, path)
+        self.count_index = 0
+
+    def _IndexOldIzu(self, rel_file, encoding):
+        self.count_index += 1
+        return super(MockOldIzuSourceBlogReader, self)._IndexOldIzu(rel_file, encoding)
+
+
+class SourceBlogReaderOldIzuTest(RigTestCase):
+
+    _OLD_IZU = ("[izu:izumi_base_url:http://izumi.example.com/izumi]\n"
+                "Some header text\n"
+                "----\n"
+                "[s:20070102:First Post]\n"
+                "Line one of first post\r\n"
+                "\n"
+                "Link [other|Page#s:20060101:Some Title] here\n"
+                "----\n"
+                "[s:20070103:]\n"
+                "ignored because no title\n"
+                "----\n"
+                "[s:bad header]\n"
+                "ignored too\n"
+                "[s:20070104:Second \xe9t\xe9]\n"
+                "Accents \xe9\xe0\n"
+                "----\n"
+                "last line without newline")
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._cachedir = self.MakeTempDir()
+        f = file(os.path.join(self._tempdir, "Main.blog.izu"), "wb")
+        f.write(self._OLD_IZU)
+        f.close()
+        self.sis = SiteSettings(public_name="Test Album",
+                                cache_dir=self._cachedir)
+        self.sos = SourceSettings()
+
+    def tearDown(self):
+        self.RemoveDir(self._tempdir)
+        self.RemoveDir(self._cachedir)
+
+    def _Parse(self):
+        m = MockOldIzuSourceBlogReader(self.Log(), self.sis, self.sos, self._tempdir)
+        items = []
+        m._ParseOldIzu(RelFile(self._tempdir, "Main.blog.izu"), "main", items)
+        return m, items
+
+    def testParseOldIzu(self):
+        m, items = self._Parse()
+        self.assertEquals(1, m.count_index)
+        self.assertEquals(2, len(items))
+
+        self.assertEquals(datetime(2007, 1, 2), items[0].date)
+        self.assertEquals("First Post", items[0].title)
+        self.assertDictEquals({ "izumi_base_url": "http://izumi.example.com/izumi",
+                                "date": datetime(2007, 1, 2),
+                                "cat": { "main": True } },
+                              items[0].tags)
+        self.assertEquals(
+            "Line one of first post\r\n\n"
+            "Link [other|http://izumi.example.com/izumi/Page?s=20060101_some_title] here\n",
+            items[0].GetContent())
+
+        self.assertEquals(datetime(2007, 1, 4), items[1].date)
+        self.assertEquals("Second \xe9t\xe9", items[1].title)
+        self.assertEquals("Accents \xe9\xe0\nlast line without newline",
+                          items[1].GetContent())
+
+    def testLazyContent(self):
+        # Indexing the file does not keep it in the source buffers
+        source_buffer.Clear()
+        m, items = self._Parse()
+        self.assertEquals(1, m.count_index)
+        self.assertEquals({}, source_buffer._BUFFERS)
+        for item in items:
+            # Content is not kept in memory, only a reference in the file
+            self.assertEquals(None, item.content)
+            self.rigAssertIsInstance(OldIzuContentRef, item.content_ref)
+        ref = items[1].content_ref
+        self.assertEquals(len("Accents \xe9\xe0\n----\nlast line without newline"), ref.length)
+        self.assertEquals(self._OLD_IZU.index("Accents"), ref.offset)
+
+        # Reading one entry does not load the whole file
+        source_buffer.Clear()
+        self.assertEquals("Accents \xe9\xe0\nlast line without newline", ref.Read())
+        self.assertEquals({}, source_buffer._BUFFERS)
+
+    def testPerEntryIdentity(self):
+        m1, items1 = self._Parse()
+
+        # Edit the first entry: this changes the file timestamp and the
+        # offsets of the following entries but not their content.
+        data = self._OLD_IZU.replace("Line one of first post", "Line 1 of the first post")
+        f = file(os.path.join(self._tempdir, "Main.blog.izu"), "wb")
+        f.write(data)
+        f.close()
+
+        m2, items2 = self._Parse()
+        self.assertEquals(1, m2.count_index)
+        self.assertEquals(2, len(items2))
+
+        self.assertNotEquals(items1[0].ContentDigest(), items2[0].ContentDigest())
+        self.assertNotEquals(items1[0].RigHash().hexdigest(), items2[0].RigHash().hexdigest())
+        self.assertNotEquals(repr(items1[0]), repr(items2[0]))
+
+        self.assertNotEquals(items1[1].content_ref.offset, items2[1].content_ref.offset)
+        self.assertEquals(items1[1].ContentDigest(), items2[1].ContentDigest())
+        self.assertEquals(items1[1].RigHash().hexdigest(), items2[1].RigHash().hexdigest())
+        self.assertEquals(repr(items1[1]), repr(items2[1]))
+
+    def testPersistedIndex(self):
+        m1, items1 = self._Parse()
+        self.assertEquals(1, m1.count_index)
+
+        # A new reader reuses the index from the cache
+        m2, items2 = self._Parse()
+        self.assertEquals(0, m2.count_index)
+        self.assertListEquals(items1, items2)
+
+        # Modifying the file invalidates the index
+        f = file(os.path.join(self._tempdir, "Main.blog.izu"), "ab")
+        f.write("\n[s:20070105:Third]\nThird post\n")
+        f.close()
+        m3, items3 = self._Parse()
+        self.assertEquals(1, m3.count_index)
+        self.assertEquals(3, len(items3))
+        self.assertEquals("Third post\n", items3[2].GetContent())
+
+
 #------------------------
 class MockSourceDirReader(SourceDirReader):
     def __init__(self, log, settings, source_settings, path):
@@ -363,6 +506,155 @@ class SourceFileReaderTest(RigTestCase):
             self.assertEquals("http://other/base/", item.source_settings.rig_base)
 
 
+#------------------------
+class MockSourceArchiveReader(SourceArchiveReader):
+    """
+    Counts the number of times the archive members get indexed.
+    """
+    def __init__(self, log, site_settings, source_settings, path):
+        super(MockSourceArchiveReader, self).__init__(log, site_settings, source_settings, path)
+        self.count_index = 0
+
+    def _IndexArchive(self, archive, encoding):
+        self.count_index += 1
+        return super(MockSourceArchiveReader, self)._IndexArchive(archive, encoding)
+
+
+#------------------------
+class SourceArchiveReaderTest(RigTestCase):
+
+    _MEMBERS = [
+        ("2007-10-07_Folder 1/index.izu", "[izu:cat:foo,bar]\n[s:en]\nFolder 1 \xc3\xa9t\xc3\xa9\n"),
+        ("2007-10-07_Folder 1/image.jpg", "not really a jpeg"),
+        ("2007-10-08_Images only/image.jpg", "not really a jpeg"),
+        ("posts/2008-01-02 File Post.izu", "[izu:encoding:iso-8859-1]\nFile \xe9t\xe9\n"),
+        ("posts/2008-01-03 Html Post.html", "<!-- [izu:cat:videos] -->\n<b>Html</b>\n"),
+        ("posts/notes.txt", "not an entry"),
+        ("posts/Main.blog.izu", "not supported"),
+        ]
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._cachedir = self.MakeTempDir()
+        self.sis = SiteSettings(public_name="Test Album",
+                                cache_dir=self._cachedir,
+                                encoding="utf-8")
+        self.sos = SourceSettings()
+
+    def tearDown(self):
+        self.RemoveDir(self._tempdir)
+        self.RemoveDir(self._cachedir)
+
+    def _WriteTar(self, name, mode):
+        path = os.path.join(self._tempdir, name)
+        tar = tarfile.open(path, mode)
+        for member, data in self._MEMBERS:
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            info.mtime = 1200000000
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        return path
+
+    def _WriteZip(self, name):
+        path = os.path.join(self._tempdir, name)
+        z = zipfile.ZipFile(path, "w")
+        for member, data in self._MEMBERS:
+            z.writestr(zipfile.ZipInfo(member, (2008, 1, 10, 12, 0, 0)), data)
+        z.close()
+        return path
+
+    def _CheckItems(self, path):
+        m = MockSourceArchiveReader(self.Log(), self.sis, self.sos, path)
+        items = m.Parse(self._tempdir)
+        self.assertEquals(3, len(items))
+        for item in items:
+            self.rigAssertIsInstance(SourceContent, item)
+            self.assertEquals(path, item.rel_file.abs_base)
+            self.rigAssertIsInstance(ArchiveMemberRef, item.content_ref)
+
+        self.assertEquals("2007-10-07_Folder 1", items[0].title)
+        self.assertEquals("2007-10-07_Folder 1/index.izu", items[0].rel_file.rel_curr)
+        self.assertDictEquals({ "cat": { "foo": True, "bar": True } }, items[0].tags)
+        self.assertEquals("[izu:cat:foo,bar]\n[s:en]\nFolder 1 \xe9t\xe9\n",
+                          items[0].GetContent())
+
+        # The encoding tag of the header overrides the site's one
+        self.assertEquals("2008-01-02 File Post", items[1].title)
+        self.assertDictEquals({ "encoding": "iso-8859-1" }, items[1].tags)
+        self.assertEquals("[izu:encoding:iso-8859-1]\nFile \xe9t\xe9\n",
+                          items[1].GetContent())
+
+        self.assertEquals("2008-01-03 Html Post", items[2].title)
+        self.assertDictEquals({ "cat": { "videos": True } }, items[2].tags)
+        self.assertEquals("<!-- [izu:cat:videos] -->\n<b>Html</b>\n",
+                          items[2].GetContent())
+        return m, items
+
+    def testParseTar(self):
+        self._CheckItems(self._WriteTar("blog.tar", "w"))
+
+    def testParseTarGz(self):
+        self._CheckItems(self._WriteTar("blog.tar.gz", "w:gz"))
+
+    def testParseZip(self):
+        self._CheckItems(self._WriteZip("blog.zip"))
+
+    def testIndexOncePerRun(self):
+        path = self._WriteZip("blog.zip")
+        s = stats.Start("1.0 Archive Open")
+        opens = s.count
+
+        m1, items1 = self._CheckItems(path)
+        m2, items2 = self._CheckItems(path)
+        self.assertEquals(1, m1.count_index)
+        self.assertEquals(0, m2.count_index)
+        self.assertEquals(opens + 1, s.count)
+
+        # items have a stable identity
+        for i in xrange(len(items1)):
+            self.assertEquals(items1[i], items2[i])
+            self.assertEquals(repr(items1[i]), repr(items2[i]))
+            self.assertEquals(items1[i].RigHash().hexdigest(), items2[i].RigHash().hexdigest())
+
+    def testPersistedIndex(self):
+        path = self._WriteTar("blog.tar", "w")
+        m1 = MockSourceArchiveReader(self.Log(), self.sis, self.sos, path)
+        items1 = m1.Parse(self._tempdir)
+
+        # A new run uses the persisted index without reading the members
+        source_reader._ARCHIVES.clear()
+        s = stats.Start("1.0 Archive Open")
+        opens = s.count
+        m2 = MockSourceArchiveReader(self.Log(), self.sis, self.sos, path)
+        items2 = m2.Parse(self._tempdir)
+        self.assertEquals(1, m1.count_index)
+        self.assertEquals(0, m2.count_index)
+        self.assertEquals(opens, s.count)
+        self.assertEquals(repr(items1), repr(items2))
+
+        # The archive is opened once to read the content
+        self.assertEquals(self._MEMBERS[0][1].replace("\xc3\xa9", "\xe9"), items2[0].GetContent())
+        self.assertEquals(self._MEMBERS[3][1], items2[1].GetContent())
+        self.assertEquals(opens + 1, s.count)
+
+    def testReadCompressedTar(self):
+        # Members of a compressed tar can be read in any order, even if it
+        # restarts the decompression.
+        m, items = self._CheckItems(self._WriteTar("blog.tar.bz2", "w:bz2"))
+        items.reverse()
+        self.assertEquals([ "<!-- [izu:cat:videos] -->\n<b>Html</b>\n",
+                            "[izu:encoding:iso-8859-1]\nFile \xe9t\xe9\n",
+                            "[izu:cat:foo,bar]\n[s:en]\nFolder 1 \xe9t\xe9\n" ],
+                          [ item.GetContent() for item in items ])
+
+    def testHeaderTags(self):
+        path = self._WriteZip("blog.zip")
+        m = MockSourceArchiveReader(self.Log(), self.sis, self.sos, path)
+        for item in m.Parse(self._tempdir):
+            self.assertTrue(item.header_tags)
+
+
 
 #------------------------
 # Local Variables:
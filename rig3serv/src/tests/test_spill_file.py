@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------|
+"""
+Unit tests for SpillFile
+
+Part of Rig3.
+Copyright (C) 2007-2009 ralfoide gmail com
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+__author__ = "ralfoide at gmail com"
+
+import os
+import sha
+
+from tests.rig_test_case import RigTestCase
+from rig.spill_file import SpillFile, SpillWriter
+
+#------------------------
+class SpillFileTest(RigTestCase):
+
+    def setUp(self):
+        self._tempdir = self.MakeTempDir()
+        self._spill_dir = os.path.join(self._tempdir, "spill")
+
+    def tearDown(self):
+        self.RemoveDir(self._tempdir)
+
+    def testStore(self):
+        w = SpillWriter(self._spill_dir)
+        w.Write("line 1\n")
+        w.Write("line 2\n")
+        f = w.Close()
+        digest = sha.new("line 1\nline 2\n").hexdigest()
+        self.assertEquals(digest, f.Digest())
+        self.assertEquals(os.path.join(self._spill_dir, digest[0:2], digest), f.Path())
+        self.assertEquals(14, f.Size())
+        self.assertTrue(f)
+        self.assertEquals("<SpillFile %s>" % digest, repr(f))
+        self.assertEquals("line 1\nline 2\n", f.Read())
+        self.assertListEquals([ "line 1\n", "line 2\n" ], list(f.Lines()))
+
+        # the same content is stored once
+        w = SpillWriter(self._spill_dir)
+        w.Write("line 1\nline 2\n")
+        f2 = w.Close()
+        self.assertEquals(f.Path(), f2.Path())
+        self.assertListEquals([ digest ], os.listdir(os.path.dirname(f.Path())))
+
+    def testTemporary(self):
+        w = SpillWriter(self._spill_dir)
+        f = w.Close(store=False)
+        self.assertFalse(f)
+        self.assertEquals("", f.Read())
+        self.assertEquals(self._spill_dir, os.path.dirname(f.Path()))
+        self.assertTrue(f.Exists())
+        f.Remove()
+        self.assertFalse(f.Exists())
+        self.assertListEquals([], os.listdir(self._spill_dir))
+
+    def testDiscard(self):
+        w = SpillWriter(self._spill_dir)
+        w.Write("partial")
+        w.Discard()
+        self.assertListEquals([], os.listdir(self._spill_dir))
+
+        # a closed file is kept
+        w = SpillWriter(self._spill_dir)
+        w.Write("line 1\n")
+        f = w.Close()
+        w.Discard()
+        self.assertTrue(f.Exists())
+
+    def testUnicode(self):
+        w = SpillWriter(self._spill_dir)
+        w.Write("abc ")
+        w.Write(u"\xe9t\xe9\n")
+        w.Write(u"2")
+        f = w.Close()
+        self.assertEquals(u"abc \xe9t\xe9\n2", f.Read())
+        self.assertListEquals([ u"abc \xe9t\xe9\n", u"2" ], list(f.Lines()))
+        self.assertEquals(11, f.Size())
+
+
+#------------------------
+# Local Variables:
+# mode: python
+# tab-width: 4
+# py-continuation-offset: 4
+# py-indent-offset: 4
+# sentence-end-double-space: nil
+# fill-column: 79
+# End: